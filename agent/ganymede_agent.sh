@@ -58,6 +58,43 @@ ISOFORMAT='%Y-%m-%dT%H:%M:%S'
 # doing.
 DUMPOPTS='--default-character-set=utf8 --disable-keys --extended-insert --no-create-db --quick --single-transaction --dump-date --tz-utc'
 
+# CHUNKSIZE:
+# The size (in bytes) of each piece of the encrypted dump sent to Ganymede. When a transfer fails, only the piece
+# that failed is sent again.
+CHUNKSIZE=8388608
+
+# LOGBATCH:
+# 'yes' queues the stage messages and sends them to Ganymede together (before the transfer starts, and at the end
+# or on an abort) with one request. 'no' sends each message as soon as its stage completes.
+LOGBATCH='yes'
+
+# DUMPMODE:
+# 'single' dumps every table with one mysqldump run, which gives one consistent snapshot of the schema. 'table'
+# dumps each table separately, DUMPJOBS at a time, into its own compressed member of a tar archive so the worker
+# can load the tables in parallel too. Each table is a consistent snapshot on its own, but the tables are not
+# guaranteed to be consistent with each other. 'table' mode always uses the 'file' TRANSFERMODE.
+DUMPMODE='single'
+
+# DUMPJOBS:
+# The number of tables to dump at once when DUMPMODE is 'table'
+DUMPJOBS=4
+
+# CODEC:
+# The compression program for the dump. 'gzip' is single-threaded; 'pigz' writes gzip-compatible output using
+# CODECTHREADS threads; 'zstd' compresses better and faster with CODECTHREADS threads; 'lz4' is the fastest but
+# compresses the least. The codec is recorded in the dump's file extension so the worker can decompress it.
+CODEC='gzip'
+
+# CODECTHREADS:
+# The number of compression threads for pigz and zstd. 0 means one per CPU.
+CODECTHREADS=0
+
+# TRANSFERMODE:
+# How the dump gets to Ganymede. 'file' dumps, compresses and encrypts into local files and then uploads the
+# result. 'stream' pipes the dump through compression and encryption straight into the upload, so the stages run
+# concurrently and the only local storage used is two chunks of CHUNKSIZE bytes.
+TRANSFERMODE='file'
+
 # PYTHON:
 # The Python interpreter to use. Note: For RHEL 5, set to 'python26'
 PYTHON='python2'
@@ -153,13 +190,72 @@ function abort_local()
 function abort_and_notify()
 {
    # Abort the operation and notify Ganymede
-   TSTAMP=`date --utc "+${ISOFORMAT}"`
-   local PARMS
-   PARMS=$(encode_params timestamp "${TSTAMP}" stage ${STAGE} status FATAL message "$@")
-   POST /agent/${AGENTID}/log/${TRANSID} "${PARMS}"
+   log_event ${STAGE} FATAL "$@"
+   flush_events
    abort_local "$@"
 }
 
+function log_event()
+{
+   # Report a stage status to Ganymede, or queue it when LOGBATCH is 'yes'
+   # Parameters: $1 - stage, $2 - status, $3 - message
+   local TSTAMP=`date --utc "+${ISOFORMAT}"`
+   local PARMS
+   if test "${LOGBATCH}" = 'yes' -a -d "${DUMPDIR}"
+   then
+      ${PYTHON} -c 'import json, sys
+print(json.dumps(dict(zip(("transid", "stage", "status", "timestamp", "message"), sys.argv[1:]))))' \
+         "${TRANSID}" "$1" "$2" "${TSTAMP}" "$3" >> ${DUMPDIR}/log.queue
+   else
+      PARMS=$(encode_params timestamp "${TSTAMP}" stage $1 status $2 message "$3")
+      POST /agent/${AGENTID}/log/${TRANSID} "${PARMS}"
+   fi
+}
+
+function flush_events()
+{
+   # Send the queued stage messages to Ganymede with one request, and log the ones it rejects. Ganymede ignores a
+   # message it already has, so when there is no batch reply (an older Ganymede, or a reply lost on the way) the
+   # messages are sent again one at a time.
+   local QUEUE="${DUMPDIR}/log.queue"
+   local BODY
+   local REPLY
+   local REJECTED
+   test -s "${QUEUE}" || return
+   BODY=$(${PYTHON} -c 'import json, sys
+print(json.dumps([json.loads(l) for l in sys.stdin if l.strip()]))' < ${QUEUE})
+   REPLY=$(POST /agent/${AGENTID}/log/batch "${BODY}" -H 'Content-Type: application/json' 2>&1)
+   REJECTED=$(${PYTHON} -c 'import json, sys
+try:
+    reply = json.loads(sys.argv[1])
+    rejected = [(r["index"], r["status_message"]) for r in reply["rejected"]]
+except (ValueError, KeyError, TypeError):
+    sys.exit(1)
+events = [json.loads(l) for l in open(sys.argv[2]) if l.strip()]
+for (index, reason) in rejected:
+    e = events[index]
+    print((e["stage"] + " " + e["status"] + " (" + e["message"] + "): " + reason).encode("utf-8"))' \
+      "${REPLY}" "${QUEUE}")
+   if test $? -eq 0
+   then
+      echo "${REJECTED}" | while read LINE
+      do
+         test "${LINE}" && log "Ganymede rejected the queued message ${LINE}"
+      done
+   else
+      ${PYTHON} -c 'import json, sys, urllib
+for l in sys.stdin:
+    if l.strip():
+        e = json.loads(l)
+        sys.stdout.write(urllib.urlencode([(k, e[k].encode("utf-8")) for k in ("timestamp", "stage", "status", "message")]) + "\n")' \
+         < ${QUEUE} | while read PARMS
+      do
+         POST /agent/${AGENTID}/log/${TRANSID} "${PARMS}"
+      done
+   fi
+   rm -f ${QUEUE}
+}
+
 function log()
 {
    # Logs a message
@@ -402,6 +498,78 @@ function dump_mysql()
    echo 'FAIL'
 }
 
+function dump_table()
+{
+   # Dump one table into its own compressed file, making 3 attempts like dump_mysql
+   # Parameters: $1 - the table, $2 - the directory to write the dump to
+   # Writes ${DUMPDIR}/meta/<table>.bytes with the uncompressed size, or <table>.fail if every attempt failed
+   local NUM=0
+   local TRIES=3
+   local PAUSE=120
+   local META="${DUMPDIR}/meta/${1}"
+   local -a STATUS
+   while test ${NUM} -lt ${TRIES}
+   do
+      test ${NUM} -eq 0 || { sleep $((NUM * PAUSE)); }
+      ${MYSQLDUMP} -u"${DBUSER}" -p"${DBPASS}" -h"${DBHOST}" ${DUMPOPTS} ${DBSCHEMA} ${1} 2>${META}.err \
+         | dd bs=65536 2>${META}.bytes | compress_stream > ${2}/${1}.sql.$(codec_ext)
+      STATUS=(${PIPESTATUS[@]})
+      if test ${STATUS[0]} -eq 0 -a ${STATUS[2]} -eq 0
+      then
+         rm -f ${META}.err
+         return 0
+      fi
+      NUM=$((NUM + 1))
+   done
+   touch ${META}.fail
+   return 1
+}
+
+function dump_tables()
+{
+   # Dump every table in DBTABLES (or the whole schema) with dump_table, DUMPJOBS at a time
+   # Echoes the directory holding the table dumps, or FAIL
+   local TABLEDIR="${DUMPDIR}/sql_${GEO}_${TRANSID}"
+   local TABLES="${DBTABLES}"
+   local TABLE
+   local -a PIDS
+
+   rm -rf ${TABLEDIR} ${DUMPDIR}/meta
+   mkdir -p ${TABLEDIR} ${DUMPDIR}/meta || { echo 'FAIL'; return; }
+   if test -z "${TABLES}"
+   then
+      # no table list means the whole schema, as with dump_mysql
+      TABLES=$(${MYSQL} -u"${DBUSER}" -p"${DBPASS}" -h"${DBHOST}" --skip-column-names -e 'show tables' ${DBSCHEMA} 2>/dev/null)
+      test -n "${TABLES}" || { echo 'FAIL'; return; }
+   fi
+   for TABLE in ${TABLES}
+   do
+      if test ${#PIDS[@]} -ge ${DUMPJOBS}
+      then
+         # wait for the oldest dump before starting another
+         wait ${PIDS[0]}
+         PIDS=("${PIDS[@]:1}")
+      fi
+      dump_table ${TABLE} ${TABLEDIR} >/dev/null &
+      PIDS+=($!)
+   done
+   wait
+
+   if ls ${DUMPDIR}/meta/*.fail >/dev/null 2>&1
+   then
+      log "Failed to dump tables: $(cd ${DUMPDIR}/meta && ls *.fail | sed -e 's/\.fail$//' | tr '\n' ' ')"
+      echo 'FAIL'
+   else
+      echo ${TABLEDIR}
+   fi
+}
+
+function table_bytes()
+{
+   # Echo the total uncompressed size of the table dumps made by dump_tables
+   cat ${DUMPDIR}/meta/*.bytes 2>/dev/null | awk '/bytes/ {total += $1} END {print total + 0}'
+}
+
 function encrypt_dump()
 {
    # Encrypt the dump file
@@ -420,6 +588,249 @@ function encrypt_dump()
    echo ${RET}
 }
 
+function transfer_status()
+{
+   # Ask Ganymede how many bytes of the encrypted dump it already has
+   # Parameters: $1 - the file name of the encrypted dump
+   local HTTPOUT
+   local RECEIVED
+
+   HTTPOUT=$(GET /agent/${AGENTID}/transfer/${TRANSID} -q "filename=${1}" 2>/dev/null)
+   RECEIVED=$(parse_json bytes_received "${HTTPOUT}")
+   test "${RECEIVED}" || RECEIVED=0
+   echo ${RECEIVED}
+}
+
+function codec_ext()
+{
+   # Echo the file extension for CODEC
+   case "${CODEC}" in
+      gzip|pigz) echo 'gz' ;;
+      zstd) echo 'zst' ;;
+      lz4) echo 'lz4' ;;
+      *) echo 'FAIL' ;;
+   esac
+}
+
+function compress_stream()
+{
+   # Compress stdin to stdout with CODEC
+   local THREADS=${CODECTHREADS}
+   test ${THREADS} -gt 0 || THREADS=$(nproc 2>/dev/null || echo 1)
+   case "${CODEC}" in
+      gzip) gzip -c ;;
+      pigz) pigz -c -p ${THREADS} ;;
+      zstd) zstd -c -q -T${THREADS} ;;
+      lz4) lz4 -c -q ;;
+      *) return 1 ;;
+   esac
+}
+
+function compress_stats()
+{
+   # Echo the codec, compression ratio and throughput (uncompressed MB per second) for the COMPRESS message
+   # Parameters: $1 - uncompressed bytes, $2 - compressed bytes, $3 - elapsed milliseconds
+   awk -v codec=${CODEC} -v pre=${1} -v post=${2} -v ms=${3} 'BEGIN {
+      ratio = (post > 0) ? pre / post : 0
+      if (ms < 1) ms = 1
+      printf "Codec: %s, Ratio: %.2f, Throughput: %.1f MB/s", codec, ratio, pre / 1048576 / (ms / 1000)
+   }'
+}
+
+function put_chunk()
+{
+   # Make one attempt at sending a chunk of the encrypted dump to Ganymede
+   # Parameters: $1 - the chunk file, $2 - offset of the chunk, $3 - total size of the dump ('*' if not yet known),
+   #             $4 - the file name of the encrypted dump
+   local LENGTH
+   local CHECKSUM
+
+   LENGTH=$(ls -l ${1} | awk '{print $5}')
+   CHECKSUM=$(openssl dgst -md5 -binary ${1} | base64)
+   PUT /agent/${AGENTID}/transfer/${TRANSID} -q "filename=${4}" --data-binary "@${1}" \
+      -H "Content-Range: bytes ${2}-$(($2 + LENGTH - 1))/${3}" -H "Content-MD5: ${CHECKSUM}" >/dev/null 2>&1
+}
+
+function transfer_chunk()
+{
+   # Send one chunk of the encrypted dump to Ganymede
+   # Parameters: $1 - the encrypted dump, $2 - offset of the chunk, $3 - total size of the dump
+   # Echoes the offset of the next chunk, or FAIL
+   local CHUNKFILE="${DUMPDIR}/chunk.out"
+   local LENGTH
+
+   tail -c +$(($2 + 1)) ${1} | head -c ${CHUNKSIZE} > ${CHUNKFILE}
+   LENGTH=$(ls -l ${CHUNKFILE} | awk '{print $5}')
+   test ${LENGTH} -gt 0 || { rm -f ${CHUNKFILE}; echo 'FAIL'; return; }
+
+   put_chunk ${CHUNKFILE} ${2} ${3} $(basename ${1})
+   if test $? -eq 0
+   then
+      echo $(($2 + LENGTH))
+   else
+      echo 'FAIL'
+   fi
+   rm -f ${CHUNKFILE}
+}
+
+function send_chunk()
+{
+   # Send a chunk of a streamed dump to Ganymede, retrying up to 5 times
+   # Parameters: $1 - the chunk file, $2 - offset of the chunk, $3 - the file name of the encrypted dump
+   local NUM=1
+   while test ${NUM} -lt 6
+   do
+      put_chunk ${1} ${2} '*' ${3} && return 0
+      log "Attempt ${NUM} to transfer chunk at offset ${2} failed"
+      ((NUM = NUM + 1))
+      sleep 5
+   done
+   return 1
+}
+
+function stream_dump()
+{
+   # Dump, compress and encrypt in a single pipeline, writing the encrypted stream to stdout. Every stage writes
+   # its exit status and the time it finished to ${DUMPDIR}/stream.*; the dd stages count the bytes between them.
+   # Parameters: $1 - the file containing the passphrase
+   local SD="${DUMPDIR}/stream"
+
+   { ${MYSQLDUMP} -u"${DBUSER}" -p"${DBPASS}" -h"${DBHOST}" ${DUMPOPTS} ${DBSCHEMA} ${DBTABLES} 2>${SD}.err
+     echo $? > ${SD}.dump_status; date +%s%3N > ${SD}.dump_end; } \
+   | tee >(tail -1 > ${SD}.dump_tail) \
+   | dd bs=65536 2>${SD}.dump_bytes \
+   | { compress_stream; echo $? > ${SD}.compress_status; date +%s%3N > ${SD}.compress_end; } \
+   | dd bs=65536 2>${SD}.compress_bytes \
+   | { openssl enc -aes-256-cbc -salt -pass file:${1}; echo $? > ${SD}.encrypt_status; date +%s%3N > ${SD}.encrypt_end; }
+}
+
+function stream_bytes()
+{
+   # Report the byte count recorded by one of the dd stages in stream_dump
+   # Parameters: $1 - the stage name (dump or compress)
+   tail -1 ${DUMPDIR}/stream.${1}_bytes 2>/dev/null | awk '{print $1}'
+}
+
+function stream_transfer()
+{
+   # Stream the dump to Ganymede. The next chunk is read from the pipeline while the previous one uploads.
+   # Parameters: $1 - the file containing the passphrase, $2 - the file name of the encrypted dump
+   # Sets STREAMSIZE to the number of encrypted bytes sent. Returns non-zero if a chunk could not be sent.
+   local CHUNK_A="${DUMPDIR}/chunk_a.out"
+   local CHUNK_B="${DUMPDIR}/chunk_b.out"
+   local CHUNK=${CHUNK_A}
+   local LENGTH
+   local SENDER=''
+   local RET=0
+
+   STREAMSIZE=0
+   rm -f ${DUMPDIR}/stream.*
+   while true
+   do
+      dd of=${CHUNK} bs=${CHUNKSIZE} count=1 iflag=fullblock 2>/dev/null
+      LENGTH=$(ls -l ${CHUNK} | awk '{print $5}')
+      if test "${SENDER}"
+      then
+         wait ${SENDER} || { RET=1; break; }
+         SENDER=''
+      fi
+      test ${LENGTH} -eq 0 && break
+      send_chunk ${CHUNK} ${STREAMSIZE} ${2} </dev/null &
+      SENDER=$!
+      ((STREAMSIZE = STREAMSIZE + LENGTH))
+      if test "${CHUNK}" = "${CHUNK_A}"
+      then
+         CHUNK=${CHUNK_B}
+      else
+         CHUNK=${CHUNK_A}
+      fi
+   done < <(stream_dump ${1})
+   rm -f ${CHUNK_A} ${CHUNK_B}
+
+   # the tail of the dump is captured by a process substitution that may still be finishing
+   local NUM=0
+   while test ! -s ${DUMPDIR}/stream.dump_tail -a ${NUM} -lt 10
+   do
+      sleep 1
+      ((NUM = NUM + 1))
+   done
+   return ${RET}
+}
+
+function stream_transaction()
+{
+   # Perform the DUMP, COMPRESS, ENCRYPT and TRANSFER stages as one pipeline, then report each stage
+   local FILENAME="sql_${GEO}_${TRANSID}.sql.$(codec_ext).encrypted"
+   local KEYFILE="${DUMPDIR}/nonce.out"
+   local START
+   local ELAPSED
+   local NUM=0
+   local TRIES=3
+   local PAUSE=120
+   local DUMPED=''
+
+   STAGE='AGENT_DUMP'
+   test $(verify_mysql) = "SUCCESS" || abort_and_notify "Cannot access database server"
+
+   # Like dump_mysql, make 3 attempts with a back-off. Each attempt restarts the upload at offset 0.
+   while test ${NUM} -lt ${TRIES}
+   do
+      test ${NUM} -eq 0 || { sleep $((NUM * PAUSE)); }
+      echo -n "${NONCE}" | base64 -d - > ${KEYFILE}
+      START=$(date +%s%3N)
+      stream_transfer ${KEYFILE} ${FILENAME}
+      if test $? -ne 0
+      then
+         STAGE='AGENT_TRANSFER'
+         abort_and_notify "All attempts to transfer a chunk of the encrypted dump failed. Aborting."
+      fi
+      if test "$(cat ${DUMPDIR}/stream.dump_status 2>/dev/null)" = '0'
+      then
+         grep '\-- Dump completed on ' ${DUMPDIR}/stream.dump_tail >/dev/null 2>&1 && { DUMPED='yes'; break; }
+      fi
+      log "Streamed dump attempt $((NUM + 1)) failed: $(cat ${DUMPDIR}/stream.err 2>/dev/null)"
+      NUM=$((NUM + 1))
+   done
+   # for security, delete the key regardless of outcome
+   rm -f ${KEYFILE}
+
+   test "${DUMPED}" || abort_and_notify "Failed to dump database"
+   PRECOMPRESS=$(stream_bytes dump)
+   log "MySQL dump complete"
+   log_event ${STAGE} SUCCESS "MySQL dump complete. Size: ${PRECOMPRESS}, Time: $((($(cat ${DUMPDIR}/stream.dump_end) - START) / 1000))s"
+
+   STAGE='AGENT_COMPRESS'
+   test "$(cat ${DUMPDIR}/stream.compress_status 2>/dev/null)" = '0' || abort_and_notify "Compression error"
+   POSTCOMPRESS=$(stream_bytes compress)
+   ELAPSED=$(($(cat ${DUMPDIR}/stream.compress_end) - START))
+   log "Compression complete. Original size: ${PRECOMPRESS}, Compressed size: ${POSTCOMPRESS}"
+   log_event ${STAGE} SUCCESS "Uncompressed size: ${PRECOMPRESS}, Compressed size: ${POSTCOMPRESS}, $(compress_stats ${PRECOMPRESS} ${POSTCOMPRESS} ${ELAPSED}), Time: $((ELAPSED / 1000))s"
+
+   STAGE='AGENT_ENCRYPT'
+   test "$(cat ${DUMPDIR}/stream.encrypt_status 2>/dev/null)" = '0' || abort_and_notify "Encryption error"
+   FILESIZE=${STREAMSIZE}
+   log "Dump file successfully encrypted. Size: ${FILESIZE}"
+   log_event ${STAGE} SUCCESS "Dump encrypted. Size: ${FILESIZE}, Time: $((($(cat ${DUMPDIR}/stream.encrypt_end) - START) / 1000))s"
+
+   # All chunks are on the server; tell it the final size so it can complete the upload
+   STAGE='AGENT_TRANSFER'
+   PUT /agent/${AGENTID}/transfer/${TRANSID} -q "filename=${FILENAME}" --data-binary '' \
+      -H "Content-Range: bytes */${FILESIZE}" >/dev/null 2>&1
+   test $? -eq 0 || abort_and_notify "Ganymede did not accept the streamed dump. Aborting."
+   log 'File transfer complete'
+   log_event ${STAGE} SUCCESS "Transfer complete. Time: $((($(date +%s%3N) - START) / 1000))s"
+}
+
+function end_transaction()
+{
+   # Tell Ganymede that we are done, clean up and exit
+   STAGE='AGENT_END'
+   log_event ${STAGE} SUCCESS "Processing complete"
+   flush_events
+   clean_up SUCCESS
+   exit 0
+}
+
 function encode_params()
 {
    local KEY
@@ -475,6 +886,7 @@ then
 fi
 
 validate_environment
+test "$(codec_ext)" != 'FAIL' || abort_local "Unknown CODEC: ${CODEC}"
 
 # We will accept an agent name on the command line
 if test "$1"
@@ -535,15 +947,30 @@ then
    abort_and_notify "Agent is disabled"
 fi
 
+###############################################################################
+# Streaming mode: DUMP, COMPRESS, ENCRYPT and TRANSFER run as a single pipeline
+
+if test "${TRANSFERMODE}" = 'stream' -a "${DUMPMODE}" != 'table'
+then
+   stream_transaction
+   end_transaction
+fi
+
 ###############################################################################
 # Stage: DUMP
 
 STAGE='AGENT_DUMP'
 
+START=$(date +%s%3N)
 if test $(verify_mysql) = "SUCCESS"
 then
    # dump the database
-   OUT=$(dump_mysql)
+   if test "${DUMPMODE}" = 'table'
+   then
+      OUT=$(dump_tables)
+   else
+      OUT=$(dump_mysql)
+   fi
 else
    abort_and_notify "Cannot access database server"
 fi
@@ -555,11 +982,10 @@ then
 else
    log "MySQL dump complete"
 fi
+DUMPTIME=$(($(date +%s%3N) - START))
 
 # Send notification to Ganymede
-TSTAMP=`date --utc "+${ISOFORMAT}"`
-PARMS=$(encode_params timestamp "${TSTAMP}" stage ${STAGE} status SUCCESS message 'MySQL dump complete')
-POST /agent/${AGENTID}/log/${TRANSID} "${PARMS}"
+log_event ${STAGE} SUCCESS 'MySQL dump complete'
 
 
 ###############################################################################
@@ -567,23 +993,38 @@ POST /agent/${AGENTID}/log/${TRANSID} "${PARMS}"
 
 STAGE='AGENT_COMPRESS'
 
-PRECOMPRESS=$(ls -l ${OUT} | awk '{print $5}')
-gzip ${OUT}
-if test $? -ne 0
+if test "${DUMPMODE}" = 'table'
 then
-   # Some processing error during compression
-   abort_and_notify "Compression error"
+   # The tables were compressed as they were dumped, so just bundle them into one archive for the transfer
+   PRECOMPRESS=$(table_bytes)
+   ELAPSED=${DUMPTIME}
+   DUMPFILE="${OUT}.tar"
+   tar -cf ${DUMPFILE} -C ${OUT} .
+   if test $? -ne 0
+   then
+      abort_and_notify "Error archiving table dumps"
+   fi
+   rm -rf ${OUT} ${DUMPDIR}/meta
+else
+   PRECOMPRESS=$(ls -l ${OUT} | awk '{print $5}')
+   DUMPFILE="${OUT}.$(codec_ext)"
+   START=$(date +%s%3N)
+   compress_stream < ${OUT} > ${DUMPFILE}
+   if test $? -ne 0
+   then
+      # Some processing error during compression
+      abort_and_notify "Compression error"
+   fi
+   ELAPSED=$(($(date +%s%3N) - START))
+   rm -f ${OUT}
 fi
 
-DUMPFILE="${OUT}.gz"
 POSTCOMPRESS=$(ls -l ${DUMPFILE} | awk '{print $5}')
 
 log "Compression complete. Original size: ${PRECOMPRESS}, Compressed size: ${POSTCOMPRESS}"
 
 # Send notification to Ganymede
-TSTAMP=`date --utc "+${ISOFORMAT}"`
-PARMS=$(encode_params timestamp "${TSTAMP}" stage ${STAGE} status SUCCESS message "Uncompressed size: ${PRECOMPRESS}, Compressed size: ${POSTCOMPRESS}")
-POST /agent/${AGENTID}/log/${TRANSID} "${PARMS}"
+log_event ${STAGE} SUCCESS "Uncompressed size: ${PRECOMPRESS}, Compressed size: ${POSTCOMPRESS}, $(compress_stats ${PRECOMPRESS} ${POSTCOMPRESS} ${ELAPSED})"
 
 
 ###############################################################################
@@ -605,10 +1046,9 @@ else
    log "Dump file successfully encrypted. Size: ${FILESIZE}"
 fi
 
-# Send notification to Ganymede
-TSTAMP=`date --utc "+${ISOFORMAT}"`
-PARMS=$(encode_params timestamp "${TSTAMP}" stage ${STAGE} status SUCCESS message "Dump encrypted and ready for transfer. Size: ${FILESIZE}")
-POST /agent/${AGENTID}/log/${TRANSID} "${PARMS}"
+# Send notification to Ganymede. The stage messages so far go out together before the (long) transfer starts.
+log_event ${STAGE} SUCCESS "Dump encrypted and ready for transfer. Size: ${FILESIZE}"
+flush_events
 
 ###############################################################################
 # Stage: TRANSFER
@@ -616,44 +1056,35 @@ POST /agent/${AGENTID}/log/${TRANSID} "${PARMS}"
 STAGE='AGENT_TRANSFER'
 
 FILENAME=$(basename ${OUT})
-# retry the transfer up to 4 times
+# Send the dump in chunks, starting from whatever Ganymede already has. Give up after 5 consecutive failures.
+OFFSET=$(transfer_status ${FILENAME})
 TRANS_COUNT=1
 MAX_RETRANS=6
-while test ${TRANS_COUNT} -lt ${MAX_RETRANS}
+while test ${OFFSET} -lt ${FILESIZE} -a ${TRANS_COUNT} -lt ${MAX_RETRANS}
 do
-   HTTPOUT=$(POST /agent/${AGENTID}/transfer/${TRANSID} -F "upload=@${OUT};filename=${FILENAME}" 2>&1)
-   if test -n "${HTTPOUT}"
+   NEXT=$(transfer_chunk ${OUT} ${OFFSET} ${FILESIZE})
+   if test "${NEXT}" = 'FAIL'
    then
-      log "Attempt ${TRANS_COUNT} to transfer encrypted dump failed: ${HTTPOUT}"
+      log "Attempt ${TRANS_COUNT} to transfer encrypted dump at offset ${OFFSET} failed"
       ((TRANS_COUNT = TRANS_COUNT + 1))
-      # pause for a few seconds
+      # pause for a few seconds, then resume from what Ganymede actually received
       sleep 5
+      OFFSET=$(transfer_status ${FILENAME})
    else
-      # successful transfer. set TRANS_COUNT to 10 (a value it could never reach unless this code is run
-      log "Successfully transferred encrypted dump file"
-      TRANS_COUNT=10
+      OFFSET=${NEXT}
+      TRANS_COUNT=1
    fi
 done
 
-if test ${TRANS_COUNT} -eq 10
+if test ${OFFSET} -ge ${FILESIZE}
 then
    log 'File transfer complete'
    # Send notification to Ganymede
-   TSTAMP=`date --utc "+${ISOFORMAT}"`
-   PARMS=$(encode_params timestamp "${TSTAMP}" stage ${STAGE} status SUCCESS message "Transfer complete")
-   POST /agent/${AGENTID}/log/${TRANSID} "${PARMS}"
+   log_event ${STAGE} SUCCESS "Transfer complete"
 else
    abort_and_notify "All attempts to transfer encrypted dump file failed. Aborting."
 fi
 ###############################################################################
 # Stage: END
 
-STAGE='AGENT_END'
-
-# Just tell Ganymede that we are done
-TSTAMP=`date --utc "+${ISOFORMAT}"`
-PARMS=$(encode_params timestamp "${TSTAMP}" stage ${STAGE} status SUCCESS message "Processing complete")
-POST /agent/${AGENTID}/log/${TRANSID} "${PARMS}"
-clean_up SUCCESS
-
-exit 0
+end_transaction
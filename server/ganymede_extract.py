@@ -0,0 +1,212 @@
+#!/usr/bin/env python -u
+
+from __future__ import print_function
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+from optparse import OptionParser
+from time import time
+import csv
+import gzip
+import io
+import json
+import os
+import os.path
+import sys
+
+from pymongo import MongoClient
+
+__author__ = 'jstoner'
+
+'''
+Exports the Leopard data set for one hour from MongoDB, for ganymede_extract_tool.sh.
+
+ganymede_extract_tool.sh runs mongoexport once per collection, one after another. This engine exports the
+collections concurrently (--jobs at a time) over one client: each query sends its projection to the server, reads
+large cursor batches and writes the rows straight into <name>.csv.gz in the output directory as they arrive. The
+CSV layout matches mongoexport's: a header of the projected fields, dotted paths into subdocuments, empty cells for
+missing fields.
+
+The collections, their file names and projections come from ganymede_extract_tool.sh, one --export option per
+collection (COLLECTION:NAME:FIELD,FIELD,...), so PROJECTIONS in the shell script stays the only list of fields. The
+aggregation collections named there (serverdisks<AGGID> and friends, or serverdisks_rollup and friends in
+incremental aggregation mode) must already exist; the shell script builds them before the export.
+
+Exits with status 0 when every collection was exported and 1 otherwise.
+'''
+
+
+def log(message):
+    """
+    :param message: message to print with a timestamp
+    """
+    print(datetime.utcnow().isoformat(' ') + ' : ' + message)
+
+
+def field_value(doc, path):
+    """
+    :param doc: document returned by the query
+    :param path: dotted field name
+    :return: the value at path, or None if it is missing
+    """
+    value = doc
+    for key in path.split('.'):
+        if isinstance(value, dict):
+            value = value.get(key)
+        elif isinstance(value, list) and key.isdigit() and int(key) < len(value):
+            value = value[int(key)]
+        else:
+            return None
+    return value
+
+
+def csv_cell(value):
+    """
+    :param value: field value
+    :return: the value formatted the way mongoexport writes it to CSV
+    """
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%dT%H:%M:%S.') + '{0:03d}Z'.format(value.microsecond // 1000)
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=str, separators=(',', ':'))
+    if sys.version_info[0] < 3 and isinstance(value, unicode):
+        # the Python 2 csv module writes bytes straight to the gzip file and cannot encode text itself
+        return value.encode('utf-8')
+    return value
+
+
+def parse_export(option):
+    """
+    :param option: value of an --export option: COLLECTION:NAME:FIELD,FIELD,...
+    :return: (collection, file name, list of fields), or None if the option is malformed
+    """
+    parts = option.split(':', 2)
+    if len(parts) != 3 or not all(parts):
+        return None
+    return parts[0], parts[1], parts[2].split(',')
+
+
+def export_collection(db, collection, name, fields, query, out_dir, batch_size):
+    """
+    Stream the query results of one collection into a compressed CSV file
+    :param db: pymongo Database object
+    :param collection: collection to query
+    :param name: file name without extension
+    :param fields: list of dotted field names to export
+    :param query: query document
+    :param out_dir: directory to write <name>.csv.gz to
+    :param batch_size: documents per cursor batch
+    :return: (name, rows, seconds, error message or None)
+    """
+    start = time()
+    rows = 0
+    path = os.path.join(out_dir, name + '.csv.gz')
+    projection = dict((field, 1) for field in fields)
+    projection['_id'] = 0
+    try:
+        with gzip.open(path, 'wb') as raw:
+            if sys.version_info[0] < 3:
+                out = raw
+            else:
+                out = io.TextIOWrapper(raw, encoding='utf-8', newline='')
+            writer = csv.writer(out)
+            writer.writerow(fields)
+            cursor = db[collection].find(query, projection, batch_size=batch_size)
+            for doc in cursor:
+                writer.writerow([csv_cell(field_value(doc, field)) for field in fields])
+                rows += 1
+            if out is not raw:
+                out.flush()
+                out.detach()
+    except Exception as err:
+        return name, rows, time() - start, str(err)
+    return name, rows, time() - start, None
+
+######
+# MAIN
+######
+if __name__ == '__main__':
+    jobs = 4  # default
+    batch_size = 5000  # default
+
+    parser = OptionParser()
+    parser.add_option('--host', dest='host', default=None, help='MongoDB host (default: mongo_host setting)')
+    parser.add_option('--db', dest='db', default='ganymede', help='Database name (default: ganymede)')
+    parser.add_option('-y', '--year', dest='year', type='int', help='Year of the report period')
+    parser.add_option('-m', '--month', dest='month', type='int', help='Month of the report period')
+    parser.add_option('-d', '--day', dest='day', type='int', help='Day of the report period')
+    parser.add_option('-H', '--hour', dest='hour', type='int', help='Hour of the report period')
+    parser.add_option('-e', '--export', dest='exports', action='append', default=[],
+                      help='Collection to export, its file name and fields: COLLECTION:NAME:FIELD,FIELD,... '
+                           '(repeat for every collection)')
+    parser.add_option('-o', '--out', dest='out', help='Directory to write the CSV files to')
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=None,
+                      help='Collections exported at once (default: extract_jobs setting or 4)')
+    (args, unused) = parser.parse_args()
+
+    exports = [parse_export(option) for option in args.exports]
+    if None in (args.year, args.month, args.day, args.hour) or not args.out or not exports or None in exports:
+        parser.print_help()
+        exit(1)
+
+    # Load settings
+    settings = {}
+    if os.path.exists('/etc/ganymede/ganymede.json'):
+        fp = open('/etc/ganymede/ganymede.json', 'r')
+        settings = json.load(fp)
+        fp.close()
+
+    # override defaults, if necessary
+    if settings.get('extract_jobs'):
+        if int(settings['extract_jobs']) > 0:
+            jobs = int(settings['extract_jobs'])
+        else:
+            print('Invalid "extract_jobs" setting. Using default value.')
+
+    if settings.get('extract_batch_size'):
+        if int(settings['extract_batch_size']) > 0:
+            batch_size = int(settings['extract_batch_size'])
+        else:
+            print('Invalid "extract_batch_size" setting. Using default value.')
+
+    if args.jobs:
+        jobs = args.jobs
+    mongo_host = args.host or settings.get('mongo_host')
+    if not mongo_host:
+        print('Cannot find the MongoDB host.')
+        exit(1)
+
+    period = {'report_period.year': args.year, 'report_period.month': args.month,
+              'report_period.day': args.day, 'report_period.hour': args.hour}
+    client = MongoClient(mongo_host if '://' in mongo_host else 'mongodb://' + mongo_host, maxPoolSize=jobs)
+    database = client[args.db]
+
+    tasks = []
+    for (coll, file_name, coll_fields) in exports:
+        tasks.append((database, coll, file_name, coll_fields, period, args.out, batch_size))
+
+    started = time()
+    pool = ThreadPool(max(jobs, 1))
+    failures = 0
+    total_rows = 0
+    # results arrive as each collection finishes, so the slowest collection does not hold up the log
+    for (file_name, row_count, seconds, error) in pool.imap_unordered(lambda t: export_collection(*t), tasks):
+        if error is not None:
+            failures += 1
+            log('Collection: ' + file_name + ' failed after ' + str(row_count) + ' rows: ' + error)
+            continue
+        total_rows += row_count
+        log('Collection: ' + file_name + ' -> ' + str(row_count) + ' rows in {0:.1f}s ({1:.0f} rows/s)'.format(
+            seconds, row_count / max(seconds, 0.001)))
+    pool.close()
+    pool.join()
+    client.close()
+
+    elapsed = time() - started
+    log('Exported ' + str(total_rows) + ' rows from ' + str(len(tasks) - failures) + ' of ' + str(len(tasks)) +
+        ' collections in {0:.1f}s'.format(elapsed))
+    if failures:
+        exit(1)
@@ -51,6 +51,10 @@ ARCHIVEDATE='%Y-%m-%d_%H'
 # The (partial) command to perform the export of data
 EXPORT='mongoexport'
 
+# EXTRACTOR:
+# The Python extract engine, used when ENGINE is 'python'
+EXTRACTOR='/usr/local/bin/ganymede_extract.py'
+
 # MONGOSHELL:
 # The MongoDB shell program
 MONGOSHELL='mongo'
@@ -60,7 +64,8 @@ MONGOSHELL='mongo'
 COLLECTIONS='geos ipblocks n1networks n2networks netdomains vendors organizations images imagedisks servers serverdisks servernics serversoftwarelabels'
 
 # PROJECTIONS[]:
-# The specific projections to use when extracting data
+# The specific projections to use when extracting data. Both engines use them; the 'python' engine gets them as
+# --export options.
 declare -A PROJECTIONS
 PROJECTIONS['geos']='geo,report_period.year,report_period.month,report_period.day,report_period.hour,report_period.yday,report_period.epoch,ganymede_doc_version,sites.mcp_id,sites.display_name,sites.type,sites.site_name'
 PROJECTIONS['ipblocks']='geo,report_period.year,report_period.month,report_period.day,report_period.hour,report_period.yday,report_period.epoch,ganymede_doc_version,general.block_type,general.subnet_size,general.state,general.in_maintenance,general.n1_network,general.n2_network'
@@ -95,6 +100,10 @@ QUERY=''
 # A projection is a list of all fields in documents to be returned when the QUERY is executed
 PROJECTION=''
 
+# EXPORTS:
+# The --export options for EXTRACTOR, one per collection: COLLECTION:COLLECTION_OUT:PROJECTION
+EXPORTS=''
+
 # OUTPUT:
 # This is the file to write the query results to
 OUTPUT=''
@@ -127,6 +136,22 @@ HOUR=''
 # This is the host/IP of the MongoDB server or mongos process to connect to
 MONGODB=''
 
+# ENGINE:
+# How to export the collections, from the extract_engine setting. 'mongoexport' runs EXPORT for one collection at a
+# time and archives plain CSV files. 'python' runs EXTRACTOR, which exports the collections concurrently into
+# gzipped CSV files, and archives those in an uncompressed tar.
+ENGINE='mongoexport'
+
+# AGGMODE:
+# How to build the unwound collections, from the aggregation_mode setting. 'rebuild' builds a set of collections for
+# this hour with build_aggregations.js and drops them afterwards. 'incremental' merges this hour into the persistent
+# *_rollup collections with merge_aggregations.js and prunes hours older than RETENTION with prune_aggregations.js.
+AGGMODE='rebuild'
+
+# RETENTION:
+# Hours the rollup collections keep in 'incremental' mode, from the aggregation_retention_hours setting
+RETENTION=168
+
 ###############################################################################
 # Functions
 
@@ -191,7 +216,7 @@ function clean_up()
    test "${DUMPDIR}" || return  # no DUMPDIR exists, nothing to do
    test -d "${DUMPDIR}" || return  # DUMPDIR is not a directory, nothing to do
    # Purge everything but the log file
-   rm -f ${DUMPDIR}/*csv
+   rm -f ${DUMPDIR}/*csv ${DUMPDIR}/*csv.gz
    rm -f ${DUMPDIR}/*js
    test "$1" = 'SUCCESS' && rm -f ${LOGFILE}
 }
@@ -222,9 +247,16 @@ function create_archive()
    local HERE=$PWD
    cd ${1}
    mkdir extract
-   cp *csv extract/
-
-   tar czf ${FILE} extract/*csv
+   if test "${ENGINE}" = 'python'
+   then
+      # the files are already compressed
+      FILE="extract_${TSTAMP}.tar"
+      cp *csv.gz extract/
+      tar cf ${FILE} extract/*csv.gz
+   else
+      cp *csv extract/
+      tar czf ${FILE} extract/*csv
+   fi
    if test $? -eq 0
    then
       RET="${1}/${FILE}"
@@ -242,9 +274,17 @@ function create_aggregation()
    # we need to do this so we can export the data properly as CSV
    # We use the 'build_aggregations.js' as a template and substitute $QUERY for the QUERY keyword
 
-   test -f /etc/ganymede/build_aggregations.js || abort_and_notify 'Unable to find the aggregation template'
-   sed -e "s/QUERY/${QUERY}/g" -e "s/AGGID/${AGG_ID}/g" /etc/ganymede/build_aggregations.js > ${DUMPDIR}/agg.js
-   sed -e "s/AGGID/${AGG_ID}/g" /etc/ganymede/clean_aggregations.js > ${DUMPDIR}/agg_clean.js
+   if test "${AGGMODE}" = 'incremental'
+   then
+      # Only this hour is unwound; the cleanup script prunes old hours instead of dropping the collections
+      test -f /etc/ganymede/merge_aggregations.js || abort_and_notify 'Unable to find the aggregation template'
+      sed -e "s/QUERY/${QUERY}/g" /etc/ganymede/merge_aggregations.js > ${DUMPDIR}/agg.js
+      sed -e "s/RETENTION/${RETENTION}/g" /etc/ganymede/prune_aggregations.js > ${DUMPDIR}/agg_clean.js
+   else
+      test -f /etc/ganymede/build_aggregations.js || abort_and_notify 'Unable to find the aggregation template'
+      sed -e "s/QUERY/${QUERY}/g" -e "s/AGGID/${AGG_ID}/g" /etc/ganymede/build_aggregations.js > ${DUMPDIR}/agg.js
+      sed -e "s/AGGID/${AGG_ID}/g" /etc/ganymede/clean_aggregations.js > ${DUMPDIR}/agg_clean.js
+   fi
 
    # Run the Javascript to build the collections
    test -s ${DUMPDIR}/agg.js || abort_and_notify 'Failed to generate aggregation build script'
@@ -297,6 +337,13 @@ fi
 # set up resty and get settings
 GANYMEDE=$(get_config_key ${GANYMEDESETTINGS} 'api_host')
 MONGODB=$(get_config_key ${GANYMEDESETTINGS} 'mongo_host')
+test "$(get_config_key ${GANYMEDESETTINGS} 'extract_engine')" = 'python' && ENGINE='python'
+test "$(get_config_key ${GANYMEDESETTINGS} 'aggregation_mode')" = 'incremental' && AGGMODE='incremental'
+OUT=$(get_config_key ${GANYMEDESETTINGS} 'aggregation_retention_hours')
+if test "${OUT}"
+then
+   test "${OUT}" -gt 0 2>/dev/null && RETENTION=${OUT} || log 'Invalid "aggregation_retention_hours" setting. Using default value.'
+fi
 
 # Parse command line args, if any, to see what time period to extract
 if test ${#} -eq 0
@@ -353,6 +400,8 @@ fi
 DATABASE='ganymede'
 QUERY="{\"report_period.hour\" : ${HOUR}, \"report_period.year\" : ${YEAR}, \"report_period.month\" : ${MONTH}, \"report_period.day\" : ${DAY}}"
 AGG_ID="${YEAR}${MONTH}${DAY}${HOUR}ex"
+# the rollup collections hold every hour; QUERY picks this one out of them
+test "${AGGMODE}" = 'incremental' && AGG_ID='_rollup'
 
 # Build our temporary collections using aggregations
 create_aggregation
@@ -387,6 +436,14 @@ do
          COLLECTION_OUT=${COLLECTION}
       ;;
    esac
+
+   if test "${ENGINE}" = 'python'
+   then
+      # exported below, all at once
+      EXPORTS="${EXPORTS} --export=${COLLECTION}:${COLLECTION_OUT}:${PROJECTION}"
+      continue
+   fi
+
    OUTPUT=$(${EXPORT} --host=${MONGODB} --db=${DATABASE} --type=csv --collection=${COLLECTION} --out=${DUMPDIR}/${COLLECTION_OUT}.csv --query="${QUERY}" --fields="${PROJECTION}" 2>&1)
    if test $? -eq 0
    then
@@ -397,6 +454,17 @@ do
 
 done
 
+if test "${ENGINE}" = 'python'
+then
+   # Export every collection at once (up to the extract_jobs setting); the engine logs each collection's row count
+   # and throughput
+   ${PYTHON} ${EXTRACTOR} --host=${MONGODB} --db=${DATABASE} --year=${YEAR} --month=${MONTH} --day=${DAY} --hour=${HOUR} --out=${DUMPDIR} ${EXPORTS} >> ${LOGFILE} 2>&1
+   if test $? -ne 0
+   then
+      abort_and_notify "Error exporting collections from database '${DATABASE}' on host '${MONGODB}'"
+   fi
+fi
+
 echo `date --utc` " : Export of data for hour ${HOUR} on day ${DAY} of month ${MONTH} of year ${YEAR} complete."
 
 # Clean up the aggregations
@@ -0,0 +1,221 @@
+from __future__ import print_function
+from collections import deque
+from contextlib import contextmanager
+from threading import Condition
+from time import time
+
+__author__ = 'jstoner'
+
+'''
+A small, driver-neutral pool of Ganymede database connections.
+
+Jupiter, the worker daemon and the agent API all use it. This file lives in server/, next to Jupiter;
+web/application/ganymede_pool.py is a symlink to it, so the API imports the same module in a checkout. Deploy it
+with each of them: copy it next to jupiter.py (e.g. /usr/local/bin) and next to agent_api.py, dereferencing the
+symlink when copying the web application (cp -L, rsync -L). The pool is given a function that opens a new
+connection, which keeps the choice of MySQL driver with the caller: the API uses MySQLdb dict cursors, Jupiter
+uses mysql.connector.
+
+* At most "max_size" connections exist at once. Callers wait up to "timeout" seconds for one to be returned.
+* Connections idle for longer than "max_idle" seconds are closed instead of reused.
+* Connections idle for longer than "ping_interval" seconds are pinged before being handed out. Dead ones are
+  discarded and replaced.
+* Every returned connection is rolled back, so an open transaction (and its REPEATABLE READ snapshot) never
+  leaks into the next checkout.
+'''
+
+
+class PoolExhausted(Exception):
+    """
+    Raised when no connection becomes available within the checkout timeout
+    """
+    pass
+
+
+class ConnectionPool(object):
+
+    def __init__(self, connect, max_size=10, max_idle=300, ping_interval=30, timeout=10):
+        """
+        :param connect: function taking no arguments that returns a new DB-API connection
+        :param max_size: maximum number of open connections
+        :param max_idle: seconds a connection may sit unused before it is closed
+        :param ping_interval: seconds a connection may sit unused before it is health checked on checkout
+        :param timeout: seconds to wait for a free connection before raising PoolExhausted
+        """
+        self.connect = connect
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.ping_interval = ping_interval
+        self.timeout = timeout
+        self.idle = deque()  # (connection, time it was returned), most recently used on the right
+        self.size = 0
+        self.lock = Condition()
+        self.counters = {
+            'created': 0,
+            'reused': 0,
+            'evicted': 0,
+            'failed_checks': 0,
+            'discarded': 0,
+            'waits': 0,
+            'timeouts': 0,
+        }
+
+    def _close(self, conn):
+        """
+        Close a connection, ignoring errors from connections that are already dead
+        :param conn: connection object
+        """
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _healthy(self, conn):
+        """
+        :param conn: connection object
+        :return: True if the server answers a ping
+        """
+        try:
+            conn.ping()
+        except Exception:
+            return False
+        return True
+
+    def evict_idle(self):
+        """
+        Close every idle connection that has been unused for longer than max_idle
+        :return: number of connections closed
+        """
+        stale = []
+        with self.lock:
+            cutoff = time() - self.max_idle
+            # the oldest connections are on the left
+            while self.idle and self.idle[0][1] < cutoff:
+                stale.append(self.idle.popleft()[0])
+            self.size -= len(stale)
+            self.counters['evicted'] += len(stale)
+            if stale:
+                self.lock.notify(len(stale))
+        for conn in stale:
+            self._close(conn)
+        return len(stale)
+
+    def acquire(self):
+        """
+        Check out a connection, opening a new one if the pool has room
+        :return: connection object
+        """
+        self.evict_idle()
+        deadline = time() + self.timeout
+        while True:
+            conn = None
+            returned = 0
+            with self.lock:
+                if self.idle:
+                    conn, returned = self.idle.pop()
+                elif self.size < self.max_size:
+                    # reserve the slot before connecting so other threads cannot overshoot max_size
+                    self.size += 1
+                else:
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        self.counters['timeouts'] += 1
+                        raise PoolExhausted('No database connection available after ' + str(self.timeout) + 's')
+                    self.counters['waits'] += 1
+                    self.lock.wait(remaining)
+                    continue
+
+            if conn is None:
+                try:
+                    conn = self.connect()
+                except Exception:
+                    self._discard_slot()
+                    raise
+                with self.lock:
+                    self.counters['created'] += 1
+                return conn
+
+            if time() - returned > self.ping_interval and not self._healthy(conn):
+                with self.lock:
+                    self.counters['failed_checks'] += 1
+                self._close(conn)
+                self._discard_slot()
+                continue
+
+            with self.lock:
+                self.counters['reused'] += 1
+            return conn
+
+    def _discard_slot(self):
+        """
+        Give up a connection slot and wake a waiting thread
+        """
+        with self.lock:
+            self.size -= 1
+            self.lock.notify()
+
+    def release(self, conn, discard=False):
+        """
+        Return a connection to the pool
+        :param conn: connection object from acquire
+        :param discard: close the connection instead of keeping it, e.g. after a connection error
+        """
+        if not discard and self.size > self.max_size:
+            # the pool was shrunk or closed while this connection was checked out
+            discard = True
+        if not discard:
+            try:
+                conn.rollback()
+            except Exception:
+                discard = True
+
+        if discard:
+            with self.lock:
+                self.counters['discarded'] += 1
+            self._close(conn)
+            self._discard_slot()
+            return
+
+        with self.lock:
+            self.idle.append((conn, time()))
+            self.lock.notify()
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager that checks out a connection and returns it afterwards. A connection that raised a
+        database error is discarded rather than returned.
+        """
+        conn = self.acquire()
+        try:
+            yield conn
+        except Exception:
+            self.release(conn, discard=not self._healthy(conn))
+            raise
+        else:
+            self.release(conn)
+
+    def stats(self):
+        """
+        :return: dict of pool metrics: configured size, current size, idle/in-use counts and lifetime counters
+        """
+        with self.lock:
+            stats = dict(self.counters)
+            stats['max_size'] = self.max_size
+            stats['size'] = self.size
+            stats['idle'] = len(self.idle)
+            stats['in_use'] = self.size - len(self.idle)
+        return stats
+
+    def close(self):
+        """
+        Close every idle connection. Connections still checked out are closed when they are released.
+        """
+        with self.lock:
+            conns = [c for (c, t) in self.idle]
+            self.idle.clear()
+            self.size -= len(conns)
+            self.max_size = 0
+            self.lock.notify_all()
+        for conn in conns:
+            self._close(conn)
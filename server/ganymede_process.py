@@ -0,0 +1,100 @@
+from __future__ import print_function
+from subprocess import Popen
+import errno
+import os
+import signal
+
+__author__ = 'jstoner'
+
+'''
+Starts and stops worker processes together with everything they run.
+
+A worker runs mysql, openssl and ganymede_worker_etl.py as child processes. Terminating only the worker leaves
+those running, and a retry of the same transaction would then drop and reload its schema while the old load or ETL
+is still writing. Each worker is therefore started as the leader of its own session and process group, and is
+stopped by signalling the whole group. A stopped worker is only finished with once no process of its group is
+left.
+
+Used by Jupiter and the worker daemon; install it next to them.
+'''
+
+
+def start_worker(command):
+    """
+    :param command: list containing the worker command and its arguments
+    :return: Popen object for the worker, which leads a new process group (its process group ID is its PID)
+    """
+    return Popen(command, preexec_fn=os.setsid)
+
+
+def signal_group(pgid, signum):
+    """
+    Send a signal to every process of a worker's process group
+    :param pgid: process group ID (the worker's PID)
+    :param signum: signal number
+    :return: True if the group still had processes to signal
+    """
+    try:
+        os.killpg(pgid, signum)
+    except OSError as err:
+        if err.errno == errno.ESRCH:
+            return False
+        raise
+    return True
+
+
+def group_alive(pgid):
+    """
+    :param pgid: process group ID (the worker's PID)
+    :return: True while any process of the group is still running, including children that outlived the worker
+    """
+    try:
+        os.killpg(pgid, 0)
+    except OSError as err:
+        # EPERM means the processes exist but belong to another user
+        return err.errno == errno.EPERM
+    return True
+
+
+class GroupStopper(object):
+    """
+    Stops worker process groups: SIGTERM first, then SIGKILL for groups still running after a grace period
+    """
+
+    def __init__(self, grace=30):
+        """
+        :param grace: seconds a group has to exit after SIGTERM before it is killed
+        """
+        self.grace = grace
+        self.deadlines = {}  # process group ID -> time after which the group is killed
+
+    def stop(self, pgid, now):
+        """
+        Ask a group to exit, and kill it if it is still running once the grace period is over. Call again until
+        done() returns True.
+        :param pgid: process group ID (the worker's PID)
+        :param now: current time, in seconds
+        """
+        deadline = self.deadlines.get(pgid)
+        if deadline is None:
+            self.deadlines[pgid] = now + self.grace
+            signal_group(pgid, signal.SIGTERM)
+        elif now >= deadline:
+            signal_group(pgid, signal.SIGKILL)
+
+    def stopping(self, pgid):
+        """
+        :param pgid: process group ID
+        :return: True if stop() was called for the group and it has not been forgotten yet
+        """
+        return pgid in self.deadlines
+
+    def done(self, pgid):
+        """
+        :param pgid: process group ID
+        :return: True once no process of the group is left; the group is then forgotten
+        """
+        if group_alive(pgid):
+            return False
+        self.deadlines.pop(pgid, None)
+        return True
@@ -0,0 +1,342 @@
+from __future__ import print_function
+from uuid import uuid4
+
+__author__ = 'jstoner'
+
+'''
+The Ganymede work queue: leases transactions to worker daemons on any number of hosts.
+
+Jupiter enqueues transactions, worker daemons (ganymede_worker_daemon.py) lease them, and the lease is what makes
+one daemon the only one working on a transaction:
+
+* claim() leases the oldest ready transactions. With "skip_locked" it uses SELECT ... FOR UPDATE SKIP LOCKED
+  (MySQL 8.0+), so concurrent daemons never wait on each other's rows. Without it, each claim is a single
+  UPDATE ... ORDER BY ... LIMIT, which older servers run just as safely but serialize.
+* Each lease carries a random token and an expiry time. A daemon extends it with heartbeat() while its worker runs,
+  and must present the token to finish it, so a lease that expired and was handed to another daemon cannot be
+  completed twice.
+* reclaim() returns expired leases to the queue, or fails them once they have used up max_attempts.
+* cancel() asks the daemon holding a lease to stop its worker. The daemon checks cancel_requested() with every
+  heartbeat and finishes the lease as a failed attempt once the worker is gone.
+* A failed attempt is queued again after retry_delay seconds, doubling with every attempt.
+* purge() deletes the transactions the queue finished with (DONE or FAILED) once they are older than the retention
+  period. Jupiter calls it when it starts.
+
+Times come from the database server (UTC_TIMESTAMP()), so clock skew between hosts does not matter. Every method
+takes an open DB-API connection (mysql.connector or MySQLdb) and commits its own work.
+'''
+
+QUEUED = 'QUEUED'
+LEASED = 'LEASED'
+DONE = 'DONE'
+FAILED = 'FAILED'
+
+
+def parse_flag(value):
+    """
+    :param value: boolean setting as found in the JSON settings file (true, 1, "true", "false", "0", ...)
+    :return: True or False, or None if the value is not a recognised boolean
+    """
+    if isinstance(value, bool):
+        return value
+    if str(value).strip().lower() in ('1', 'true', 'yes', 'on'):
+        return True
+    if str(value).strip().lower() in ('0', 'false', 'no', 'off'):
+        return False
+    return None
+
+
+class WorkQueue(object):
+
+    def __init__(self, max_attempts=2, retry_delay=30, lease_seconds=120, skip_locked=True):
+        """
+        :param max_attempts: number of times a transaction is leased before it is failed
+        :param retry_delay: seconds to wait before the first retry of a failed attempt
+        :param lease_seconds: seconds a lease lasts without a heartbeat
+        :param skip_locked: use SELECT ... FOR UPDATE SKIP LOCKED to claim work (requires MySQL 8.0)
+        """
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lease_seconds = lease_seconds
+        self.skip_locked = skip_locked
+
+    def enqueue(self, db, transids):
+        """
+        Add transactions to the queue. A transaction the queue already failed is queued again; one that is queued,
+        leased or done is left alone.
+        :param db: database connection object
+        :param transids: list of transaction IDs
+        :return: number of rows inserted or changed
+        """
+        if not transids:
+            return 0
+        sql = '''
+            insert into work_queue (transid, state, attempts, not_before, enqueued, updated)
+            values {0}
+            on duplicate key update
+                attempts = if(state = 'FAILED', 0, attempts),
+                not_before = if(state = 'FAILED', values(not_before), not_before),
+                updated = if(state = 'FAILED', values(updated), updated),
+                state = if(state = 'FAILED', 'QUEUED', state)
+            '''.format(', '.join(["(%s, 'QUEUED', 0, utc_timestamp(), utc_timestamp(), utc_timestamp())"] *
+                                 len(transids)))
+        cur = db.cursor()
+        cur.execute(sql, tuple(transids))
+        count = cur.rowcount
+        cur.close()
+        db.commit()
+        return count
+
+    def claim(self, db, owner, limit=1):
+        """
+        Lease up to limit of the oldest transactions that are ready to run
+        :param db: database connection object
+        :param owner: name of the claiming daemon (host:pid), for operators
+        :param limit: maximum number of transactions to lease
+        :return: list of (transaction ID, lease token, attempt number)
+        """
+        token = uuid4().hex
+        cur = db.cursor()
+        if self.skip_locked:
+            sql = '''
+                select transid
+                from work_queue
+                where state = 'QUEUED' and not_before <= utc_timestamp()
+                order by not_before, enqueued
+                limit %s
+                for update skip locked
+                '''
+            cur.execute(sql, (limit,))
+            transids = [row[0] for row in cur.fetchall()]
+            if not transids:
+                cur.close()
+                db.commit()
+                return []
+            sql = '''
+                update work_queue
+                set state = 'LEASED', lease_owner = %s, lease_token = %s,
+                    lease_expires = utc_timestamp() + interval %s second,
+                    attempts = attempts + 1, cancel_requested = 0, updated = utc_timestamp()
+                where transid in ({0})
+                '''.format(', '.join(['%s'] * len(transids)))
+            cur.execute(sql, (owner, token, self.lease_seconds) + tuple(transids))
+            # read the leases back by primary key
+            sql = 'select transid, lease_token, attempts from work_queue where transid in ({0}) and lease_token = %s'
+            cur.execute(sql.format(', '.join(['%s'] * len(transids))), tuple(transids) + (token,))
+        else:
+            sql = '''
+                update work_queue
+                set state = 'LEASED', lease_owner = %s, lease_token = %s,
+                    lease_expires = utc_timestamp() + interval %s second,
+                    attempts = attempts + 1, cancel_requested = 0, updated = utc_timestamp()
+                where state = 'QUEUED' and not_before <= utc_timestamp()
+                order by not_before, enqueued
+                limit %s
+                '''
+            cur.execute(sql, (owner, token, self.lease_seconds, limit))
+            # the UPDATE does not say which rows it leased, so find them by token (idx_work_queue_lease)
+            cur.execute('select transid, lease_token, attempts from work_queue where lease_token = %s', (token,))
+        leases = [(row[0], row[1], row[2]) for row in cur.fetchall()]
+        cur.close()
+        db.commit()
+        return leases
+
+    def heartbeat(self, db, transid, token):
+        """
+        Extend a lease by lease_seconds
+        :param db: database connection object
+        :param transid: transaction ID
+        :param token: lease token from claim
+        :return: True if the lease is still held, False if it expired and was reclaimed
+        """
+        # heartbeats always changes, so the row counts as affected even if lease_expires does not move
+        sql = '''
+            update work_queue
+            set lease_expires = utc_timestamp() + interval %s second, heartbeats = heartbeats + 1,
+                updated = utc_timestamp()
+            where transid = %s and lease_token = %s and state = 'LEASED'
+            '''
+        cur = db.cursor()
+        cur.execute(sql, (self.lease_seconds, transid, token))
+        held = cur.rowcount == 1
+        cur.close()
+        db.commit()
+        return held
+
+    def cancel(self, db, transid):
+        """
+        Ask the daemon holding a transaction's lease to stop its worker
+        :param db: database connection object
+        :param transid: transaction ID
+        :return: True if the transaction is leased and the request was recorded
+        """
+        sql = '''
+            update work_queue
+            set cancel_requested = 1, updated = utc_timestamp()
+            where transid = %s and state = 'LEASED'
+            '''
+        cur = db.cursor()
+        cur.execute(sql, (transid,))
+        cancelled = cur.rowcount == 1
+        cur.close()
+        db.commit()
+        return cancelled
+
+    def cancel_requested(self, db, transid, token):
+        """
+        :param db: database connection object
+        :param transid: transaction ID
+        :param token: lease token from claim
+        :return: True if cancel() was called for the lease
+        """
+        cur = db.cursor()
+        cur.execute('select cancel_requested from work_queue where transid = %s and lease_token = %s',
+                    (transid, token))
+        row = cur.fetchone()
+        cur.close()
+        db.commit()
+        return row is not None and bool(row[0])
+
+    def complete(self, db, transid, token, success):
+        """
+        Finish a lease. A failed attempt is queued again after an exponential back-off until the transaction has
+        been attempted max_attempts times.
+        :param db: database connection object
+        :param transid: transaction ID
+        :param token: lease token from claim
+        :param success: True if the worker succeeded
+        :return: the new state of the transaction, or None if the lease was no longer held
+        """
+        cur = db.cursor()
+        cur.execute('select attempts from work_queue where transid = %s and lease_token = %s and state = %s '
+                    'for update', (transid, token, LEASED))
+        row = cur.fetchone()
+        if row is None:
+            cur.close()
+            db.commit()
+            return None
+
+        state = self._next_state(success, row[0])
+        sql = '''
+            update work_queue
+            set state = %s, lease_owner = null, lease_token = null, lease_expires = null, cancel_requested = 0,
+                not_before = utc_timestamp() + interval %s second, updated = utc_timestamp()
+            where transid = %s
+            '''
+        cur.execute(sql, (state, self.backoff(row[0]), transid))
+        cur.close()
+        db.commit()
+        return state
+
+    def release(self, db, transid, token):
+        """
+        Give a lease back without counting the attempt, e.g. when a daemon shuts down
+        :param db: database connection object
+        :param transid: transaction ID
+        :param token: lease token from claim
+        :return: True if the lease was held
+        """
+        sql = '''
+            update work_queue
+            set state = 'QUEUED', attempts = greatest(attempts, 1) - 1, lease_owner = null, lease_token = null,
+                lease_expires = null, cancel_requested = 0, updated = utc_timestamp()
+            where transid = %s and lease_token = %s and state = 'LEASED'
+            '''
+        cur = db.cursor()
+        cur.execute(sql, (transid, token))
+        released = cur.rowcount == 1
+        cur.close()
+        db.commit()
+        return released
+
+    def reclaim(self, db):
+        """
+        Return expired leases to the queue. Any daemon (and Jupiter) may call this; the daemon that held the lease
+        is assumed to have died with its worker.
+        :param db: database connection object
+        :return: list of (transaction ID, owner, new state) for the leases reclaimed
+        """
+        cur = db.cursor()
+        cur.execute('''
+            select transid, lease_owner, attempts
+            from work_queue
+            where state = 'LEASED' and lease_expires < utc_timestamp()
+            for update
+            ''')
+        expired = cur.fetchall()
+        reclaimed = []
+        for (transid, owner, attempts) in expired:
+            state = self._next_state(False, attempts)
+            cur.execute('''
+                update work_queue
+                set state = %s, lease_owner = null, lease_token = null, lease_expires = null, cancel_requested = 0,
+                    not_before = utc_timestamp() + interval %s second, updated = utc_timestamp()
+                where transid = %s
+                ''', (state, self.backoff(attempts), transid))
+            reclaimed.append((transid, owner, state))
+        cur.close()
+        db.commit()
+        return reclaimed
+
+    def states(self, db, transids):
+        """
+        :param db: database connection object
+        :param transids: list of transaction IDs
+        :return: dict of transaction ID -> (state, attempts) for the transactions in the queue
+        """
+        if not transids:
+            return {}
+        sql = 'select transid, state, attempts from work_queue where transid in ({0})'.format(
+            ', '.join(['%s'] * len(transids)))
+        cur = db.cursor()
+        cur.execute(sql, tuple(transids))
+        states = dict((row[0], (row[1], row[2])) for row in cur.fetchall())
+        cur.close()
+        db.commit()
+        return states
+
+    def purge(self, db, days, batch=1000):
+        """
+        Delete the transactions the queue finished with more than days ago. A purged transaction is enqueued again
+        if Jupiter ever finds it without a worker, so days must cover Jupiter's lookback period.
+        :param db: database connection object
+        :param days: retention period of DONE and FAILED transactions, in days
+        :param batch: maximum number of rows deleted per transaction
+        :return: number of rows deleted
+        """
+        # small batches keep each delete from holding its locks for long while the daemons claim work
+        sql = '''
+            delete from work_queue
+            where state in ('DONE', 'FAILED') and updated < utc_timestamp() - interval %s day
+            limit %s
+            '''
+        cur = db.cursor()
+        purged = 0
+        while True:
+            cur.execute(sql, (days, batch))
+            count = cur.rowcount
+            db.commit()
+            purged += count
+            if count < batch:
+                break
+        cur.close()
+        return purged
+
+    def backoff(self, attempts):
+        """
+        :param attempts: attempts made so far
+        :return: seconds to wait before the next attempt
+        """
+        return self.retry_delay * 2 ** max(attempts - 1, 0)
+
+    def _next_state(self, success, attempts):
+        """
+        :param success: True if the attempt succeeded
+        :param attempts: attempts made so far, including this one
+        :return: state the transaction moves to when a lease ends
+        """
+        if success:
+            return DONE
+        if attempts >= self.max_attempts:
+            return FAILED
+        return QUEUED
@@ -0,0 +1,180 @@
+#!/bin/bash
+
+# ganymede_restore.sh
+#
+# Restores the Ganymede database from the dumps hourly_backup.sh archived: the most recent base snapshot at or
+# before the requested hour, followed by every incremental dump after it up to that hour, in order. Archived months
+# of the log are not part of the hourly dumps; restore their log_archive_* dumps (see log_archiver.py) separately.
+#
+# Usage: ganymede_restore.sh [-d directory] [-t YYYY-MM-DD_HH] [-s schema] [-n]
+#   -d  directory holding the dumps (default: the archive_dir setting). Dumps fetched back from S3 can be put
+#       in any directory and restored from there.
+#   -t  restore the state as of this hour (default: the latest dump)
+#   -s  schema to restore into (default: the db_schema setting). It is created if it does not exist.
+#   -n  only list the dumps that would be replayed
+#
+###############################################################################
+# Define variables
+
+# GANYMEDESETTINGS:
+# The JSON-formatted settings for all scripts
+GANYMEDESETTINGS='/etc/ganymede/ganymede.json'
+
+# PYTHON
+# Define the Python interpreter to use
+PYTHON='python'
+
+###############################################################################
+# Runtime variables. This are set during execution. Do NOT set these manually.
+
+# DUMPDIR:
+# The directory to read dumps from
+DUMPDIR=''
+
+# TARGET:
+# The hour to restore to, as in the dump file names (YYYY-MM-DD_HH)
+TARGET=''
+
+# DRYRUN:
+# Set to 'yes' to only list the dumps
+DRYRUN=''
+
+# BASE:
+# The base snapshot to start from
+BASE=''
+
+# INCREMENTS:
+# The incremental dumps to replay after BASE, oldest first
+declare -a INCREMENTS
+
+# LAST:
+# The most recent dump replayed
+LAST=''
+
+# GDBHOST:
+# The Ganymede database host
+GDBHOST=''
+
+# GDBUSER:
+# The user for accessing GDBHOST
+GDBUSER=''
+
+# GDBPASS:
+# The password for GDBUSER
+GDBPASS=''
+
+# GSCHEMA:
+# The schema to restore into
+GSCHEMA=''
+
+###############################################################################
+# Functions
+
+function get_config_key()
+{
+   # Parse JSON output for a specific key
+   test "$2" || { echo ''; return; }
+   local SETTINGS="$1"
+   local KEY="$2"
+   local OUT=''
+
+   test -s ${SETTINGS} || { echo ''; return; }
+   OUT=$(${PYTHON} -mjson.tool < ${SETTINGS} | grep "${KEY}" | sed -e 's/[",[:space:][:cntrl:]]//g' | cut -d: -f2-)
+   echo ${OUT}
+}
+
+function dump_hour()
+{
+   # Echo the YYYY-MM-DD_HH part of a dump file name
+   basename ${1} | sed -e 's/^ganymede_\([0-9-]*_[0-9]*\)\..*$/\1/'
+}
+
+function find_dumps()
+{
+   # Set BASE and INCREMENTS for the restore. File names sort by hour, so a plain sort puts them in order.
+   local DUMP
+   local HOUR
+   local COUNT=0
+
+   for DUMP in $(ls ${DUMPDIR}/ganymede_*.sql.gz 2>/dev/null | sort)
+   do
+      HOUR=$(dump_hour ${DUMP})
+      test "${TARGET}" && [[ "${HOUR}" > "${TARGET}" ]] && break
+      case "${DUMP}" in
+         *.inc.sql.gz)
+            test "${BASE}" || continue  # increments before the first base cannot be used
+            INCREMENTS[$COUNT]="${DUMP}"
+            ((COUNT=COUNT + 1))
+            ;;
+         *)
+            # a newer base replaces everything before it
+            BASE="${DUMP}"
+            INCREMENTS=()
+            COUNT=0
+            ;;
+      esac
+   done
+}
+
+function replay()
+{
+   # Load one dump into GSCHEMA
+   echo "$(date --utc '+%Y-%m-%d %H:%M:%S') Replaying $(basename ${1})"
+   gunzip -c ${1} | mysql -u"${GDBUSER}" -p"${GDBPASS}" -h"${GDBHOST}" ${GSCHEMA}
+   local -a STATUS=(${PIPESTATUS[@]})
+   test ${STATUS[0]} -eq 0 -a ${STATUS[1]} -eq 0
+}
+
+###############################################################################
+# MAIN
+
+GDBHOST=$(get_config_key ${GANYMEDESETTINGS} 'db_host')
+GDBUSER=$(get_config_key ${GANYMEDESETTINGS} 'db_user')
+GDBPASS=$(get_config_key ${GANYMEDESETTINGS} 'db_pass')
+GSCHEMA=$(get_config_key ${GANYMEDESETTINGS} 'db_schema')
+DUMPDIR=$(get_config_key ${GANYMEDESETTINGS} 'archive_dir')
+
+while getopts 'd:t:s:n' OPT
+do
+   case "${OPT}" in
+      d) DUMPDIR="${OPTARG}" ;;
+      t) TARGET="${OPTARG}" ;;
+      s) GSCHEMA="${OPTARG}" ;;
+      n) DRYRUN='yes' ;;
+      *) echo "Usage: $0 [-d directory] [-t YYYY-MM-DD_HH] [-s schema] [-n]"; exit 1 ;;
+   esac
+done
+
+test -d "${DUMPDIR}" || { echo "Dump directory ${DUMPDIR} does not exist"; exit 1; }
+if test "${TARGET}"
+then
+   echo "${TARGET}" | grep -E '^[0-9]{4}-[0-9]{2}-[0-9]{2}_[0-9]{2}$' >/dev/null || { echo "Invalid hour ${TARGET}"; exit 1; }
+fi
+
+find_dumps
+test "${BASE}" || { echo "No base snapshot found in ${DUMPDIR}"; exit 1; }
+
+echo "Base snapshot: $(basename ${BASE})"
+echo "Increments: ${#INCREMENTS[@]}"
+if test "${DRYRUN}" = 'yes'
+then
+   for DUMP in "${INCREMENTS[@]}"
+   do
+      echo "  $(basename ${DUMP})"
+   done
+   exit 0
+fi
+
+mysql -u"${GDBUSER}" -p"${GDBPASS}" -h"${GDBHOST}" -e "create schema if not exists ${GSCHEMA}" || { echo "Cannot create schema ${GSCHEMA}"; exit 1; }
+
+# The base recreates every table. Each increment recreates the small tables and adds its log rows with INSERT
+# IGNORE, so rows in the overlap between increments are skipped.
+replay ${BASE} || { echo "Failed to restore $(basename ${BASE})"; exit 1; }
+LAST=${BASE}
+for DUMP in "${INCREMENTS[@]}"
+do
+   replay ${DUMP} || { echo "Failed to restore $(basename ${DUMP})"; exit 1; }
+   LAST=${DUMP}
+done
+
+echo "$(date --utc '+%Y-%m-%d %H:%M:%S') Restored ${GSCHEMA} through $(dump_hour ${LAST})"
@@ -0,0 +1,318 @@
+#!/usr/bin/env python -u
+
+from __future__ import print_function
+from base64 import b64encode
+from datetime import datetime
+from hashlib import md5
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from optparse import OptionParser
+from threading import Semaphore
+from time import sleep
+import os
+import os.path
+import json
+import zlib
+
+import boto3
+from botocore.exceptions import BotoCoreError, ClientError
+
+__author__ = 'jstoner'
+
+'''
+Uploads a backup file to S3 storage as a multipart upload, for hourly_backup.sh.
+
+* With --compress the file is gzipped on the way: it is cut into --chunk-size MB chunks that are compressed in
+  parallel, each as its own gzip member. Concatenated gzip members are a valid gzip file, so gunzip (and
+  ganymede_restore.sh) read the result as usual. --output keeps a local copy of the compressed file.
+* The (compressed) data is gathered into parts of at least --part-size MB and uploaded --jobs at a time. A part that
+  fails is retried with back-off; the upload is only aborted when a part has failed --retries times.
+* Every part is sent with its MD5 so S3 rejects a part damaged in transit, and the ETag and size of the completed
+  object are checked against what was sent.
+
+The endpoint is any S3-compatible service, so it can be tested against a local stand-in (e.g. MinIO or
+moto_server) with --endpoint http://localhost:9000 (see s3_upload_harness.py).
+
+Credentials, in order:
+
+1. AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY in the environment. hourly_backup.sh sets them to the id and key
+   of its s3curl profile (S3PROFILE), so both uploaders write with the same account.
+2. The "s3_access_key" and "s3_secret_key" settings in ganymede.json, for running the uploader on its own.
+3. The other sources boto3 looks in, e.g. ~/.aws/credentials or an instance role.
+
+Prints the object's ETag and exits with status 0 on success; exits with status 1 on failure.
+'''
+
+MB = 1024 * 1024
+MIN_PART_SIZE = 5 * MB  # S3 minimum for every part but the last
+
+
+def log(message):
+    """
+    :param message: message to print with a timestamp
+    """
+    print(datetime.utcnow().isoformat(' ') + ' : ' + message)
+
+
+def gzip_member(data, level=6):
+    """
+    :param data: bytes to compress
+    :param level: compression level
+    :return: data as a complete gzip member
+    """
+    # 16 + MAX_WBITS writes a gzip header and trailer instead of a zlib one
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def read_chunks(path, chunk_size, window):
+    """
+    :param path: file to read
+    :param chunk_size: bytes per chunk
+    :param window: Semaphore limiting how many chunks are in memory; released by the consumer
+    :return: generator of chunks
+    """
+    with open(path, 'rb') as fp:
+        while True:
+            window.acquire()
+            data = fp.read(chunk_size)
+            if not data:
+                window.release()
+                return
+            yield data
+
+
+class MultipartUpload(object):
+    """
+    Uploads parts of one object concurrently, retrying each part on failure
+    """
+
+    def __init__(self, client, bucket, key, jobs, retries, retry_delay=5):
+        """
+        :param client: boto3 S3 client
+        :param bucket: bucket name
+        :param key: object key
+        :param jobs: number of parts uploaded at once
+        :param retries: attempts per part before the upload fails
+        :param retry_delay: seconds to wait before the first retry of a part, doubling each time
+        """
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.pool = ThreadPool(jobs)
+        # hold at most two parts per upload thread in memory
+        self.slots = Semaphore(jobs * 2)
+        self.results = []
+        self.digests = []
+        self.size = 0
+        self.completed = False
+        self.upload_id = client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+
+    def _upload_part(self, number, data, digest):
+        """
+        :return: (part number, ETag)
+        """
+        try:
+            attempt = 1
+            while True:
+                try:
+                    resp = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                                   PartNumber=number, Body=data,
+                                                   ContentMD5=b64encode(digest).decode('ascii'))
+                    return number, resp['ETag']
+                except (BotoCoreError, ClientError) as err:
+                    if attempt >= self.retries:
+                        raise
+                    delay = self.retry_delay * 2 ** (attempt - 1)
+                    log('Part ' + str(number) + ' of ' + self.key + ' failed (' + str(err) + '). Retrying in ' +
+                        str(delay) + 's')
+                    sleep(delay)
+                    attempt += 1
+        finally:
+            self.slots.release()
+
+    def add_part(self, data):
+        """
+        Queue a part for upload; blocks while too many parts are waiting
+        :param data: part contents
+        """
+        self.slots.acquire()
+        digest = md5(data).digest()
+        self.digests.append(digest)
+        self.size += len(data)
+        number = len(self.digests)
+        self.results.append(self.pool.apply_async(self._upload_part, (number, data, digest)))
+
+    def complete(self):
+        """
+        Wait for every part, complete the upload and verify the object
+        :return: ETag of the object
+        """
+        self.pool.close()
+        try:
+            parts = [result.get() for result in self.results]
+        finally:
+            self.pool.join()
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': [{'PartNumber': n, 'ETag': etag} for (n, etag) in parts]})
+        self.completed = True
+
+        # S3 gives a multipart object the MD5 of its parts' MD5s, followed by the number of parts
+        expected = '"' + md5(b''.join(self.digests)).hexdigest() + '-' + str(len(self.digests)) + '"'
+        head = self.client.head_object(Bucket=self.bucket, Key=self.key)
+        if head['ETag'] != expected or head['ContentLength'] != self.size:
+            # a damaged object must not pass for a good backup
+            self.client.delete_object(Bucket=self.bucket, Key=self.key)
+            raise ValueError('Uploaded object does not match: ETag ' + head['ETag'] + ' (expected ' + expected +
+                             '), ' + str(head['ContentLength']) + ' bytes (expected ' + str(self.size) + ')')
+        return head['ETag']
+
+    def abort(self):
+        """
+        Discard the parts uploaded so far
+        """
+        self.pool.terminate()
+        if self.completed:
+            # nothing left to abort; complete() removed an object that failed verification
+            return
+        try:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        except (BotoCoreError, ClientError) as err:
+            log('Failed to abort upload of ' + self.key + ': ' + str(err))
+
+
+def upload_file(client, bucket, key, path, compress, output, jobs, chunk_size, part_size, retries):
+    """
+    :param client: boto3 S3 client
+    :param bucket: bucket name
+    :param key: object key
+    :param path: file to upload
+    :param compress: gzip the file in parallel chunks on the way
+    :param output: also write the uploaded bytes to this file (None for no local copy)
+    :param jobs: number of threads for compression and for uploads
+    :param chunk_size: bytes compressed at a time by one thread
+    :param part_size: minimum part size in bytes
+    :param retries: attempts per part
+    :return: ETag of the uploaded object
+    """
+    upload = MultipartUpload(client, bucket, key, jobs, retries)
+    out = None
+    try:
+        if output:
+            out = open(output, 'wb')
+        window = Semaphore(jobs * 2)
+        if compress:
+            compress_pool = ThreadPool(jobs)
+            # zlib releases the GIL, so the threads compress in parallel; imap keeps the members in order
+            pieces = compress_pool.imap(gzip_member, read_chunks(path, chunk_size, window))
+        else:
+            compress_pool = None
+            pieces = read_chunks(path, part_size, window)
+
+        buf = []
+        buffered = 0
+        for piece in pieces:
+            window.release()
+            if out is not None:
+                out.write(piece)
+            buf.append(piece)
+            buffered += len(piece)
+            if buffered >= part_size:
+                upload.add_part(b''.join(buf))
+                buf = []
+                buffered = 0
+        if buf:
+            upload.add_part(b''.join(buf))
+        elif not upload.digests:
+            # an empty file is still uploaded, as one part
+            piece = gzip_member(b'') if compress else b''
+            if out is not None:
+                out.write(piece)
+            upload.add_part(piece)
+        if compress_pool is not None:
+            compress_pool.close()
+            compress_pool.join()
+        etag = upload.complete()
+    except Exception:
+        upload.abort()
+        if out is not None:
+            out.close()
+            os.remove(output)
+            out = None
+        raise
+    finally:
+        if out is not None:
+            out.close()
+    return etag
+
+######
+# MAIN
+######
+if __name__ == '__main__':
+    s3_opts = {}
+
+    parser = OptionParser(usage='%prog [options] bucket file')
+    parser.add_option('-e', '--endpoint', dest='endpoint', default=None, help='URL of the S3 service')
+    parser.add_option('-k', '--key', dest='key', default=None, help='Object key (default: the file name)')
+    parser.add_option('-z', '--compress', dest='compress', action='store_true', default=False,
+                      help='gzip the file in parallel chunks while uploading')
+    parser.add_option('-o', '--output', dest='output', default=None,
+                      help='Also write the uploaded (compressed) bytes to this file')
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=cpu_count(),
+                      help='Threads for compression and for part uploads (default: CPU count)')
+    parser.add_option('-c', '--chunk-size', dest='chunk_size', type='int', default=32,
+                      help='MB of the file each compression thread takes at a time (default: 32)')
+    parser.add_option('-p', '--part-size', dest='part_size', type='int', default=16,
+                      help='Minimum size of an uploaded part in MB, at least 5 (default: 16)')
+    parser.add_option('-r', '--retries', dest='retries', type='int', default=5,
+                      help='Attempts per part before giving up (default: 5)')
+    parser.add_option('-b', '--create-bucket', dest='create_bucket', action='store_true', default=False,
+                      help='Create the bucket if it does not exist')
+    parser.add_option('--insecure', dest='insecure', action='store_true', default=False,
+                      help='Do not verify the TLS certificate of the endpoint')
+    (args, params) = parser.parse_args()
+
+    if len(params) != 2:
+        parser.print_usage()
+        exit(1)
+    (bucket_name, file_path) = params
+    if not os.path.isfile(file_path):
+        log('File (' + file_path + ') is not accessible')
+        exit(1)
+
+    # Load settings
+    if os.path.exists('/etc/ganymede/ganymede.json'):
+        fp = open('/etc/ganymede/ganymede.json', 'r')
+        settings = json.load(fp)
+        fp.close()
+        # credentials passed in the environment (by hourly_backup.sh) win over the settings
+        if settings.get('s3_access_key') and settings.get('s3_secret_key') and \
+                not os.environ.get('AWS_ACCESS_KEY_ID'):
+            s3_opts['aws_access_key_id'] = settings['s3_access_key']
+            s3_opts['aws_secret_access_key'] = settings['s3_secret_key']
+
+    if args.endpoint:
+        s3_opts['endpoint_url'] = args.endpoint
+    if args.insecure:
+        s3_opts['verify'] = False
+    s3 = boto3.client('s3', **s3_opts)
+
+    object_key = args.key or os.path.basename(file_path)
+    try:
+        if args.create_bucket:
+            try:
+                s3.head_bucket(Bucket=bucket_name)
+            except ClientError:
+                s3.create_bucket(Bucket=bucket_name)
+                log('Created bucket ' + bucket_name)
+        object_etag = upload_file(s3, bucket_name, object_key, file_path, args.compress, args.output,
+                                  max(args.jobs, 1), max(args.chunk_size, 1) * MB,
+                                  max(args.part_size * MB, MIN_PART_SIZE), max(args.retries, 1))
+    except (BotoCoreError, ClientError, ValueError, IOError, OSError) as err:
+        log('Failed to store ' + file_path + ' to bucket ' + bucket_name + ': ' + str(err))
+        exit(1)
+
+    log('Stored ' + file_path + ' to ' + bucket_name + '/' + object_key + ' (ETag ' + object_etag + ')')
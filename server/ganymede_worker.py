@@ -0,0 +1,912 @@
+#!/usr/bin/env python -u
+
+from __future__ import print_function
+from base64 import b64decode
+from datetime import datetime
+from subprocess import Popen, PIPE
+from threading import Event, Thread, Semaphore, Lock
+from time import time
+import os
+import os.path
+import json
+import re
+import shutil
+import socket
+import sys
+import tarfile
+import tempfile
+import zlib
+
+try:
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
+    from urllib.parse import urlencode, urlparse
+except ImportError:
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
+    from urllib import urlencode
+    from urlparse import urlparse
+
+# optional: used instead of the zstd and lz4 programs when they are installed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+__author__ = 'jstoner'
+
+'''
+Ganymede Worker, in Python. A drop-in replacement for ganymede_worker.sh: Jupiter (or a worker daemon) runs it with
+a transaction ID, and it reports the same stages to the API:
+
+1. WORKER_INIT: validate the transaction and fetch its dump file and key
+2. WORKER_DECRYPT: decrypt the dump
+3. WORKER_DECOMPRESS: decompress the dump (gzip, zstd or lz4, or a tar archive of per-table dumps)
+4. WORKER_SCHEMA: create the schema for the transaction
+5. WORKER_LOAD: import the dump into the schema
+6. WORKER_ETL: run ganymede_worker_etl.py to move the data into MongoDB
+7. WORKER_END: drop the schema and clean up
+
+The shell worker forks python, grep, sed and cut to read each setting and curl, sed and perl for every API call.
+Here the settings are read once, the API calls share one keep-alive connection and decompression happens
+in-process. Decryption stays with openssl, whose "enc" key derivation depends on its version and must match the
+agent's, and MySQL imports still go through the mysql client, one process per dump or table.
+
+Set "jupiter_worker" to the path of this script to use it instead of ganymede_worker.sh.
+
+While a stage runs, the worker posts a heartbeat every "worker_heartbeat_seconds" (default 60, 0 to disable) as
+long as it is making progress: bytes fed to MySQL, files growing in the working directory or CPU used by the
+processes it started. Jupiter takes a worker that has done none of this for "jupiter_stall_minutes" to be stalled.
+
+With "worker_streaming" enabled, the dump is not written to the working directory at all: openssl's output is
+decompressed as it arrives and fed straight into the mysql client (a per-table archive is read as a tar stream, one
+table at a time). Decryption, decompression and loading overlap and scratch disk use drops to the log file. The
+schema is created before the pipeline starts, and WORKER_DECRYPT, WORKER_DECOMPRESS and WORKER_LOAD are reported
+together when it finishes, each with its byte count and time.
+'''
+
+SETTINGS_FILE = '/etc/ganymede/ganymede.json'
+ISOFORMAT = '%Y-%m-%dT%H:%M:%S'
+CHUNK_SIZE = 1024 * 1024
+
+
+class WorkerError(Exception):
+    """
+    Raised when a stage fails; the message is reported to Ganymede as a FATAL log entry
+    """
+    pass
+
+
+class GanymedeAPI(object):
+    """
+    Minimal client for the Ganymede API that keeps one connection open for every call a worker makes
+    """
+
+    def __init__(self, api_host, user_agent='ganymede_worker/0.2', timeout=180):
+        """
+        :param api_host: the "api_host" setting, with or without a scheme
+        :param user_agent: User-Agent header to send
+        :param timeout: seconds to wait for a connection or a response
+        """
+        if not re.match(r'^https?://', api_host):
+            api_host = 'http://' + api_host
+        url = urlparse(api_host)
+        self.scheme = url.scheme
+        self.netloc = url.netloc
+        self.base = url.path.rstrip('/') + '/api/v1'
+        self.user_agent = user_agent
+        self.timeout = timeout
+        self.conn = None
+
+    def _connect(self):
+        if self.scheme == 'https':
+            return HTTPSConnection(self.netloc, timeout=self.timeout)
+        return HTTPConnection(self.netloc, timeout=self.timeout)
+
+    def request(self, method, path, fields=None, document=None):
+        """
+        :param method: HTTP method
+        :param path: path below /api/v1
+        :param fields: dict of form fields to POST
+        :param document: object to POST as JSON, in place of form fields
+        :return: (HTTP status, decoded JSON body or None)
+        """
+        headers = {'User-Agent': self.user_agent, 'Connection': 'keep-alive'}
+        body = None
+        if fields is not None:
+            body = urlencode(fields)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        elif document is not None:
+            body = json.dumps(document)
+            headers['Content-Type'] = 'application/json'
+
+        # the server may have closed an idle keep-alive connection, so retry once on a fresh one
+        for attempt in (1, 2):
+            if self.conn is None:
+                self.conn = self._connect()
+            try:
+                self.conn.request(method, self.base + path, body, headers)
+                resp = self.conn.getresponse()
+                data = resp.read()
+                break
+            except (HTTPException, socket.error):
+                self.close()
+                if attempt == 2:
+                    raise
+        if resp.getheader('Connection', '').lower() == 'close':
+            self.close()
+
+        content = None
+        if data:
+            try:
+                content = json.loads(data.decode('utf-8'))
+            except ValueError:
+                content = {'status_message': data.decode('utf-8', 'replace')}
+        return resp.status, content
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+class Decompressor(object):
+    """
+    Incremental decompression for the codecs agents use, chosen by file extension
+    """
+
+    def __init__(self, filename):
+        """
+        :param filename: dump file name ending in .gz, .zst or .lz4; anything else is passed through
+        """
+        self.codec = filename.rsplit('.', 1)[-1]
+        self.proc = None
+        if self.codec == 'gz':
+            # 16 + MAX_WBITS: expect a gzip header; concatenated members are handled in feed()
+            self.engine = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.codec == 'lz4' and lz4 is not None:
+            self.engine = lz4.frame.LZ4FrameDecompressor()
+        else:
+            self.engine = None
+
+    def stream(self, source, chunk_size=CHUNK_SIZE):
+        """
+        :param source: file object holding compressed data
+        :param chunk_size: bytes to read at a time
+        :return: generator of decompressed chunks
+        """
+        if self.codec == 'zst' and zstandard is not None:
+            reader = zstandard.ZstdDecompressor().stream_reader(source, read_across_frames=True)
+            for chunk in iter(lambda: reader.read(chunk_size), b''):
+                yield chunk
+            return
+        if self.engine is None and self.codec in ('zst', 'lz4'):
+            # no Python module for this codec, fall back to its program
+            for chunk in self._stream_program(source, chunk_size):
+                yield chunk
+            return
+
+        while True:
+            data = source.read(chunk_size)
+            if not data:
+                break
+            if self.engine is None:
+                yield data
+                continue
+            for chunk in self.feed(data):
+                yield chunk
+        if self.engine is not None and not self.ended():
+            # a truncated dump must not load as if it were complete
+            raise WorkerError('Unexpected end of ' + self.codec + ' data')
+        if self.codec == 'gz':
+            tail = self.engine.flush()
+            if tail:
+                yield tail
+
+    def ended(self):
+        """
+        :return: True if the last gzip member or lz4 frame was read to its end
+        """
+        if hasattr(self.engine, 'eof'):
+            return self.engine.eof
+        # Python 2 zlib has no eof: a byte fed past the end of a complete member is left over as unused data
+        probe = self.engine.copy()
+        try:
+            probe.decompress(b'\0')
+        except zlib.error:
+            return False
+        return probe.unused_data == b'\0'
+
+    def feed(self, data):
+        """
+        :param data: compressed bytes
+        :return: list of decompressed chunks
+        """
+        out = []
+        while data:
+            if self.codec == 'lz4' and self.engine.eof:
+                self.engine = lz4.frame.LZ4FrameDecompressor()
+            out.append(self.engine.decompress(data))
+            data = b''
+            if self.codec == 'gz' and self.engine.unused_data:
+                # the next gzip member starts here
+                data = self.engine.unused_data
+                out.append(self.engine.flush())
+                self.engine = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            elif self.codec == 'lz4' and self.engine.eof and self.engine.unused_data:
+                data = self.engine.unused_data
+        return [chunk for chunk in out if chunk]
+
+    def _stream_program(self, source, chunk_size):
+        command = {'zst': ['zstd', '-dc', '-q'], 'lz4': ['lz4', '-dc', '-q']}[self.codec]
+        self.proc = Popen(command, stdin=PIPE, stdout=PIPE)
+        # the source may be another pipe or a tar member, so copy it in from a thread rather than pass a descriptor
+        feeder = Thread(target=self._feed_program, args=(source, chunk_size))
+        feeder.daemon = True
+        feeder.start()
+        while True:
+            chunk = self.proc.stdout.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+        self.proc.stdout.close()
+        feeder.join()
+        if self.proc.wait() != 0:
+            raise WorkerError(command[0] + ' exited with status ' + str(self.proc.returncode))
+
+    def _feed_program(self, source, chunk_size):
+        try:
+            for data in iter(lambda: source.read(chunk_size), b''):
+                self.proc.stdin.write(data)
+        except (IOError, OSError):
+            # the program exited early; stream() reports its status
+            pass
+        finally:
+            try:
+                self.proc.stdin.close()
+            except (IOError, OSError):
+                pass
+
+
+class StreamMeter(object):
+    """
+    Counts the bytes that pass through one step of the streaming pipeline and the time spent producing them
+    """
+
+    def __init__(self):
+        self.bytes = 0
+        self.seconds = 0.0
+        self.error = None
+
+    def reader(self, source):
+        """
+        :param source: file object
+        :return: file-like object that reads from source and counts what it returns
+        """
+        meter = self
+
+        class MeteredReader(object):
+            def read(self, size=-1):
+                start = time()
+                data = source.read(size)
+                meter.seconds += time() - start
+                meter.bytes += len(data)
+                return data
+
+        return MeteredReader()
+
+    def chunks(self, chunks):
+        """
+        :param chunks: iterable of byte strings
+        :return: generator yielding the same chunks; an exception is kept in error before it is raised again
+        """
+        chunks = iter(chunks)
+        while True:
+            start = time()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                self.seconds += time() - start
+                return
+            except Exception as err:
+                self.error = err
+                raise
+            self.seconds += time() - start
+            self.bytes += len(chunk)
+            yield chunk
+
+    def summary(self):
+        """
+        :return: the byte count and time, for a log message
+        """
+        return '{0} bytes in {1:.1f}s'.format(self.bytes, self.seconds)
+
+
+def group_cpu():
+    """
+    :return: CPU time, in clock ticks, used by the other processes of this process group: the processes the worker
+        started (it leads its own group, see ganymede_process.py). 0 where /proc is not available.
+    """
+    total = 0
+    try:
+        pids = os.listdir('/proc')
+    except OSError:
+        return total
+    for pid in pids:
+        if not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        try:
+            with open('/proc/' + pid + '/stat') as fp:
+                # the command name may contain spaces and parentheses; the fields after it do not
+                fields = fp.read().rsplit(')', 1)[1].split()
+        except (IOError, OSError, IndexError):
+            # the process exited while we looked
+            continue
+        if int(fields[2]) == os.getpgrp():
+            total += int(fields[11]) + int(fields[12])
+    return total
+
+
+class Heartbeat(Thread):
+    """
+    Posts a heartbeat for the transaction every interval in which the worker made progress, so Jupiter can tell a
+    long stage from a stalled worker
+    """
+
+    def __init__(self, worker, interval):
+        """
+        :param worker: Worker object
+        :param interval: seconds between checks for progress
+        """
+        Thread.__init__(self)
+        self.daemon = True
+        self.worker = worker
+        self.interval = interval
+        # its own connection: the worker's is in use by the stage that is running
+        self.api = GanymedeAPI(worker.settings['api_host'], timeout=30)
+        self.stopped = Event()
+
+    def run(self):
+        last = self.worker.progress()
+        while not self.stopped.wait(self.interval):
+            current = self.worker.progress()
+            if current == last:
+                # nothing moved: let Jupiter see the stall
+                continue
+            last = current
+            try:
+                code, content = self.api.request('POST', '/worker/heartbeat/' + self.worker.transid, {})
+            except (HTTPException, socket.error) as err:
+                code, content = None, str(err)
+            if code != 200:
+                self.worker.log('Unable to post a heartbeat: ' + str(content))
+        self.api.close()
+
+    def stop(self):
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+
+
+class Worker(object):
+    """
+    Processes one transaction, reporting each stage to Ganymede
+    """
+
+    def __init__(self, transid, settings, tmp_root='/var/tmp'):
+        """
+        :param transid: transaction ID
+        :param settings: dict loaded from ganymede.json
+        :param tmp_root: directory to create the working directory in
+        """
+        self.transid = transid
+        self.settings = settings
+        self.stage = 'WORKER_INIT'
+        self.mysql = settings.get('worker_mysql', '/usr/bin/mysql')
+        self.etl_script = '/usr/local/bin/ganymede_worker_etl.py'
+        self.load_jobs = 4  # default
+        if settings.get('worker_load_jobs'):
+            if int(settings['worker_load_jobs']) > 0:
+                self.load_jobs = int(settings['worker_load_jobs'])
+            else:
+                print('Invalid "worker_load_jobs" setting. Using default value.')
+        self.streaming = False  # default
+        if 'worker_streaming' in settings:
+            # JSON true or false; bool() would turn the string "false" into True
+            if str(settings['worker_streaming']).lower() in ('true', '1'):
+                self.streaming = True
+            elif str(settings['worker_streaming']).lower() not in ('false', '0'):
+                print('Invalid "worker_streaming" setting. Using default value.')
+        self.heartbeat_seconds = 60  # default
+        if 'worker_heartbeat_seconds' in settings:
+            # 0 disables the heartbeat
+            if int(settings['worker_heartbeat_seconds']) >= 0:
+                self.heartbeat_seconds = int(settings['worker_heartbeat_seconds'])
+            else:
+                print('Invalid "worker_heartbeat_seconds" setting. Using default value.')
+        self.api = GanymedeAPI(settings['api_host'])
+        self.schema = None
+        self.fed = 0  # bytes written to the mysql client
+        self.pending = []
+        self.log_lock = Lock()
+        self.dump_dir = tempfile.mkdtemp(prefix='ganymede_', dir=tmp_root)
+        fd, self.log_file = tempfile.mkstemp(prefix='log_', dir=self.dump_dir)
+        os.close(fd)
+
+    def log(self, message):
+        """
+        :param message: message to append to the worker's log file
+        """
+        with self.log_lock:
+            with open(self.log_file, 'a') as fp:
+                fp.write(datetime.utcnow().strftime(ISOFORMAT) + ' ' + message + '\n')
+
+    def progress(self):
+        """
+        :return: a value that changes while the worker makes progress: the bytes fed to MySQL, the size of the
+            working directory and the CPU time of the processes the worker started
+        """
+        size = 0
+        for (root, dirs, files) in os.walk(self.dump_dir):
+            for name in files:
+                try:
+                    size += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return self.fed, size, group_cpu()
+
+    def queue(self, status, message):
+        """
+        Hold a log entry for the current stage, to be posted with the next report
+        :param status: SUCCESS or FATAL
+        :param message: log message
+        """
+        self.pending.append({'transid': self.transid, 'timestamp': datetime.utcnow().strftime(ISOFORMAT),
+                             'stage': self.stage, 'status': status, 'message': message})
+
+    def report(self, status, message, **fields):
+        """
+        Post a log entry for the current stage, in one request with any entries queued before it. Ganymede ignores
+        an entry it already has, so the request is safe to send again when its response is lost.
+        :param status: SUCCESS or FATAL
+        :param message: log message
+        :param fields: extra entry fields, e.g. host and pid
+        """
+        self.queue(status, message)
+        self.pending[-1].update(fields)
+        events = self.pending
+        self.pending = []
+        stages = ', '.join([event['stage'] + ' ' + event['status'] for event in events])
+        try:
+            code, content = self.api.request('POST', '/worker/log/batch', document=events)
+        except (HTTPException, socket.error) as err:
+            self.log('Unable to post ' + stages + ': ' + str(err))
+            return False
+        if code == 207:
+            for rejected in content['rejected']:
+                event = events[rejected['index']]
+                self.log('Unable to post ' + event['stage'] + ' ' + event['status'] + ': ' +
+                         rejected['status_message'])
+            return False
+        if code != 201:
+            self.log('Unable to post ' + stages + ': ' + str(content))
+            return False
+        return True
+
+    def schema_action(self, action):
+        """
+        :param action: CREATE or DESTROY
+        :return: True if the API completed the action
+        """
+        code, content = self.api.request('POST', '/worker/' + self.transid, {'action': action})
+        return content is not None and 'schema action completed' in content.get('status_message', '')
+
+    def mysql_command(self):
+        """
+        :return: (command, environment) to run the mysql client against the transaction schema
+        """
+        command = [self.mysql, '-u' + self.settings['db_user'], '-h' + self.settings['db_host'], self.schema]
+        env = dict(os.environ)
+        # keep the password off the command line
+        env['MYSQL_PWD'] = self.settings['db_pass']
+        return command, env
+
+    def abort(self, message):
+        """
+        Report a FATAL error for the current stage, mail the log to the responsible person and clean up
+        :param message: what went wrong
+        """
+        self.log(message)
+        self.report('FATAL', message)
+        if self.settings.get('notify_email'):
+            with open(self.log_file) as fp:
+                log = fp.read()
+            body = 'ERROR\nTimestamp: {0}\nMessage: {1}\n\n===================== LOG =========================\n{2}'
+            mail = Popen(['mail', '-s', 'Ganymede: Worker', self.settings['notify_email']], stdin=PIPE)
+            mail.communicate(body.format(datetime.utcnow().strftime(ISOFORMAT), message, log).encode('utf-8'))
+        self.clean_up(False)
+
+    def clean_up(self, success):
+        """
+        Remove the working directory. After a failure the log file is kept for investigation.
+        :param success: True if the transaction was processed
+        """
+        self.api.close()
+        if success:
+            shutil.rmtree(self.dump_dir, ignore_errors=True)
+            return
+        for name in os.listdir(self.dump_dir):
+            path = os.path.join(self.dump_dir, name)
+            if path == self.log_file:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+
+    def initialize(self):
+        """
+        WORKER_INIT: check the transaction with the API and write its key to a file only we can read
+        :return: (path of the dump file, path of the key file)
+        """
+        try:
+            code, details = self.api.request('GET', '/worker/' + self.transid)
+        except (HTTPException, socket.error) as err:
+            raise WorkerError('Unable to contact Ganymede: ' + str(err))
+        if details is None:
+            raise WorkerError('No response from API or invalid transaction ID')
+        if 'nonce' not in details:
+            raise WorkerError('API returned an error: ' + json.dumps(details))
+        if not details.get('filename'):
+            raise WorkerError('No file associated with transaction ' + self.transid)
+
+        filename = os.path.join(self.settings['data_dir'], details['filename'])
+        if not os.path.isfile(filename) or os.path.getsize(filename) == 0:
+            raise WorkerError('Dump file does not exist, is unreadable or is zero-length (transaction: ' +
+                              self.transid + ')')
+
+        key_file = os.path.join(self.dump_dir, 'nonce.out')
+        fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(b64decode(details['nonce']))
+        if os.path.getsize(key_file) == 0:
+            raise WorkerError('Got empty key while processing transaction: ' + self.transid)
+        return filename, key_file
+
+    def decrypt(self, filename, key_file):
+        """
+        WORKER_DECRYPT: decrypt the dump into the working directory
+        :param filename: encrypted dump file
+        :param key_file: file holding the key; removed whatever the outcome
+        :return: path of the decrypted file
+        """
+        name = os.path.basename(filename)
+        if name.endswith('.encrypted'):
+            name = name[:-len('.encrypted')]
+        decrypted = os.path.join(self.dump_dir, name)
+        try:
+            with open(self.log_file, 'a') as err:
+                code = Popen(['openssl', 'enc', '-aes-256-cbc', '-d', '-salt', '-in', filename, '-out', decrypted,
+                              '-pass', 'file:' + key_file], stderr=err).wait()
+        finally:
+            os.remove(key_file)
+        if code != 0:
+            raise WorkerError('Could not decrypt file for transaction ' + self.transid)
+        return decrypted
+
+    def decompress(self, filename):
+        """
+        WORKER_DECOMPRESS: decompress the dump. A per-table dump is a tar archive of separately compressed tables,
+        which is only unpacked here; its tables are decompressed as they are loaded.
+        :param filename: decrypted dump file
+        :return: path of the SQL file, or of the directory holding the table dumps
+        """
+        if filename.endswith('.tar'):
+            table_dir = os.path.join(self.dump_dir, 'tables')
+            os.mkdir(table_dir)
+            try:
+                archive = tarfile.open(filename)
+                for member in archive.getmembers():
+                    # the agent writes flat archives; refuse anything that would land outside table_dir
+                    if not member.isfile() or os.path.basename(member.name) != member.name:
+                        raise WorkerError('Unexpected member ' + member.name + ' in per-table dump')
+                archive.extractall(table_dir)
+                archive.close()
+            except (tarfile.TarError, IOError, OSError) as err:
+                raise WorkerError('Error during file decompression (transaction ' + self.transid + '): ' + str(err))
+            os.remove(filename)
+            return table_dir
+
+        decompressor = Decompressor(filename)
+        if decompressor.codec not in ('gz', 'zst', 'lz4'):
+            return filename
+        plain = filename.rsplit('.', 1)[0]
+        try:
+            with open(filename, 'rb') as source:
+                with open(plain, 'wb') as out:
+                    for chunk in decompressor.stream(source):
+                        out.write(chunk)
+        except Exception as err:
+            # zlib, zstandard and lz4 each raise their own error types
+            raise WorkerError('Error during file decompression (transaction ' + self.transid + '): ' + str(err))
+        os.remove(filename)
+        return plain
+
+    def create_schema(self):
+        """
+        WORKER_SCHEMA: create the schema to load the dump into. A retry of a failed transaction starts from an
+        empty schema, so drop whatever an earlier attempt left behind first.
+        """
+        try:
+            self.schema_action('DESTROY')
+        except (HTTPException, socket.error):
+            pass
+        try:
+            created = self.schema_action('CREATE')
+        except (HTTPException, socket.error) as err:
+            raise WorkerError('Unknown error while creating schema for transaction ' + self.transid + ': ' + str(err))
+        if not created:
+            raise WorkerError('Failed to create schema for transaction ' + self.transid)
+        self.schema = 'G_' + self.transid.replace('-', '_')
+
+    def load_stream(self, chunks):
+        """
+        Feed SQL into the mysql client
+        :param chunks: iterable of SQL byte strings
+        :return: True if every chunk was written and the client succeeded
+        """
+        command, env = self.mysql_command()
+        with open(self.log_file, 'a') as err:
+            proc = Popen(command, stdin=PIPE, stderr=err, env=env)
+            try:
+                for chunk in chunks:
+                    proc.stdin.write(chunk)
+                    self.fed += len(chunk)
+                proc.stdin.close()
+            except Exception as load_error:
+                # either the client exited early (its own error is in the log) or the dump failed to decompress
+                self.log('Load interrupted: ' + str(load_error))
+                proc.kill()
+                proc.wait()
+                return False
+        return proc.wait() == 0
+
+    def load_table(self, path, failed, slots):
+        """
+        Decompress one table dump straight into the schema
+        :param path: table dump file
+        :param failed: list the table name is added to if it does not load
+        :param slots: semaphore released when the load finishes
+        """
+        try:
+            with open(path, 'rb') as source:
+                loaded = self.load_stream(Decompressor(path).stream(source))
+            if loaded:
+                os.remove(path)
+            else:
+                failed.append(re.sub(r'\.sql\..*$', '', os.path.basename(path)))
+        finally:
+            slots.release()
+
+    def load(self, path):
+        """
+        WORKER_LOAD: import the dump, or every table dump in a directory load_jobs at a time
+        :param path: SQL file or directory of table dumps
+        """
+        if not os.path.isdir(path):
+            with open(path, 'rb') as source:
+                if not self.load_stream(iter(lambda: source.read(CHUNK_SIZE), b'')):
+                    raise WorkerError('Failed to load dump for transaction ' + self.transid)
+            return
+
+        failed = []
+        slots = Semaphore(self.load_jobs)
+        threads = []
+        for name in sorted(os.listdir(path)):
+            if '.sql.' not in name:
+                continue
+            slots.acquire()
+            thread = Thread(target=self.load_table, args=(os.path.join(path, name), failed, slots))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if failed:
+            self.log('Failed to load tables: ' + ' '.join(sorted(failed)))
+            raise WorkerError('Failed to load dump for transaction ' + self.transid)
+
+    def stream_load(self, filename, key_file):
+        """
+        WORKER_DECRYPT, WORKER_DECOMPRESS and WORKER_LOAD as one pipeline: decrypt with openssl, decompress its
+        output as it arrives and feed the SQL straight into the schema. Nothing is written to the working directory.
+        :param filename: encrypted dump file
+        :param key_file: file holding the key; removed whatever the outcome
+        :return: (decrypted, decompressed, loaded) StreamMeter objects
+        """
+        name = os.path.basename(filename)
+        if name.endswith('.encrypted'):
+            name = name[:-len('.encrypted')]
+        decrypted = StreamMeter()
+        decompressed = StreamMeter()
+        loaded = StreamMeter()
+        start = time()
+        ok = False
+        finished = False  # True once the pipeline ran to the end without an exception
+        killed = False
+        try:
+            with open(self.log_file, 'a') as err:
+                decrypt = Popen(['openssl', 'enc', '-aes-256-cbc', '-d', '-salt', '-in', filename,
+                                 '-pass', 'file:' + key_file], stdout=PIPE, stderr=err)
+        except OSError as err:
+            os.remove(key_file)
+            self.stage = 'WORKER_DECRYPT'
+            raise WorkerError('Could not decrypt file for transaction ' + self.transid + ': ' + str(err))
+
+        try:
+            plain = decrypted.reader(decrypt.stdout)
+            if name.endswith('.tar'):
+                # tables arrive one after another, so they are loaded in archive order
+                archive = tarfile.open(fileobj=plain, mode='r|')
+                ok = True
+                for member in archive:
+                    if not member.isfile() or os.path.basename(member.name) != member.name:
+                        decompressed.error = WorkerError('Unexpected member ' + member.name + ' in per-table dump')
+                        ok = False
+                        break
+                    if '.sql.' not in member.name:
+                        continue
+                    source = archive.extractfile(member)
+                    if not self.load_stream(decompressed.chunks(Decompressor(member.name).stream(source))):
+                        self.log('Failed to load table ' + re.sub(r'\.sql\..*$', '', member.name))
+                        ok = False
+                        break
+                archive.close()
+            else:
+                ok = self.load_stream(decompressed.chunks(Decompressor(name).stream(plain)))
+            finished = True
+        except (tarfile.TarError, IOError, OSError) as err:
+            decompressed.error = err
+        finally:
+            # stop openssl if we gave up before reading all of its output
+            if decrypt.poll() is None and not (ok and finished):
+                decrypt.kill()
+                killed = True
+            decrypt.stdout.close()
+            decrypt.wait()
+            os.remove(key_file)
+
+        loaded.bytes = decompressed.bytes
+        loaded.seconds = time() - start
+        # the decompressor's time includes waiting for openssl
+        decompressed.seconds = max(decompressed.seconds - decrypted.seconds, 0.0)
+        if ok and decrypt.returncode == 0:
+            return decrypted, decompressed, loaded
+
+        # put the failure on the stage that caused it. openssl is only to blame if it failed on its own.
+        if decrypt.returncode != 0 and not killed:
+            self.stage = 'WORKER_DECRYPT'
+            raise WorkerError('Could not decrypt file for transaction ' + self.transid)
+        if decompressed.error is not None:
+            self.stage = 'WORKER_DECOMPRESS'
+            raise WorkerError('Error during file decompression (transaction ' + self.transid + '): ' +
+                              str(decompressed.error))
+        self.stage = 'WORKER_LOAD'
+        raise WorkerError('Failed to load dump for transaction ' + self.transid)
+
+    def etl(self):
+        """
+        WORKER_ETL: extract the data from MySQL, transform it and load it into MongoDB
+        """
+        if not os.path.isfile(self.etl_script):
+            raise WorkerError('Failed to ETL transaction ' + self.transid)
+        with open(self.log_file, 'a') as err:
+            code = Popen([sys.executable, '-u', self.etl_script, '--transactionid=' + self.transid],
+                         stdout=err, stderr=err).wait()
+        if code != 0:
+            raise WorkerError('Failed to ETL transaction ' + self.transid)
+
+    def file_stages(self, filename, key_file):
+        """
+        Decrypt, decompress and load one stage at a time through files in the working directory
+        :param filename: encrypted dump file
+        :param key_file: file holding the key
+        """
+        self.stage = 'WORKER_DECRYPT'
+        filename = self.decrypt(filename, key_file)
+        self.report('SUCCESS', 'Dumpfile decrypted')
+
+        self.stage = 'WORKER_DECOMPRESS'
+        codec = filename.rsplit('.', 1)[-1]
+        filename = self.decompress(filename)
+        self.report('SUCCESS', 'Dump file decompressed (' + codec + ')')
+
+        self.stage = 'WORKER_SCHEMA'
+        self.create_schema()
+        self.report('SUCCESS', 'Schema created')
+
+        self.stage = 'WORKER_LOAD'
+        self.load(filename)
+        self.report('SUCCESS', 'Transaction data loaded into MySQL')
+
+    def stream_stages(self, filename, key_file):
+        """
+        Create the schema, then decrypt, decompress and load in one pipeline
+        :param filename: encrypted dump file
+        :param key_file: file holding the key
+        """
+        self.stage = 'WORKER_SCHEMA'
+        self.create_schema()
+        self.report('SUCCESS', 'Schema created')
+
+        self.stage = 'WORKER_LOAD'
+        decrypted, decompressed, loaded = self.stream_load(filename, key_file)
+        codec = re.sub(r'\.encrypted$', '', filename).rsplit('.', 1)[-1]
+
+        # the three stages finished together, so they are posted together
+        self.stage = 'WORKER_DECRYPT'
+        self.queue('SUCCESS', 'Dumpfile decrypted (streamed: ' + decrypted.summary() + ')')
+        self.stage = 'WORKER_DECOMPRESS'
+        self.queue('SUCCESS', 'Dump file decompressed (' + codec + ', streamed: ' + decompressed.summary() + ')')
+        self.stage = 'WORKER_LOAD'
+        self.report('SUCCESS', 'Transaction data loaded into MySQL (streamed: ' + loaded.summary() + ')')
+
+    def run(self):
+        """
+        Process the transaction
+        :return: exit status: 0 on success, 1 on failure
+        """
+        heartbeat = Heartbeat(self, self.heartbeat_seconds)
+        try:
+            filename, key_file = self.initialize()
+            self.report('SUCCESS', 'Initialization complete', host=socket.gethostname(), pid=str(os.getpid()))
+            if self.heartbeat_seconds:
+                heartbeat.start()
+
+            if self.streaming:
+                self.stream_stages(filename, key_file)
+            else:
+                self.file_stages(filename, key_file)
+
+            self.stage = 'WORKER_ETL'
+            self.etl()
+            self.report('SUCCESS', 'Transaction ETL complete')
+
+            self.stage = 'WORKER_END'
+            try:
+                destroyed = self.schema_action('DESTROY')
+            except (HTTPException, socket.error) as err:
+                raise WorkerError('Unknown error while removing schema for transaction ' + self.transid + ': ' +
+                                  str(err))
+            if not destroyed:
+                raise WorkerError('Failed to remove schema for transaction ' + self.transid)
+            self.report('SUCCESS', 'Worker complete')
+        except WorkerError as err:
+            heartbeat.stop()
+            self.abort(str(err))
+            return 1
+        heartbeat.stop()
+        self.clean_up(True)
+        return 0
+
+######
+# MAIN
+######
+if __name__ == '__main__':
+    if len(sys.argv) != 2 or not re.match(r'^[a-zA-Z0-9-]+$', sys.argv[1]):
+        print('Usage: ' + sys.argv[0] + ' transaction-id')
+        exit(1)
+
+    if not os.path.exists(SETTINGS_FILE):
+        print('Cannot find configuration settings.')
+        exit(1)
+    with open(SETTINGS_FILE) as fp:
+        worker_settings = json.load(fp)
+
+    try:
+        worker = Worker(sys.argv[1], worker_settings)
+    except (IOError, OSError) as err:
+        print('Cannot create temporary directory for operations: ' + str(err))
+        exit(1)
+    exit(worker.run())
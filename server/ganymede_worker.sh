@@ -40,6 +40,10 @@ PYTHON='python'
 # The MySQL client to use
 MYSQL='/usr/bin/mysql'
 
+# PIGZ:
+# The pigz program, used instead of gunzip for gzip dumps when it is installed
+PIGZ='pigz'
+
 ###############################################################################
 # Runtime variables. This are set during execution. Do NOT set these manually.
 
@@ -63,6 +67,23 @@ FILENAME=''
 # File for hold temporary key
 KEYFILE=''
 
+# CODEC:
+# The compression codec the agent used, taken from the dump's file extension (gz, zst or lz4)
+CODEC=''
+
+# LOADJOBS:
+# The number of tables to load at once from a per-table dump (worker_load_jobs setting)
+LOADJOBS=4
+
+# HEARTBEAT:
+# Seconds between checks for progress during a stage (worker_heartbeat_seconds setting). While the worker makes
+# progress, each check posts a heartbeat so Jupiter does not take a long stage for a stall. 0 disables heartbeats.
+HEARTBEAT=60
+
+# HEARTBEATPID:
+# The background process posting heartbeats
+HEARTBEATPID=''
+
 # NONCE:
 # the key
 NONCE=''
@@ -158,6 +179,13 @@ function log()
 function clean_up()
 {
    # Clean up when appropriate
+   if test "${HEARTBEATPID}"
+   then
+      # its sleep first, which also ends its loop
+      pkill -P ${HEARTBEATPID} 2>/dev/null
+      kill ${HEARTBEATPID} 2>/dev/null
+      HEARTBEATPID=''
+   fi
    test "${DUMPDIR}" || return  # no DUMPDIR exists, nothing to do
    test -d "${DUMPDIR}" || return  # DUMPDIR is not a directory, nothing to do
    test "$1" = 'SUCCESS' && { rm -rf ${DUMPDIR}; return; }
@@ -165,7 +193,30 @@ function clean_up()
    for sdf in ${DUMPDIR}/*
    do
       test "${sdf}" = "${LOGFILE}" && continue
-      rm -f ${sdf}
+      rm -rf ${sdf}
+   done
+}
+
+function worker_progress()
+{
+   # Print something that changes while the worker makes progress: the CPU seconds used by the processes of its
+   # session and the size of the working directory. Workers are started as session leaders (see
+   # ganymede_process.py), so the session ID is this script's PID.
+   echo "$(ps --sid $$ -o times= | awk '{ s += $1 } END { print s }') $(du -sb ${DUMPDIR} | cut -f1)"
+}
+
+function heartbeat()
+{
+   # Runs in the background: every HEARTBEAT seconds, tell Ganymede the worker is still making progress, unless
+   # nothing moved since the last check
+   local LAST=$(worker_progress)
+   local NOW
+   while sleep ${HEARTBEAT} && kill -0 $$ 2>/dev/null
+   do
+      NOW=$(worker_progress)
+      test "${NOW}" = "${LAST}" && continue
+      LAST="${NOW}"
+      POST /worker/heartbeat/${TRANSID} </dev/null >/dev/null 2>&1
    done
 }
 
@@ -175,6 +226,91 @@ function load_dump()
    ${MYSQL} -u"${GDBUSER}" -p"${GDBPASS}" -h${GDBHOST} ${SCHEMA} < ${1} 2>${LOGFILE}
 }
 
+function decompress_stream()
+{
+   # Decompress a file to stdout, choosing the program by its codec extension
+   case "${1}" in
+      *.gz)
+         if ${PIGZ} --version >/dev/null 2>&1
+         then
+            ${PIGZ} -dc ${1}
+         else
+            gunzip -c ${1}
+         fi
+         ;;
+      *.zst)
+         zstd -dc -q ${1}
+         ;;
+      *.lz4)
+         lz4 -dc -q ${1}
+         ;;
+      *)
+         cat ${1}
+         ;;
+   esac
+}
+
+function unpack_tables()
+{
+   # Unpack the tar archive of a per-table dump
+   # Echoes the directory holding the table dumps, or FAIL
+   test "$1" || { echo 'FAIL'; return; }
+   local TABLEDIR="${DUMPDIR}/tables"
+   mkdir -p ${TABLEDIR} || { echo 'FAIL'; return; }
+   tar -xf ${1} -C ${TABLEDIR} 2>>${LOGFILE}
+   if test $? -eq 0
+   then
+      rm -f ${1}
+      echo ${TABLEDIR}
+   else
+      echo 'FAIL'
+   fi
+}
+
+function load_table()
+{
+   # Decompress one table dump straight into the schema
+   # Touches <member>.fail if the load does not succeed
+   local -a STATUS
+   decompress_stream ${1} 2>>${LOGFILE} | ${MYSQL} -u"${GDBUSER}" -p"${GDBPASS}" -h${GDBHOST} ${SCHEMA} 2>>${LOGFILE}
+   STATUS=(${PIPESTATUS[@]})
+   if test ${STATUS[0]} -eq 0 -a ${STATUS[1]} -eq 0
+   then
+      rm -f ${1}
+   else
+      touch ${1}.fail
+      return 1
+   fi
+}
+
+function load_tables()
+{
+   # Load every table dump in the directory passed as param 1, LOADJOBS at a time
+   # Returns non-zero if any table failed to load
+   local MEMBER
+   local -a PIDS
+
+   for MEMBER in ${1}/*.sql.*
+   do
+      test -f ${MEMBER} || continue
+      if test ${#PIDS[@]} -ge ${LOADJOBS}
+      then
+         # wait for the oldest load before starting another
+         wait ${PIDS[0]}
+         PIDS=("${PIDS[@]:1}")
+      fi
+      load_table ${MEMBER} &
+      PIDS+=($!)
+   done
+   wait
+
+   if ls ${1}/*.fail >/dev/null 2>&1
+   then
+      log "Failed to load tables: $(cd ${1} && ls *.fail | sed -e 's/\.sql\..*$//' | tr '\n' ' ')"
+      return 1
+   fi
+}
+
 function create_schema()
 {
    # Create a new schema
@@ -240,6 +376,44 @@ function decrypt_file()
    echo ${RET}
 }
 
+function decompress_file()
+{
+   # Decompress a dump in place, choosing the program by the extension the agent gave it for its codec
+   # Echoes the name of the decompressed file, or FAIL
+   test "$1" || { echo 'FAIL'; return; }
+   local NEWFILE
+   local RET=1
+
+   case "${1}" in
+      *.gz)
+         NEWFILE="${1%.gz}"
+         if ${PIGZ} --version >/dev/null 2>&1
+         then
+            ${PIGZ} -d ${1} 2>>${LOGFILE}
+         else
+            gunzip ${1} 2>>${LOGFILE}
+         fi
+         RET=$?
+         ;;
+      *.zst)
+         NEWFILE="${1%.zst}"
+         zstd -d -q --rm ${1} -o ${NEWFILE} 2>>${LOGFILE}
+         RET=$?
+         ;;
+      *.lz4)
+         NEWFILE="${1%.lz4}"
+         lz4 -d -q --rm ${1} ${NEWFILE} 2>>${LOGFILE}
+         RET=$?
+         ;;
+   esac
+   if test ${RET} -eq 0
+   then
+      echo ${NEWFILE}
+   else
+      echo 'FAIL'
+   fi
+}
+
 function parse_json()
 {
    # Parse JSON output for a specific key
@@ -421,6 +595,16 @@ GDBUSER=$(get_config_key ${GANYMEDESETTINGS} 'db_user')
 GDBPASS=$(get_config_key ${GANYMEDESETTINGS} 'db_pass')
 GSCHEMA=$(get_config_key ${GANYMEDESETTINGS} 'db_schema')
 UPLOADSDIR=$(get_config_key ${GANYMEDESETTINGS} 'data_dir')
+OUT=$(get_config_key ${GANYMEDESETTINGS} 'worker_load_jobs')
+if test "${OUT}"
+then
+   test "${OUT}" -gt 0 2>/dev/null && LOADJOBS=${OUT} || log 'Invalid "worker_load_jobs" setting. Using default value.'
+fi
+OUT=$(get_config_key ${GANYMEDESETTINGS} 'worker_heartbeat_seconds')
+if test "${OUT}"
+then
+   test "${OUT}" -ge 0 2>/dev/null && HEARTBEAT=${OUT} || log 'Invalid "worker_heartbeat_seconds" setting. Using default value.'
+fi
 resty "${GANYMEDE}/api/v1" --user-agent 'ganymede_worker/0.1' --connect-timeout 30 --max-time 180 2>/dev/null
 
 # Validate the TRANSID
@@ -480,7 +664,12 @@ fi
 
 # Stage complete
 TSTAMP=`date --utc "+${ISOFORMAT}"`
-POST /worker/log/${TRANSID} -d "timestamp=${TSTAMP}" -d "stage=${STAGE}" -d "status=SUCCESS" --data-urlencode "message=Initialization complete"
+POST /worker/log/${TRANSID} -d "timestamp=${TSTAMP}" -d "stage=${STAGE}" -d "status=SUCCESS" -d "host=$(hostname)" -d "pid=$$" --data-urlencode "message=Initialization complete"
+if test "${HEARTBEAT}" -gt 0
+then
+   heartbeat &
+   HEARTBEATPID=$!
+fi
    
 STAGE='WORKER_DECRYPT'
 
@@ -501,23 +690,32 @@ POST /worker/log/${TRANSID} -d "timestamp=${TSTAMP}" -d "stage=${STAGE}" -d "sta
 
 STAGE='WORKER_DECOMPRESS'
 
-# Next step is to decompress the file
-gunzip ${FILENAME}
-if test $? -eq 0
+# Next step is to decompress the file with whatever codec the agent used
+# A per-table dump is a tar archive of separately compressed tables, which are decompressed as they are loaded
+CODEC=${FILENAME##*.}
+if test "${CODEC}" = 'tar'
 then
-   # Chop off the .gz extension
-   FILENAME="${DUMPDIR}/$(basename ${FILENAME} .gz)"
+   OUT=$(unpack_tables ${FILENAME})
 else
+   OUT=$(decompress_file ${FILENAME})
+fi
+if test "${OUT}" = 'FAIL'
+then
    abort_and_notify "Error during file decompression (transaction ${TRANSID})"
+else
+   # the functions remove the extension, so use that
+   FILENAME=${OUT}
 fi
 
 # Stage complete
 TSTAMP=`date --utc "+${ISOFORMAT}"`
-POST /worker/log/${TRANSID} -d "timestamp=${TSTAMP}" -d "stage=${STAGE}" -d "status=SUCCESS" --data-urlencode "message=Dump file decompressed"
+POST /worker/log/${TRANSID} -d "timestamp=${TSTAMP}" -d "stage=${STAGE}" -d "status=SUCCESS" --data-urlencode "message=Dump file decompressed (${CODEC})"
 
 STAGE='WORKER_SCHEMA'
 
-# We have a decrypted/decompressed dump file, create a schema to load it into
+# We have a decrypted/decompressed dump file, create a schema to load it into. A retry of a failed transaction
+# starts from an empty schema, so drop whatever an earlier attempt left behind first.
+POST /worker/${TRANSID} -d "action=DESTROY" >/dev/null 2>&1
 OUT=$(POST /worker/${TRANSID} -d "action=CREATE")
 if test "${OUT}"
 then
@@ -539,7 +737,12 @@ POST /worker/log/${TRANSID} -d "timestamp=${TSTAMP}" -d "stage=${STAGE}" -d "sta
 STAGE='WORKER_LOAD'
 
 # With our new schema, load the data
-OUT=$(load_dump ${FILENAME})
+if test -d ${FILENAME}
+then
+   OUT=$(load_tables ${FILENAME})
+else
+   OUT=$(load_dump ${FILENAME})
+fi
 if test $? -ne 0
 then
    abort_and_notify "Failed to load dump for transaction ${TRANSID}"
@@ -0,0 +1,321 @@
+#!/usr/bin/env python -u
+
+from __future__ import print_function
+from datetime import datetime
+from multiprocessing import cpu_count
+from optparse import OptionParser
+from time import sleep, time
+import os
+import os.path
+import json
+import signal
+import socket
+
+import mysql.connector
+from mysql.connector import errorcode
+
+from ganymede_pool import ConnectionPool
+from ganymede_process import GroupStopper, start_worker
+from ganymede_queue import WorkQueue, parse_flag
+
+__author__ = 'jstoner'
+
+'''
+Runs Ganymede workers for transactions leased from the work queue (see ganymede_queue.py).
+
+Start one daemon on every worker host when "jupiter_dispatch" is set to "queue". Each daemon:
+
+1. reclaims expired leases, then leases as many ready transactions as it has free slots
+2. runs a worker (ganymede_worker.sh by default) for each lease
+3. heartbeats every running lease; if a lease was lost (e.g. the daemon was paused past its expiry and the
+   transaction handed to another host) or Jupiter asked for the worker to be stopped (it stalled), the worker is
+   stopped
+4. finishes each lease with the worker's result: the queue retries failed attempts with back-off
+
+Workers are stopped together with everything they started (see ganymede_process.py), and a lease is only finished
+once the worker's whole process group has exited.
+
+On SIGTERM or SIGINT the daemon stops leasing, stops its workers and gives their leases back.
+
+Several daemons may run on one host (each identifies itself as host:pid), which is also how to try it locally:
+start a few with "--slots 2" against one database, enqueue transactions and watch them share the work.
+'''
+
+stopping = False
+
+
+def request_stop(signum, frame):
+    """
+    Signal handler: finish the current loop, then shut down
+    """
+    global stopping
+    stopping = True
+
+
+def log(message):
+    """
+    :param message: message to print with a timestamp
+    """
+    print(datetime.utcnow().isoformat(' ') + ' : ' + message)
+
+
+class LeaseRunner(object):
+    """
+    Runs one worker process per lease and keeps the leases alive while they run
+    """
+
+    def __init__(self, queue, db_pool, command, slots, owner, heartbeat_interval):
+        """
+        :param queue: WorkQueue object
+        :param db_pool: ConnectionPool for the Ganymede database
+        :param command: list containing the worker command; the transaction ID is appended as the last argument
+        :param slots: maximum number of workers to run at once
+        :param owner: name recorded on the leases (host:pid)
+        :param heartbeat_interval: seconds between heartbeats of a running lease
+        """
+        self.queue = queue
+        self.db_pool = db_pool
+        self.command = command
+        self.slots = slots
+        self.owner = owner
+        self.heartbeat_interval = heartbeat_interval
+        self.running = {}  # transid -> (process, lease token, time of the last heartbeat)
+        self.lost = set()  # transactions whose lease was lost while their worker was being stopped
+        self.stopper = GroupStopper()
+
+    def fill(self):
+        """
+        Lease transactions for the free slots and start their workers
+        :return: number of workers started
+        """
+        free = self.slots - len(self.running)
+        if free <= 0:
+            return 0
+        with self.db_pool.connection() as cnx:
+            for (transid, owner, state) in self.queue.reclaim(cnx):
+                log('Reclaimed expired lease on ' + str(transid) + ' from ' + str(owner) + ': now ' + state)
+            leases = self.queue.claim(cnx, self.owner, free)
+        for (transid, token, attempt) in leases:
+            log('Leased transaction ' + str(transid) + ' (attempt ' + str(attempt) + ')')
+            self.running[transid] = (start_worker(self.command + [str(transid)]), token, time())
+        return len(leases)
+
+    def exited(self, transid, proc):
+        """
+        :param transid: transaction ID
+        :param proc: Popen object of the worker
+        :return: True once the worker and every process it started have exited. Processes the worker left
+            running are stopped, and groups that are being stopped are killed once their grace period is over.
+        """
+        code = proc.poll()
+        if code is None:
+            if self.stopper.stopping(proc.pid):
+                self.stopper.stop(proc.pid, time())
+            return False
+        if self.stopper.done(proc.pid):
+            return True
+        if not self.stopper.stopping(proc.pid):
+            log('Worker for transaction ' + str(transid) + ' exited with status ' + str(code) +
+                '. Stopping the processes it left running')
+        self.stopper.stop(proc.pid, time())
+        return False
+
+    def reap(self):
+        """
+        Finish the leases of workers that exited
+        :return: number of workers that finished
+        """
+        finished = 0
+        for transid, (proc, token, beat) in list(self.running.items()):
+            if not self.exited(transid, proc):
+                continue
+            code = proc.returncode
+            del self.running[transid]
+            finished += 1
+            if transid in self.lost:
+                # another daemon may hold the transaction now; the lease is not ours to finish
+                self.lost.discard(transid)
+                state = None
+            else:
+                with self.db_pool.connection() as cnx:
+                    state = self.queue.complete(cnx, transid, token, code == 0)
+            if state is None:
+                log('Worker for transaction ' + str(transid) + ' exited with status ' + str(code) +
+                    ' after its lease was lost')
+            else:
+                log('Worker for transaction ' + str(transid) + ' exited with status ' + str(code) + ': ' + state)
+        return finished
+
+    def heartbeat(self):
+        """
+        Extend the leases that are due a heartbeat, and stop the workers whose lease was lost or that Jupiter asked
+        to stop. reap() finishes their leases once they are gone.
+        """
+        now = time()
+        for transid, (proc, token, beat) in list(self.running.items()):
+            if transid in self.lost or now - beat < self.heartbeat_interval:
+                continue
+            with self.db_pool.connection() as cnx:
+                held = self.queue.heartbeat(cnx, transid, token)
+                cancelled = held and self.queue.cancel_requested(cnx, transid, token)
+            if not held:
+                log('Lost lease on transaction ' + str(transid) + '. Stopping its Worker')
+                self.lost.add(transid)
+                self.stopper.stop(proc.pid, now)
+                continue
+            # the lease is kept alive while a cancelled worker shuts down, so no other daemon starts it meanwhile
+            self.running[transid] = (proc, token, now)
+            if cancelled and not self.stopper.stopping(proc.pid):
+                log('Jupiter asked to stop the Worker for transaction ' + str(transid) + '. Stopping it')
+                self.stopper.stop(proc.pid, now)
+
+    def shutdown(self):
+        """
+        Stop every running worker and give its lease back once the worker and everything it started have exited
+        """
+        for transid, (proc, token, beat) in list(self.running.items()):
+            log('Stopping Worker for transaction ' + str(transid))
+            self.stopper.stop(proc.pid, time())
+        while self.running:
+            for transid, (proc, token, beat) in list(self.running.items()):
+                if not self.exited(transid, proc):
+                    continue
+                del self.running[transid]
+                if transid in self.lost:
+                    self.lost.discard(transid)
+                    continue
+                with self.db_pool.connection() as cnx:
+                    self.queue.release(cnx, transid, token)
+            if self.running:
+                sleep(1)
+
+######
+# MAIN
+######
+if __name__ == '__main__':
+    slots = cpu_count()  # default
+    poll_interval = 10  # default, seconds
+    lease_seconds = 120  # default
+    max_attempts = 2  # default
+    retry_delay = 30  # default, seconds
+    skip_locked = True  # default
+    worker_command = ['/usr/local/bin/ganymede_worker.sh']
+
+    parser = OptionParser()
+    parser.add_option('-s', '--slots', dest='slots', type='int', default=None,
+                      help='Number of workers to run at once (default: worker_daemon_slots setting or CPU count)')
+    parser.add_option('-c', '--command', dest='command', default=None,
+                      help='Worker program to run; the transaction ID is passed as its only argument '
+                           '(default: jupiter_worker setting or ganymede_worker.sh)')
+    (args, unused) = parser.parse_args()
+
+    # Load settings
+    if os.path.exists('/etc/ganymede/ganymede.json'):
+        fp = open('/etc/ganymede/ganymede.json', 'r')
+        settings = json.load(fp)
+        fp.close()
+    else:
+        print('Cannot find database configuration settings.')
+        exit(1)
+
+    ganymede_db_opts = {
+        'user': settings['db_user'],
+        'password': settings['db_pass'],
+        'host': settings['db_host'],
+        'database': settings['db_schema'],
+        'raise_on_warnings': True,
+        'time_zone': settings['db_timezone'],
+    }
+
+    # override defaults, if necessary
+    if settings.get('worker_daemon_slots'):
+        if int(settings['worker_daemon_slots']) > 0:
+            slots = int(settings['worker_daemon_slots'])
+        else:
+            print('Invalid "worker_daemon_slots" setting. Using default value.')
+
+    if settings.get('worker_daemon_poll'):
+        if int(settings['worker_daemon_poll']) > 0:
+            poll_interval = int(settings['worker_daemon_poll'])
+        else:
+            print('Invalid "worker_daemon_poll" setting. Using default value.')
+
+    if settings.get('queue_lease_seconds'):
+        if int(settings['queue_lease_seconds']) > 10:
+            lease_seconds = int(settings['queue_lease_seconds'])
+        else:
+            print('Invalid "queue_lease_seconds" setting. Using default value.')
+
+    if 'queue_skip_locked' in settings:
+        # MySQL before 8.0 has no SKIP LOCKED
+        if parse_flag(settings['queue_skip_locked']) is not None:
+            skip_locked = parse_flag(settings['queue_skip_locked'])
+        else:
+            print('Invalid "queue_skip_locked" setting. Using default value.')
+
+    # Retries follow the same policy whether Jupiter runs the workers itself or hands them to the queue
+    if settings.get('jupiter_max_attempts'):
+        if int(settings['jupiter_max_attempts']) > 0:
+            max_attempts = int(settings['jupiter_max_attempts'])
+        else:
+            print('Invalid "jupiter_max_attempts" setting. Using default value.')
+
+    if settings.get('jupiter_retry_delay'):
+        if int(settings['jupiter_retry_delay']) > 0:
+            retry_delay = int(settings['jupiter_retry_delay'])
+        else:
+            print('Invalid "jupiter_retry_delay" setting. Using default value.')
+
+    if settings.get('jupiter_worker'):
+        # the same worker Jupiter runs in "local" dispatch mode
+        worker_command = [settings['jupiter_worker']]
+
+    if args.slots:
+        slots = args.slots
+    if args.command:
+        worker_command = [args.command]
+
+    owner = socket.gethostname() + ':' + str(os.getpid())
+    queue = WorkQueue(max_attempts, retry_delay, lease_seconds, skip_locked)
+    db_pool = ConnectionPool(lambda: mysql.connector.connect(**ganymede_db_opts), max_size=1,
+                             max_idle=max(300, poll_interval * 2))
+    # heartbeat often enough that two missed heartbeats still leave the lease alive
+    runner = LeaseRunner(queue, db_pool, worker_command, slots, owner, max(1, lease_seconds // 3))
+
+    try:
+        with db_pool.connection() as cnx:
+            for (trans, lease_owner, lease_state) in queue.reclaim(cnx):
+                log('Reclaimed expired lease on ' + str(trans) + ' from ' + str(lease_owner) + ': now ' + lease_state)
+    except mysql.connector.Error as err:
+        if err.errno == errorcode.ER_ACCESS_DENIED_ERROR:
+            print('Incorrect Ganymede DB user name or password')
+            exit(1)
+        elif err.errno == errorcode.ER_BAD_DB_ERROR:
+            print('Ganymede Schema does not exist')
+            exit(1)
+        else:
+            print(err)
+            exit(1)
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    log('Worker daemon ' + owner + ' started with ' + str(slots) + ' slots')
+
+    while not stopping:
+        try:
+            runner.reap()
+            runner.heartbeat()
+            runner.fill()
+        except mysql.connector.Error as err:
+            # the database may be restarting; running workers carry on and their leases are renewed next time
+            log('Database error: ' + str(err))
+        # check back sooner while workers run, so heartbeats and finished workers are handled promptly
+        if runner.running:
+            sleep(min(poll_interval, runner.heartbeat_interval, 5))
+        else:
+            sleep(poll_interval)
+
+    runner.reap()
+    runner.shutdown()
+    db_pool.close()
+    log('Worker daemon ' + owner + ' stopped')
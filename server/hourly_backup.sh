@@ -4,6 +4,11 @@
 #
 # This script performs an hourly backup of the transactions that have taken place during that hour
 #
+# In "incremental" mode (backup_mode setting) the full dump is only taken once a day, at BASEHOUR, as a base
+# snapshot. Every other hour dumps the small tables in full but only the rows of the append-only INCTABLES added
+# since the last backup, tracked by their id in WATERMARKFILE. ganymede_restore.sh replays a base and the increments
+# that follow it.
+#
 ###############################################################################
 # Define variables
 
@@ -32,8 +37,28 @@ S3OPTS='--silent --insecure'
 GANYMEDESETTINGS='/etc/ganymede/ganymede.json'
 
 # GTABLES:
-# The tables to dump for Ganymede
-GTABLES='agent geo_config geo_release assignment log upload'
+# The tables to dump for Ganymede. Archived months of the log (log_archive_*) never change, so they are dumped
+# once by log_archiver.py instead of every hour.
+GTABLES='agent geo_config geo_release assignment log log_archive transaction_state work_queue upload schema_version'
+
+# INCTABLES:
+# The append-only tables (auto-increment id, never updated) that incremental backups dump by id range
+INCTABLES='log'
+
+# BACKUPMODE:
+# 'full' dumps every table every hour; 'incremental' takes a base snapshot at BASEHOUR and increments in between
+# (backup_mode setting)
+BACKUPMODE='full'
+
+# BASEHOUR:
+# The UTC hour (0-23) at which incremental mode takes its base snapshot (backup_base_hour setting)
+BASEHOUR=0
+
+# OVERLAP:
+# How many ids below the watermark each increment starts at. A row whose insert committed after a higher id was
+# already backed up is still caught; the overlap is harmless because increments are restored with INSERT IGNORE.
+# (backup_overlap setting)
+OVERLAP=1000
 
 # DUMPOPTS:
 # Options passed to mysqldump. Do NOT edit these unless you know what you are
@@ -70,6 +95,21 @@ S3CURL='/usr/local/bin/s3curl'
 # Define the Python interpreter to use
 PYTHON='python'
 
+# UPLOADER:
+# How backups are sent to S3 storage (backup_uploader setting): 's3curl' compresses with a single gzip and sends
+# each file as one PUT; 'multipart' runs S3UPLOAD, which compresses in parallel chunks and sends a multipart upload
+# with concurrent parts, per-part retries and a checksum check of the result. Both sign with the credentials of
+# S3PROFILE in the s3curl configuration.
+UPLOADER='s3curl'
+
+# S3UPLOAD:
+# The multipart uploader
+S3UPLOAD='/usr/local/bin/ganymede_s3_upload.py'
+
+# UPLOADJOBS:
+# Threads the multipart uploader uses for compression and for parts (backup_upload_jobs setting)
+UPLOADJOBS=4
+
 ###############################################################################
 # Runtime variables. This are set during execution. Do NOT set these manually.
 
@@ -89,6 +129,26 @@ MSG=''
 # For holding the path/filename of the MySQL dump
 MYSQLDUMP=''
 
+# BACKUPTYPE:
+# Whether this run takes a 'full' dump or an 'incremental' one
+BACKUPTYPE='full'
+
+# WATERMARKFILE:
+# Records the highest INCTABLES id backed up so far and the base snapshot it builds on. Kept in ARCHIVEDIR.
+WATERMARKFILE=''
+
+# WATERMARK:
+# The highest id backed up by the previous run
+WATERMARK=''
+
+# HIGHMARK:
+# The highest id at the start of this run's dump; becomes the new watermark once the dump is archived
+HIGHMARK=''
+
+# LOWMARK:
+# The id an incremental dump starts after: WATERMARK less OVERLAP
+LOWMARK=0
+
 # TSTAMPTEMPLATE:
 # The format string for generating a tstamp to use in MySQL queries. This is passed through the 'date' command.
 TSTAMPTEMPLATE='%Y-%m-%d %H'
@@ -242,20 +302,81 @@ function get_config_key()
    echo ${OUT}
 }
 
+function max_log_id()
+{
+   # Echo the highest id in the INCTABLES, or FAIL
+   local TABLE
+   local OUT
+   local MAX=0
+
+   for TABLE in ${INCTABLES}
+   do
+      OUT=$(mysql -u"${GDBUSER}" -p"${GDBPASS}" -h"${GDBHOST}" --skip-column-names -e "select coalesce(max(id), 0) from ${GSCHEMA}.${TABLE}" 2>>${LOGFILE})
+      test $? -eq 0 || { echo 'FAIL'; return; }
+      test "${OUT}" -gt ${MAX} 2>/dev/null && MAX=${OUT}
+   done
+   echo ${MAX}
+}
+
+function read_watermark()
+{
+   # Echo a value (log_id or base) from WATERMARKFILE, or nothing if there is none
+   test -s "${WATERMARKFILE}" || return
+   grep "^${1}=" ${WATERMARKFILE} | tail -1 | cut -d= -f2-
+}
+
+function write_watermark()
+{
+   # Record the id backed up by this run and the base snapshot it belongs to
+   # param 1: the id; param 2: the file name of the base snapshot
+   echo "log_id=${1}" > ${WATERMARKFILE}.new
+   echo "base=${2}" >> ${WATERMARKFILE}.new
+   mv ${WATERMARKFILE}.new ${WATERMARKFILE}
+}
+
+function full_tables()
+{
+   # Echo the tables in GTABLES that are not dumped by id range
+   local TABLE
+   local OUT=''
+
+   for TABLE in ${GTABLES}
+   do
+      [[ " ${INCTABLES} " == *" ${TABLE} "* ]] && continue
+      OUT="${OUT} ${TABLE}"
+   done
+   echo ${OUT}
+}
+
 function dump_mysql()
 {
    # Perform a dump of MySQL
+   # With two parameters, an id range (low, high], the dump is incremental: the INCTABLES rows in the range as
+   # INSERT IGNORE statements, without table definitions, and every other table in full.
    # Due to the nature of the Beast, we will make 3 attempts to dump MySQL, employing a back-off timing scheme.
    local NUM=0  # our current attempt
    local TRIES=3  # the number of times we will try
    local PAUSE=120  # seconds
    local TSBD=`date --utc "+ganymede_%Y-%m-%d_%H"`
    local DUMPFILE="${DUMPDIR}/${TSBD}"
+   local TABLES="${GTABLES}"
+   local RET
+   if test "$2"
+   then
+      DUMPFILE="${DUMPFILE}.inc"
+      TABLES=$(full_tables)
+   fi
    while test ${NUM} -lt ${TRIES}
    do
       test ${NUM} -eq 0 || { sleep $((NUM * PAUSE)); }
-      mysqldump -u"${GDBUSER}" -p"${GDBPASS}" -h"${GDBHOST}" ${DUMPOPTS} ${GSCHEMA} ${GTABLES} > ${DUMPFILE}.sql 2>${DUMPFILE}.err
-      if test $? -eq 0
+      mysqldump -u"${GDBUSER}" -p"${GDBPASS}" -h"${GDBHOST}" ${DUMPOPTS} ${GSCHEMA} ${TABLES} > ${DUMPFILE}.sql 2>${DUMPFILE}.err
+      RET=$?
+      if test ${RET} -eq 0 -a "$2"
+      then
+         mysqldump -u"${GDBUSER}" -p"${GDBPASS}" -h"${GDBHOST}" ${DUMPOPTS} --no-create-info --insert-ignore --where="id > ${1} and id <= ${2}" ${GSCHEMA} ${INCTABLES} >> ${DUMPFILE}.sql 2>>${DUMPFILE}.err
+         RET=$?
+      fi
+      if test ${RET} -eq 0
       then
          # Validate the dump by checking for a specific line that's only written on success
          tail -1 ${DUMPFILE}.sql | grep '\-- Dump completed on ' >/dev/null 2>&1
@@ -334,6 +455,37 @@ function get_archives()
    done
 }
 
+function s3curl_credentials()
+{
+   # Print the id and the key of S3PROFILE, one per line. s3curl reads .s3curl from its own directory, or else
+   # from the home directory, and evaluates it as Perl; read it the same way.
+   local CONFIG="$(dirname ${S3CURL})/.s3curl"
+   test -f "${CONFIG}" || CONFIG="${HOME}/.s3curl"
+   perl -e 'our %awsSecretAccessKeys; do $ARGV[0]; my $p = $awsSecretAccessKeys{$ARGV[1]} or exit 1;
+print "$p->{id}\n$p->{key}\n"' "${CONFIG}" ${S3PROFILE}
+}
+
+function upload_multipart()
+{
+   # Upload a file with S3UPLOAD, signed with the same credentials as s3curl. Extra parameters are passed on to it.
+   # param 1: bucket; param 2: file
+   local BUCKET=$1
+   local FILE=$2
+   shift 2
+   local S3INSECURE=''
+   local CREDENTIALS=''
+   echo "${S3OPTS}" | grep -- '--insecure' >/dev/null && S3INSECURE='--insecure'
+   CREDENTIALS=$(s3curl_credentials)
+   if test $? -ne 0 -o -z "${CREDENTIALS}"
+   then
+      log "Cannot read the credentials of s3curl profile '${S3PROFILE}'"
+      return 1
+   fi
+   # in the environment rather than on the command line, where ps would show them
+   AWS_ACCESS_KEY_ID=$(echo "${CREDENTIALS}" | sed -n 1p) AWS_SECRET_ACCESS_KEY=$(echo "${CREDENTIALS}" | sed -n 2p) \
+      ${PYTHON} ${S3UPLOAD} --endpoint ${S3ENDPOINT} --jobs ${UPLOADJOBS} ${S3INSECURE} "$@" ${BUCKET} ${FILE} >>${LOGFILE} 2>&1
+}
+
 function add_archive()
 {
    # we need a bucket name and a file to upload
@@ -350,7 +502,13 @@ function add_archive()
       return
    fi
 
-   OUT=$(${S3CURL} --id=${S3PROFILE} --put=${FILE} -- ${S3OPTS} ${S3ENDPOINT}/${BUCKET}/${KEY})
+   if test "${UPLOADER}" = 'multipart'
+   then
+      upload_multipart ${BUCKET} ${FILE} --key ${KEY}
+      test $? -eq 0 && OUT='' || OUT='Not Found'
+   else
+      OUT=$(${S3CURL} --id=${S3PROFILE} --put=${FILE} -- ${S3OPTS} ${S3ENDPOINT}/${BUCKET}/${KEY})
+   fi
    echo ${OUT} | grep 'Not Found' >/dev/null 2>/dev/null
    if test $? -eq 0
    then
@@ -393,50 +551,101 @@ GDBPASS=$(get_config_key ${GANYMEDESETTINGS} 'db_pass')
 GSCHEMA=$(get_config_key ${GANYMEDESETTINGS} 'db_schema')
 UPLOADSDIR=$(get_config_key ${GANYMEDESETTINGS} 'data_dir')
 ARCHIVEDIR=$(get_config_key ${GANYMEDESETTINGS} 'archive_dir')
+WATERMARKFILE="${ARCHIVEDIR}/ganymede_backup.watermark"
+OUT=$(get_config_key ${GANYMEDESETTINGS} 'backup_mode')
+if test "${OUT}"
+then
+   test "${OUT}" = 'full' -o "${OUT}" = 'incremental' && BACKUPMODE=${OUT} || log 'Invalid "backup_mode" setting. Using default value.'
+fi
+OUT=$(get_config_key ${GANYMEDESETTINGS} 'backup_base_hour')
+if test "${OUT}"
+then
+   test "${OUT}" -ge 0 -a "${OUT}" -le 23 2>/dev/null && BASEHOUR=${OUT} || log 'Invalid "backup_base_hour" setting. Using default value.'
+fi
+OUT=$(get_config_key ${GANYMEDESETTINGS} 'backup_uploader')
+if test "${OUT}"
+then
+   test "${OUT}" = 's3curl' -o "${OUT}" = 'multipart' && UPLOADER=${OUT} || log 'Invalid "backup_uploader" setting. Using default value.'
+fi
+OUT=$(get_config_key ${GANYMEDESETTINGS} 'backup_upload_jobs')
+if test "${OUT}"
+then
+   test "${OUT}" -gt 0 2>/dev/null && UPLOADJOBS=${OUT} || log 'Invalid "backup_upload_jobs" setting. Using default value.'
+fi
+OUT=$(get_config_key ${GANYMEDESETTINGS} 'backup_overlap')
+if test "${OUT}"
+then
+   test "${OUT}" -ge 0 2>/dev/null && OVERLAP=${OUT} || log 'Invalid "backup_overlap" setting. Using default value.'
+fi
 
 # Start by dumping the database
 MSG=$(verify_mysql)
-if test "${MSG}" = "SUCCESS"
+test "${MSG}" = "SUCCESS" || abort_and_notify "MySQL not available"
+
+# Everything up to HIGHMARK is in this run's dump; later rows go in the next increment
+HIGHMARK=$(max_log_id)
+test "${HIGHMARK}" = 'FAIL' && abort_and_notify "Failed to read the log watermark"
+
+# An incremental run needs a base to build on. Take a new one at BASEHOUR, when there is no watermark yet, or when
+# the ids went backwards (the tables were reloaded).
+if test "${BACKUPMODE}" = 'incremental'
 then
-   MSG=$(dump_mysql)
+   WATERMARK=$(read_watermark log_id)
+   if test "${WATERMARK}" -a "$(date --utc '+%-H')" -ne ${BASEHOUR} && test "${WATERMARK}" -le ${HIGHMARK} 2>/dev/null
+   then
+      BACKUPTYPE='incremental'
+   fi
+fi
+
+if test "${BACKUPTYPE}" = 'incremental'
+then
+   LOWMARK=$((WATERMARK - OVERLAP))
+   test ${LOWMARK} -lt 0 && LOWMARK=0
+   MSG=$(dump_mysql ${LOWMARK} ${HIGHMARK})
 else
-   abort_and_notify "MySQL not available"
+   MSG=$(dump_mysql)
 fi
 
 if test "${MSG}" = "FAIL"
 then
    abort_and_notify "Failed to dump MySQL"
 else
-   log "Successfully dumped Ganymede database"
+   log "Successfully dumped Ganymede database (${BACKUPTYPE}, ${INCTABLES} ids through ${HIGHMARK})"
 fi
 
 # At this point, we have a dump file. Let's compress it.
 MYSQLDUMP=${MSG}
-gzip ${MYSQLDUMP} >/dev/null 2>/dev/null
-if test $? -ne 0
+if test "${UPLOADER}" = 'multipart'
 then
-   abort_and_notify "Failed to compress the dump file: ${MYSQLDUMP}"
+   # the uploader compresses the dump in parallel while it uploads it and creates the bucket if needed
+   log "Successfully created Ganymede dump: ${MYSQLDUMP}"
 else
-   log "Successfully created Ganymede dump: ${MYSQLDUMP}.gz"
-fi
+   gzip ${MYSQLDUMP} >/dev/null 2>/dev/null
+   if test $? -ne 0
+   then
+      abort_and_notify "Failed to compress the dump file: ${MYSQLDUMP}"
+   else
+      log "Successfully created Ganymede dump: ${MYSQLDUMP}.gz"
+   fi
 
-# reset the filename
-MYSQLDUMP="${MYSQLDUMP}.gz"
+   # reset the filename
+   MYSQLDUMP="${MYSQLDUMP}.gz"
 
-# Next, we create a new bucket
-MSG=$(create_bucket ${S3BUCKET})
-if test "$MSG" = 'FAIL'
-then
-   abort_and_notify 'Failed to create bucket'
-fi
+   # Next, we create a new bucket
+   MSG=$(create_bucket ${S3BUCKET})
+   if test "$MSG" = 'FAIL'
+   then
+      abort_and_notify 'Failed to create bucket'
+   fi
 
-# Make sure the bucket exists
-MSG=$(verify_bucket ${S3BUCKET})
-if test $? -ne 0
-then
-   abort_and_notify "Failed to verify bucket creation"
-else
-   log "Verified bucket: ${S3BUCKET}"
+   # Make sure the bucket exists
+   MSG=$(verify_bucket ${S3BUCKET})
+   if test $? -ne 0
+   then
+      abort_and_notify "Failed to verify bucket creation"
+   else
+      log "Verified bucket: ${S3BUCKET}"
+   fi
 fi
 
 # Get our list of files
@@ -444,7 +653,21 @@ get_archives
 if test $? -eq 0
 then
    # Start the archive by pushing the database dump to S3 storage
-   MSG=$(add_archive ${S3BUCKET} ${MYSQLDUMP})
+   if test "${UPLOADER}" = 'multipart'
+   then
+      upload_multipart ${S3BUCKET} ${MYSQLDUMP} --create-bucket --compress --output ${MYSQLDUMP}.gz --key $(basename ${MYSQLDUMP}).gz
+      if test $? -eq 0
+      then
+         MSG=''
+         rm -f ${MYSQLDUMP}
+         MYSQLDUMP="${MYSQLDUMP}.gz"
+      else
+         # keep the uncompressed dump; clean_up leaves it for a manual upload
+         MSG='FAIL'
+      fi
+   else
+      MSG=$(add_archive ${S3BUCKET} ${MYSQLDUMP})
+   fi
    if test "$MSG" = 'FAIL'
    then
       # oops
@@ -452,6 +675,13 @@ then
    else
       log "Archived Ganymede dump"
       mv ${MYSQLDUMP} ${ARCHIVEDIR}/
+      # only move the watermark once the dump holding its rows is safely stored
+      if test "${BACKUPTYPE}" = 'incremental'
+      then
+         write_watermark ${HIGHMARK} "$(read_watermark base)"
+      else
+         write_watermark ${HIGHMARK} "$(basename ${MYSQLDUMP})"
+      fi
    fi
 
    # Now we push the archive files themselves
@@ -1,116 +1,178 @@
 #!/usr/bin/env python -u
 
 from __future__ import print_function
+from collections import deque
 from datetime import datetime, timedelta
+from multiprocessing import cpu_count
 from subprocess import Popen
 from string import Template
-from time import sleep
+from time import sleep, time
+import os
 import os.path
 import json
+import select
+import socket
 
 import mysql.connector
 from mysql.connector import errorcode
 
+from ganymede_pool import ConnectionPool
+from ganymede_process import GroupStopper, group_alive, start_worker
+from ganymede_queue import WorkQueue, DONE, FAILED, parse_flag
+
 __author__ = 'jstoner'
 
+# The queries of both scans. db/check_indexes.py imports them to make sure they are answered from an index.
+SCAN_TRANSACTION_STATE = '''
+    select transid, stage, status, agent_status, worker_status, greatest(updated, coalesce(progress, updated)),
+        worker_host, worker_pid, attempts
+    from transaction_state
+    where
+        started >= %s
+        and started <= %s
+    '''
+
+SCAN_BACKLOG = '''
+    select transid, stage, status, agent_status, worker_status, greatest(updated, coalesce(progress, updated)),
+        worker_host, worker_pid, attempts
+    from transaction_state
+    where
+        started >= %s
+        and started < %s
+        and agent_status = 'SUCCESS'
+        and not (stage = 'WORKER_END' and status = 'SUCCESS')
+    order by started
+    '''
 
-def completed_agent_transactions(db, trans_start, trans_end):
+
+def scan_transaction_state(db, trans_start, trans_end):
     """
     :param db: database object
     :param trans_start: start date for query (string)
     :param trans_end: end date for query (string)
-    :return: list of transaction IDs
+    :return: list of (transid, stage, status, agent_status, worker_status, updated, worker_host, worker_pid,
+        attempts) rows, where updated is the time of the latest log entry or worker heartbeat
 
-    This function finds all transactions where the agent has successfully completed it actions
+    This function fetches the current state of every transaction started during the period. The API keeps
+    transaction_state up to date with every log entry, so this is one index range over a handful of rows per GEO
+    instead of a scan of the log.
     """
-    sql = '''
-        select transid
-        from log
-        where
-            tstamp >= %s
-            and tstamp <= %s
-            and stage = 'AGENT_END'
-            and status = 'SUCCESS'
-        '''
-    trans_list = set()
     cur = db.cursor()
-    cur.execute(sql, (trans_start, trans_end))
-    running_transactions = cur.fetchall()
-    ts_now = datetime.utcnow().isoformat(' ')
-    if running_transactions is None or len(running_transactions) == 0:
-        print(ts_now + ' : No Agent transactions in progress')
-    else:
-        for transid in running_transactions:
-            print(ts_now + ' : Found Agent Transaction: ' + str(transid[0]))
-            trans_list.add(transid[0])
+    cur.execute(SCAN_TRANSACTION_STATE, (trans_start, trans_end))
+    rows = cur.fetchall()
     cur.close()
-    return trans_list
+    return rows
 
 
-def current_worker_transactions(db, trans_start, trans_end):
+def scan_backlog(db, backlog_start, backlog_end):
     """
     :param db: database object
-    :param trans_start: start date for query (string)
-    :param trans_end: end date for query (string)
-    :return: list of transaction IDs
+    :param backlog_start: earliest start time to look at (datetime)
+    :param backlog_end: end of the backlog period, exclusive (datetime); normally the start of the current hour
+    :return: list of rows in the same form as scan_transaction_state, oldest first
 
-    This function finds all transactions where a worker has been started
+    This function finds transactions from earlier hours whose agent finished but which no worker has completed,
+    e.g. because Jupiter was not running or the hour's run ended before their AGENT_END arrived.
     """
-    sql = '''
-        select transid
-        from log
-        where
-            tstamp >= %s
-            and tstamp <= %s
-            and stage = 'WORKER_INIT'
-            and status = 'SUCCESS'
-        '''
-    trans_list = set()
     cur = db.cursor()
-    cur.execute(sql, (trans_start, trans_end))
-    running_transactions = cur.fetchall()
-    ts_now = datetime.utcnow().isoformat(' ')
-    if running_transactions is None or len(running_transactions) == 0:
-        print(ts_now + ' : No Worker transactions in progress')
-    else:
-        for transid in running_transactions:
-            print(ts_now + ' : Found in-progress Worker Transaction: ' + str(transid[0]))
-            trans_list.add(transid[0])
+    cur.execute(SCAN_BACKLOG, (backlog_start, backlog_end))
+    rows = cur.fetchall()
     cur.close()
-    return trans_list
+    return rows
 
 
-def completed_worker_transactions(db, trans_start, trans_end):
+def track_transactions(rows, agent_trans, worker_trans, completed_trans):
     """
-    :param db: database object
-    :param trans_start: start date for query (string)
-    :param trans_end: end date for query (string)
-    :return: list of transaction IDs
+    :param rows: rows returned by scan_transaction_state
+    :param agent_trans: set of transactions where the agent has successfully completed its actions
+    :param worker_trans: set of transactions where a worker has been started
+    :param completed_trans: set of transactions where the worker has successfully completed its actions
+    :return: number of transactions added to the sets
 
-    This function finds all transactions where the worker has successfully completed its actions
+    This function folds the scanned transaction states into the in-memory transaction sets
     """
-    sql = '''
-        select transid
-        from log
-        where
-            tstamp >= %s
-            and tstamp <= %s
-            and stage = 'WORKER_END'
-            and status = 'SUCCESS'
-        '''
-    trans_list = set()
-    cur = db.cursor()
-    cur.execute(sql, (trans_start, trans_end))
-    running_transactions = cur.fetchall()
+    added = 0
     ts_now = datetime.utcnow().isoformat(' ')
-    if running_transactions is None or len(running_transactions) == 0:
-        print(ts_now + ' : No Worker transactions completed')
-    else:
-        for transid in running_transactions:
-            print(ts_now + ' : Found completed Worker Transaction: ' + str(transid[0]))
-            trans_list.add(transid[0])
-    cur.close()
-    return trans_list
+    for (transid, stage, status, agent_status, worker_status) in [row[:5] for row in rows]:
+        found = []
+        if agent_status == 'SUCCESS':
+            found.append((agent_trans, 'Found Agent Transaction'))
+        if worker_status == 'SUCCESS':
+            found.append((worker_trans, 'Found in-progress Worker Transaction'))
+        if stage == 'WORKER_END' and status == 'SUCCESS':
+            found.append((completed_trans, 'Found completed Worker Transaction'))
+        for (trans_set, label) in found:
+            if transid in trans_set:
+                # already seen on an earlier scan
+                continue
+            print(ts_now + ' : ' + label + ': ' + str(transid))
+            trans_set.add(transid)
+            added += 1
+    return added
+
+
+def failed_workers(rows, stall_deadline):
+    """
+    :param rows: rows returned by scan_transaction_state
+    :param stall_deadline: datetime; a worker that has made no progress since then is considered stalled
+    :return: list of (transid, reason, attempts, stalled, worker_host, worker_pid) for the workers that logged a
+        FATAL error or stalled
+
+    A FATAL at WORKER_END is not included: the data has already been loaded, only the clean up failed.
+    """
+    failed = []
+    for (transid, stage, status, agent_status, worker_status, updated, host, pid, attempts) in rows:
+        if not stage.startswith('WORKER_') or stage == 'WORKER_END':
+            continue
+        if status == 'FATAL':
+            failed.append((transid, 'logged a FATAL error at ' + stage, attempts, False, host, pid))
+        elif updated < stall_deadline:
+            failed.append((transid, 'has made no progress since ' + updated.isoformat(' ') + ' (' + stage + ')',
+                           attempts, True, host, pid))
+    return failed
+
+
+def worker_alive(host, pid):
+    """
+    :param host: host name the worker reported
+    :param pid: process ID the worker reported
+    :return: True if the worker process, or any process it started, is still running on this host
+    """
+    if not pid or host != socket.gethostname():
+        return False
+    # workers lead their own process group, so their children are found even after the worker itself exited
+    if group_alive(pid):
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def retry_failed(pool, rows, stall_deadline):
+    """
+    Queue another attempt for the workers that logged a FATAL error or stopped making progress. Workers in the
+    pool are stopped and retried through reap(); workers started by an earlier run are retried once their process
+    is gone.
+    :param pool: WorkerPool object
+    :param rows: rows returned by scan_transaction_state or scan_backlog
+    :param stall_deadline: datetime; a worker that has made no progress since then is considered stalled
+    :return: list of transaction IDs queued for another attempt
+    """
+    queued = []
+    for (transid, reason, attempts, stalled, host, pid) in failed_workers(rows, stall_deadline):
+        if transid in pool.running:
+            if stalled:
+                pool.stop(transid, reason)
+            continue
+        if transid in pool.pending or transid in pool.failed or transid in pool.succeeded:
+            continue
+        if stalled and worker_alive(host, pid):
+            continue
+        if pool.retry(transid, reason, attempts):
+            queued.append(transid)
+    return queued
 
 
 def active_geos(db):
@@ -139,6 +201,321 @@ def active_geos(db):
     cur.close()
     return geo_list
 
+
+def open_event_socket(path):
+    """
+    Bind the Unix datagram socket the API publishes transaction events to
+    :param path: file system path for the socket
+    :return: socket object, or None if the socket could not be created
+    """
+    if os.path.exists(path):
+        # left behind by a previous run
+        os.unlink(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.bind(path)
+    except socket.error as err:
+        print(datetime.utcnow().isoformat(' ') + ' : Unable to bind event socket ' + path + ': ' + str(err))
+        sock.close()
+        return None
+    # the API runs as a different user, so let it write to the socket
+    os.chmod(path, 0o666)
+    sock.setblocking(False)
+    return sock
+
+
+def wait_for_events(sock, timeout):
+    """
+    Block until the API publishes a transaction event or the timeout expires
+    :param sock: event socket from open_event_socket, or None to just sleep
+    :param timeout: maximum number of seconds to wait
+    :return: list of event messages received
+    """
+    events = []
+    if sock is None:
+        sleep(timeout)
+        return events
+
+    ready, unused_w, unused_x = select.select([sock], [], [], timeout)
+    if not ready:
+        return events
+
+    # drain everything that is queued so a burst of events results in a single scan
+    while True:
+        try:
+            data = sock.recv(1024)
+        except socket.error:
+            break
+        events.append(data.decode('utf-8', 'replace'))
+
+    ts_now = datetime.utcnow().isoformat(' ')
+    for event in events:
+        print(ts_now + ' : Received event: ' + event)
+    return events
+
+
+class WorkerPool(object):
+    """
+    Runs worker processes for transactions with a cap on how many run at once.
+
+    Transactions wait in a FIFO queue until a slot is free. A slot is only considered free when the number of
+    running workers is below max_workers and, once at least one worker is running, the host load average is below
+    max_load. The Linux load average counts processes blocked on disk as well as runnable ones, so it throttles
+    on I/O pressure as well as CPU. Finished workers are reaped on every call to reap(); a worker that exits
+    with a non-zero status is queued again until it has been attempted max_attempts times. Each retry waits
+    retry_delay seconds, doubling with every attempt, so a transient problem has time to clear.
+
+    Every worker leads its own process group (see ganymede_process.py). A worker only counts as finished once its
+    whole group has exited, so a retry never overlaps with a load or ETL left behind by the previous attempt.
+    """
+
+    def __init__(self, command, max_workers, max_load, max_attempts, retry_delay=30):
+        """
+        :param command: list containing the worker command; the transaction ID is appended as the last argument
+        :param max_workers: maximum number of workers to run at once
+        :param max_load: 1-minute load average above which no additional workers are started (0 disables)
+        :param max_attempts: number of times a transaction is attempted before giving up
+        :param retry_delay: seconds to wait before the first retry of a failed transaction
+        """
+        self.command = command
+        self.max_workers = max_workers
+        self.max_load = max_load
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.pending = deque()
+        self.running = {}
+        self.attempts = {}
+        self.not_before = {}
+        self.stopper = GroupStopper()
+        self.succeeded = set()
+        self.failed = set()
+
+    def known(self):
+        """
+        :return: set of transaction IDs the pool is queuing, running or has finished with
+        """
+        return set(self.pending) | set(self.running) | self.succeeded | self.failed
+
+    def submit(self, transid):
+        """
+        Queue a transaction for a worker
+        :param transid: transaction ID
+        :return: True if the transaction was queued, False if the pool already knows about it
+        """
+        if transid in self.known():
+            return False
+        self.pending.append(transid)
+        return True
+
+    def reap(self):
+        """
+        Collect the exit status of finished workers and queue failed ones for another attempt
+        :return: list of (transaction ID, exit status) for the workers that finished
+        """
+        finished = []
+        ts_now = datetime.utcnow().isoformat(' ')
+        for transid, proc in list(self.running.items()):
+            code = proc.poll()
+            if code is None:
+                if self.stopper.stopping(proc.pid):
+                    # kills the group once it has had its grace period
+                    self.stopper.stop(proc.pid, time())
+                continue
+            if not self.stopper.done(proc.pid):
+                # the worker exited, but mysql, openssl or the ETL it started are still running. Stop them and keep
+                # the slot taken until they are gone.
+                if not self.stopper.stopping(proc.pid):
+                    print(ts_now + ' : Worker for transaction ' + str(transid) + ' exited with status ' + str(code) +
+                          '. Stopping the processes it left running')
+                self.stopper.stop(proc.pid, time())
+                continue
+            del self.running[transid]
+            finished.append((transid, code))
+            if code == 0:
+                print(ts_now + ' : Worker for transaction ' + str(transid) + ' finished')
+                self.succeeded.add(transid)
+            else:
+                self.retry(transid, 'exited with status ' + str(code))
+        return finished
+
+    def retry(self, transid, reason, attempts=None):
+        """
+        Queue another attempt at a failed transaction after an exponential back-off, or give up on it once it has
+        been attempted max_attempts times. The new worker reuses the dump the agent already uploaded.
+        :param transid: transaction ID
+        :param reason: what went wrong, for the log
+        :param attempts: attempts recorded in transaction_state, for workers this pool did not start itself
+        :return: True if another attempt was queued
+        """
+        if attempts is not None and attempts > self.attempts.get(transid, 0):
+            self.attempts[transid] = attempts
+        made = self.attempts.get(transid, 0)
+        ts_now = datetime.utcnow()
+        if made >= self.max_attempts:
+            print(ts_now.isoformat(' ') + ' : Worker for transaction ' + str(transid) + ' ' + reason +
+                  '. Giving up after ' + str(made) + ' attempts')
+            self.failed.add(transid)
+            return False
+
+        delay = self.retry_delay * 2 ** max(made - 1, 0)
+        self.not_before[transid] = ts_now + timedelta(seconds=delay)
+        print(ts_now.isoformat(' ') + ' : Worker for transaction ' + str(transid) + ' ' + reason +
+              '. Queuing attempt ' + str(made + 1) + ' of ' + str(self.max_attempts) + ' in ' + str(delay) + 's')
+        self.pending.append(transid)
+        return True
+
+    def stop(self, transid, reason):
+        """
+        Terminate a running worker and every process it started; the group is killed if it has not exited after a
+        grace period. reap() collects it once the whole group is gone and queues a retry like any other failed
+        worker.
+        :param transid: transaction ID
+        :param reason: why the worker is being stopped, for the log
+        :return: True if a worker was signalled
+        """
+        proc = self.running.get(transid)
+        if proc is None or self.stopper.stopping(proc.pid):
+            return False
+        print(datetime.utcnow().isoformat(' ') + ' : Stopping Worker for transaction ' + str(transid) + ': ' +
+              reason)
+        self.stopper.stop(proc.pid, time())
+        return True
+
+    def capacity(self):
+        """
+        :return: number of workers that may be started right now
+        """
+        slots = self.max_workers - len(self.running)
+        if slots > 0 and self.max_load and len(self.running) > 0:
+            load = os.getloadavg()[0]
+            if load >= self.max_load:
+                print(datetime.utcnow().isoformat(' ') + ' : Host load ' + str(load) + ' exceeds ' +
+                      str(self.max_load) + '. Deferring ' + str(len(self.pending)) + ' queued Workers')
+                slots = 0
+        return slots
+
+    def launch(self):
+        """
+        Start workers for queued transactions while there is capacity
+        :return: number of workers started
+        """
+        started = 0
+        slots = self.capacity()
+        now = datetime.utcnow()
+        backing_off = []
+        while slots > 0 and self.pending:
+            transid = self.pending.popleft()
+            if self.not_before.get(transid, now) > now:
+                # a retry that is still backing off keeps its place in the queue
+                backing_off.append(transid)
+                continue
+            print(datetime.utcnow().isoformat(' ') + ' : Launching Worker to process transaction: ' + str(transid))
+            self.running[transid] = start_worker(self.command + [str(transid)])
+            self.attempts[transid] = self.attempts.get(transid, 0) + 1
+            slots -= 1
+            started += 1
+        self.pending.extendleft(reversed(backing_off))
+        return started
+
+
+class QueuedWorkerPool(WorkerPool):
+    """
+    Hands transactions to worker daemons on any number of hosts through the work queue instead of running workers
+    itself (see ganymede_queue.py and ganymede_worker_daemon.py).
+
+    launch() enqueues every queued transaction that is not backing off; the daemons decide where and how many run
+    at once. reap() collects the transactions the queue has finished with. The queue retries failed attempts and
+    reclaims the leases of daemons that died. stop() flags the lease in the work queue; the daemon holding it stops
+    the worker on its next heartbeat and the attempt counts as failed.
+    """
+
+    def __init__(self, queue, db_pool, max_workers, max_attempts, retry_delay=30):
+        """
+        :param queue: WorkQueue object
+        :param db_pool: ConnectionPool for the Ganymede database
+        :param max_workers: number of backlog transactions handed out at once
+        :param max_attempts: number of times a transaction is attempted before giving up
+        :param retry_delay: seconds to wait before the first retry of a failed transaction
+        """
+        WorkerPool.__init__(self, None, max_workers, 0, max_attempts, retry_delay)
+        self.queue = queue
+        self.db_pool = db_pool
+        self.cancelled = {}  # transid -> attempt that stop() asked to cancel
+
+    def reap(self):
+        """
+        Collect the transactions the work queue has finished with
+        :return: list of (transaction ID, exit status) for the transactions that finished
+        """
+        finished = []
+        with self.db_pool.connection() as cnx:
+            for (transid, owner, state) in self.queue.reclaim(cnx):
+                print(datetime.utcnow().isoformat(' ') + ' : Reclaimed expired lease on transaction ' +
+                      str(transid) + ' from ' + str(owner) + ': now ' + state)
+            states = self.queue.states(cnx, list(self.running))
+        ts_now = datetime.utcnow().isoformat(' ')
+        for transid, (state, attempts) in states.items():
+            self.attempts[transid] = attempts
+            if state == DONE:
+                del self.running[transid]
+                self.cancelled.pop(transid, None)
+                print(ts_now + ' : Worker for transaction ' + str(transid) + ' finished')
+                self.succeeded.add(transid)
+                finished.append((transid, 0))
+            elif state == FAILED:
+                del self.running[transid]
+                self.cancelled.pop(transid, None)
+                print(ts_now + ' : Worker for transaction ' + str(transid) + ' failed. Giving up after ' +
+                      str(attempts) + ' attempts')
+                self.failed.add(transid)
+                finished.append((transid, 1))
+        return finished
+
+    def stop(self, transid, reason):
+        """
+        Ask the worker daemon holding the transaction's lease to stop its worker. The daemon notices on its next
+        heartbeat; the queue then retries the transaction like any other failed attempt.
+        :param transid: transaction ID
+        :param reason: why the worker is being stopped, for the log
+        :return: True if a stop was requested
+        """
+        if transid not in self.running:
+            return False
+        if transid in self.cancelled and self.cancelled[transid] == self.attempts.get(transid):
+            # already asked to stop this attempt
+            return False
+        with self.db_pool.connection() as cnx:
+            if not self.queue.cancel(cnx, transid):
+                # not leased: waiting for a daemon or backing off before a retry
+                return False
+        print(datetime.utcnow().isoformat(' ') + ' : Stopping Worker for transaction ' + str(transid) + ': ' +
+              reason)
+        self.cancelled[transid] = self.attempts.get(transid)
+        return True
+
+    def capacity(self):
+        """
+        :return: number of transactions that may be enqueued right now
+        """
+        return len(self.pending)
+
+    def launch(self):
+        """
+        Enqueue the queued transactions that are not backing off
+        :return: number of transactions enqueued
+        """
+        now = datetime.utcnow()
+        ready = [t for t in self.pending if self.not_before.get(t, now) <= now]
+        if not ready:
+            return 0
+        with self.db_pool.connection() as cnx:
+            self.queue.enqueue(cnx, ready)
+        for transid in ready:
+            print(now.isoformat(' ') + ' : Queued transaction for the worker daemons: ' + str(transid))
+            self.pending.remove(transid)
+            self.running[transid] = None
+        return len(ready)
+
 ######
 # MAIN
 ######
@@ -147,8 +524,27 @@ if __name__ == '__main__':
     settings = ''
     loop_sleep = 120  # default
     max_time = timedelta(minutes=30)  # default
+    max_workers = cpu_count()  # default
+    max_load = cpu_count() * 2  # default
+    max_attempts = 2  # default
+    retry_delay = 30  # default, seconds
+    # Workers log when a stage completes and post a heartbeat every minute or so while a long stage makes progress
+    # (worker_heartbeat_seconds), so this only has to cover a few missed heartbeats. It must be shorter than
+    # max_time: a worker of this run that stalls is only stopped while the run lasts.
+    stall_time = timedelta(minutes=10)  # default
+    lookback_hours = 6  # default
+    dispatch = 'local'  # default
+    lease_seconds = 120  # default
+    skip_locked = True  # default
+    retention_days = 7  # default
+    worker_command = '/usr/local/bin/ganymede_worker.sh'  # default
+    backlog_budget = None  # default: 2 * max_workers
+    backlog_transactions = set()
+    queue_sleep = 5  # seconds between checks for a free worker slot while transactions are queued
     processing = True
-    cnx = False
+    db_pool = None
+    event_socket_path = ''
+    event_sock = None
     agent_transactions = set()
     worker_transactions = set()
     completed_transactions = set()
@@ -187,9 +583,116 @@ if __name__ == '__main__':
         else:
             print('Invalid "jupiter_loop_sleep" setting. Using default value.')
 
+    if settings.get('jupiter_max_workers'):
+        if int(settings['jupiter_max_workers']) > 0:
+            max_workers = int(settings['jupiter_max_workers'])
+        else:
+            print('Invalid "jupiter_max_workers" setting. Using default value.')
+
+    if 'jupiter_max_load' in settings:
+        # 0 disables the load check
+        if float(settings['jupiter_max_load']) >= 0:
+            max_load = float(settings['jupiter_max_load'])
+        else:
+            print('Invalid "jupiter_max_load" setting. Using default value.')
+
+    if settings.get('jupiter_max_attempts'):
+        if int(settings['jupiter_max_attempts']) > 0:
+            max_attempts = int(settings['jupiter_max_attempts'])
+        else:
+            print('Invalid "jupiter_max_attempts" setting. Using default value.')
+
+    if settings.get('jupiter_retry_delay'):
+        if int(settings['jupiter_retry_delay']) > 0:
+            retry_delay = int(settings['jupiter_retry_delay'])
+        else:
+            print('Invalid "jupiter_retry_delay" setting. Using default value.')
+
+    if settings.get('jupiter_stall_minutes'):
+        if int(settings['jupiter_stall_minutes']) > 0:
+            stall_time = timedelta(minutes=int(settings['jupiter_stall_minutes']))
+        else:
+            print('Invalid "jupiter_stall_minutes" setting. Using default value.')
+    if stall_time >= max_time:
+        print('Warning: "jupiter_stall_minutes" is not shorter than "jupiter_max_time". Stalled workers will not be '
+              'stopped before the run ends.')
+
+    if 'jupiter_lookback_hours' in settings:
+        # 0 disables catch-up
+        if int(settings['jupiter_lookback_hours']) >= 0:
+            lookback_hours = int(settings['jupiter_lookback_hours'])
+        else:
+            print('Invalid "jupiter_lookback_hours" setting. Using default value.')
+
+    if settings.get('jupiter_backlog_budget'):
+        if int(settings['jupiter_backlog_budget']) > 0:
+            backlog_budget = int(settings['jupiter_backlog_budget'])
+        else:
+            print('Invalid "jupiter_backlog_budget" setting. Using default value.')
+    if backlog_budget is None:
+        backlog_budget = max_workers * 2
+
+    if settings.get('jupiter_dispatch'):
+        if settings['jupiter_dispatch'] in ('local', 'queue'):
+            dispatch = settings['jupiter_dispatch']
+        else:
+            print('Invalid "jupiter_dispatch" setting. Using default value.')
+
+    if settings.get('jupiter_worker'):
+        # e.g. /usr/local/bin/ganymede_worker.py
+        worker_command = settings['jupiter_worker']
+
+    if settings.get('queue_lease_seconds'):
+        if int(settings['queue_lease_seconds']) > 10:
+            lease_seconds = int(settings['queue_lease_seconds'])
+        else:
+            print('Invalid "queue_lease_seconds" setting. Using default value.')
+
+    if 'queue_skip_locked' in settings:
+        # MySQL before 8.0 has no SKIP LOCKED
+        if parse_flag(settings['queue_skip_locked']) is not None:
+            skip_locked = parse_flag(settings['queue_skip_locked'])
+        else:
+            print('Invalid "queue_skip_locked" setting. Using default value.')
+
+    if settings.get('queue_retention_days'):
+        if int(settings['queue_retention_days']) > 0:
+            retention_days = int(settings['queue_retention_days'])
+        else:
+            print('Invalid "queue_retention_days" setting. Using default value.')
+    if dispatch == 'queue' and retention_days * 24 <= lookback_hours:
+        print('Warning: "queue_retention_days" does not cover "jupiter_lookback_hours". Purged transactions may be '
+              'processed again.')
+
+    # When the API publishes transaction events, we wake up as soon as an agent finishes. The loop_sleep
+    # polling interval remains as a fallback in case an event is lost.
+    if settings.get('jupiter_socket'):
+        event_socket_path = settings['jupiter_socket']
+        event_sock = open_event_socket(event_socket_path)
+        if event_sock is None:
+            print('Event socket unavailable. Falling back to polling.')
+
+    # Jupiter only needs one connection at a time. It is kept open between scans and pinged before reuse; every
+    # scan ends its transaction when the connection goes back to the pool, so each scan sees the latest log rows.
+    db_pool = ConnectionPool(lambda: mysql.connector.connect(**ganymede_db_opts), max_size=1,
+                             max_idle=max(300, loop_sleep * 2))
+
+    # "local" runs the workers as children of Jupiter; "queue" hands them to the worker daemons, which can run on
+    # any number of hosts
+    if dispatch == 'queue':
+        work_queue = WorkQueue(max_attempts, retry_delay, lease_seconds, skip_locked)
+        pool = QueuedWorkerPool(work_queue, db_pool, max_workers, max_attempts, retry_delay)
+    else:
+        pool = WorkerPool([worker_command], max_workers, max_load, max_attempts, retry_delay)
+
     # first, connect to Ganymede to gather some data
     try:
-        cnx = mysql.connector.connect(**ganymede_db_opts)
+        with db_pool.connection() as cnx:
+            expected_geos = active_geos(cnx)
+            if dispatch == 'queue':
+                purged = work_queue.purge(cnx, retention_days)
+                print(datetime.utcnow().isoformat(' ') + ' : Purged ' + str(purged) + ' finished transactions from '
+                      'the work queue')
     except mysql.connector.Error as err:
         if err.errno == errorcode.ER_ACCESS_DENIED_ERROR:
             print('Incorrect Ganymede DB user name or password')
@@ -208,11 +711,19 @@ if __name__ == '__main__':
     start = start_timestamp.substitute(year=now.year, month=now.month, day=now.day, hour=now.hour)
     end = end_timestamp.substitute(year=now.year, month=now.month, day=now.day, hour=now.hour)
 
-    expected_geos = active_geos(cnx)
+    # Catch-up mode: transactions from the previous lookback_hours hours that never got a completed worker are
+    # processed oldest first, using only the slots this hour's transactions leave free and at most backlog_budget
+    # new workers per run, so the pipeline recovers from an outage over a few runs without starving this hour.
+    backlog_end = now.replace(minute=0, second=0, microsecond=0)
+    backlog_start = backlog_end - timedelta(hours=lookback_hours)
 
     print(now.isoformat(' ') + ' : Jupiter initialized.')
     print(now.isoformat(' ') + ' : Expecting to process ' + str(len(expected_geos)) + ' GEOs')
     print(now.isoformat(' ') + ' : Transaction period: ' + start + ' through ' + end)
+    print(now.isoformat(' ') + ' : Dispatching Workers: ' + dispatch)
+    if lookback_hours:
+        print(now.isoformat(' ') + ' : Catching up on transactions from ' + backlog_start.isoformat(' ') +
+              ' (budget: ' + str(backlog_budget) + ' Workers)')
 
     # This goes in a loop
     while processing:
@@ -228,22 +739,36 @@ if __name__ == '__main__':
 
         print(time_check.isoformat(' ') + ' : Scanning transaction log.')
 
-        # we close & reopen our database connection
-        cnx.close()
-        cnx = mysql.connector.connect(**ganymede_db_opts)
-
-        # make sure our sets are empty
-        agent_transactions.clear()
-        worker_transactions.clear()
-        completed_transactions.clear()
-        available_transactions.clear()
-
-        # get all completed agent transactions
-        agent_transactions = completed_agent_transactions(cnx, start, end)
-        # get worker transactions that have been started
-        worker_transactions = current_worker_transactions(cnx, start, end)
-        # get worker transactions that have completed
-        completed_transactions = completed_worker_transactions(cnx, start, end)
+        # collect finished workers so their slots can be reused
+        pool.reap()
+
+        # pick up the current state of this period's transactions
+        with db_pool.connection() as cnx:
+            state_rows = scan_transaction_state(cnx, start, end)
+        track_transactions(state_rows, agent_transactions, worker_transactions, completed_transactions)
+
+        # retry workers that logged a FATAL error or stopped making progress
+        stall_deadline = datetime.utcnow() - stall_time
+        retry_failed(pool, state_rows, stall_deadline)
+
+        # catch up on earlier hours with whatever capacity this hour's queue leaves
+        if lookback_hours and not pool.pending:
+            with db_pool.connection() as cnx:
+                backlog_rows = scan_backlog(cnx, backlog_start, backlog_end)
+            backlog_transactions.update(retry_failed(pool, backlog_rows, stall_deadline))
+            free_slots = pool.max_workers - len(pool.running)
+            for row in backlog_rows:
+                if backlog_budget <= 0 or free_slots <= 0:
+                    break
+                # row[4] is worker_status: only transactions no worker has picked up yet are new work
+                if row[4] is not None or row[0] in pool.known():
+                    continue
+                print(time_check.isoformat(' ') + ' : Found backlog Agent Transaction: ' + str(row[0]))
+                pool.submit(row[0])
+                backlog_transactions.add(row[0])
+                backlog_budget -= 1
+                free_slots -= 1
+        backlog_active = [t for t in backlog_transactions if t in pool.running or t in pool.pending]
 
         print(time_check.isoformat(' ') + ' : Scan complete.')
         print(time_check.isoformat(' ') + ' : Agent Transactions: ' + str(len(agent_transactions)) +
@@ -254,30 +779,55 @@ if __name__ == '__main__':
         if len(agent_transactions) == 0:
             # No agents have started, pause then loop around
             print(time_check.isoformat(' ') + ' : No Agents have completed their transactions. Pausing.')
-            sleep(loop_sleep)
+            # retries and backlog transactions do not wait for this hour's agents
+            pool.launch()
+            if pool.pending:
+                wait_for_events(event_sock, min(queue_sleep, loop_sleep))
+            else:
+                wait_for_events(event_sock, loop_sleep)
             continue
 
         # Check to see if all agent transactions have been processed by workers
         if len(expected_geos) == len(agent_transactions):
             # All expected agents have initiated transactions
-            if agent_transactions == completed_transactions:
-                # all agent transactions have been completed by workers, so we're done
+            if agent_transactions == completed_transactions and not backlog_active:
+                # all agent transactions (and any backlog we took on) have been completed by workers, so we're done
                 print(time_check.isoformat(' ') + ' : All Agent transactions have been processed.')
                 processing = False
                 continue
 
         # We have agents that have finished processing their side, figure out which have had workers launched
-        # against the transaction
-        available_transactions = agent_transactions - worker_transactions
+        # against the transaction. Workers in the pool may not have logged WORKER_INIT yet, so skip those too.
+        available_transactions = agent_transactions - worker_transactions - pool.known()
+
+        for x in available_transactions:
+            pool.submit(x)
+
+        # we need to launch some workers
+        pool.launch()
+        print(time_check.isoformat(' ') + ' : Workers running: ' + str(len(pool.running)) +
+              ', Workers queued: ' + str(len(pool.pending)))
+
+        # wait for the next event (or the polling interval) and loop around. While transactions are queued we
+        # check back sooner so a slot freed by a finished worker does not sit idle.
+        if pool.pending:
+            wait_for_events(event_sock, min(queue_sleep, loop_sleep))
+        else:
+            wait_for_events(event_sock, loop_sleep)
+
+    pool.reap()
+    if pool.running or pool.pending:
+        print(datetime.utcnow().isoformat(' ') + ' : Leaving ' + str(len(pool.running)) + ' Workers running and ' +
+              str(len(pool.pending)) + ' transactions unprocessed')
 
-        if len(available_transactions) > 0:
-            # we need to launch some workers
-            for x in available_transactions:
-                print(time_check.isoformat(' ') + ' : Launching Worker to process transaction: ' + str(x))
-                Popen(['/usr/local/bin/ganymede_worker.sh', str(x)])
+    if event_sock is not None:
+        event_sock.close()
+        os.unlink(event_socket_path)
 
-        # go to sleep and loop around
-        sleep(loop_sleep)
+    pool_stats = db_pool.stats()
+    db_pool.close()
+    print(datetime.utcnow().isoformat(' ') + ' : DB connections opened: ' + str(pool_stats['created']) +
+          ', reused: ' + str(pool_stats['reused']) + ', failed health checks: ' + str(pool_stats['failed_checks']))
 
     # At this point, all processing is complete (as complete as it's going to be) so launch the Leopard
     # data set generator
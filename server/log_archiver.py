@@ -0,0 +1,311 @@
+#!/usr/bin/env python -u
+
+from __future__ import print_function
+from datetime import date, datetime
+from optparse import OptionParser
+from subprocess import Popen, PIPE
+import os.path
+import json
+import re
+
+import mysql.connector
+from mysql.connector import errorcode
+
+__author__ = 'jstoner'
+
+'''
+Maintains the monthly partitions of the transaction log (see db/migrations/002_log_partitions.sql).
+
+1. Splits the catch-all p_future partition so the current month and the next few months have their own partitions
+2. Moves every partition that closed more than "log_hot_months" months ago out of the log table into an archive
+   table with compressed rows, records it in log_archive and dumps it to "archive_dir"
+
+Archived months stay queryable: the agent log APIs read log_archive and include the archive tables that overlap the
+requested period. Compressed rows require innodb_file_per_table (and the Barracuda file format on MySQL 5.6).
+
+Run it from cron once a day; it is a no-op when nothing needs to change.
+'''
+
+
+def add_months(day, months):
+    """
+    :param day: date object
+    :param months: number of months to add (may be negative)
+    :return: date of the first day of the resulting month
+    """
+    month_index = day.year * 12 + day.month - 1 + months
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def log_partitions(db, schema):
+    """
+    :param db: database connection object
+    :param schema: the Ganymede schema name
+    :return: list of (partition name, lower bound, upper bound) in partition order. Bounds are date objects; the
+        lower bound of the first partition and the upper bound of p_future are None.
+    """
+    sql = '''
+        select partition_name, partition_description
+        from information_schema.partitions
+        where table_schema = %s and table_name = 'log'
+        order by partition_ordinal_position
+        '''
+    cur = db.cursor()
+    cur.execute(sql, (schema,))
+    rows = cur.fetchall()
+    partitions = []
+    lower = None
+    for (name, description) in rows:
+        if name is None:
+            # the table is not partitioned
+            break
+        if description == 'MAXVALUE':
+            upper = None
+        else:
+            # the description is a TO_DAYS() value, which counts from year 0 rather than year 1
+            upper = date.fromordinal(int(description) - 365)
+        partitions.append((name, lower, upper))
+        lower = upper
+    cur.close()
+    return partitions
+
+
+def split_future_partition(db, partitions, this_month, through, dry_run):
+    """
+    Reorganize p_future so every month from this_month up to and including "through" has its own partition
+    :param db: database connection object
+    :param partitions: list returned by log_partitions
+    :param this_month: first day of the current month
+    :param through: first day of the last month that needs a partition
+    :param dry_run: only print what would be done
+    :return: list of partition names created
+    """
+    # The last bounded partition tells us where the monthly partitions end. If it ends before the current month,
+    # the first new partition also takes whatever p_future holds from the months in between.
+    bounded = [p[2] for p in partitions if p[2] is not None]
+    month = this_month
+    if bounded and bounded[-1] > month:
+        month = bounded[-1]
+
+    new_parts = []
+    clauses = []
+    while month <= through:
+        upper = add_months(month, 1)
+        name = 'p' + month.strftime('%Y%m')
+        clauses.append("PARTITION {0} VALUES LESS THAN (TO_DAYS('{1}'))".format(name, upper.isoformat()))
+        new_parts.append(name)
+        month = upper
+
+    if not new_parts:
+        return new_parts
+
+    clauses.append('PARTITION p_future VALUES LESS THAN MAXVALUE')
+    sql = 'ALTER TABLE log REORGANIZE PARTITION p_future INTO ({0})'.format(', '.join(clauses))
+    print(datetime.utcnow().isoformat(' ') + ' : Adding partitions: ' + ', '.join(new_parts))
+    if not dry_run:
+        cur = db.cursor()
+        cur.execute(sql)
+        cur.close()
+    return new_parts
+
+
+def dump_archive(db_opts, table, archive_dir):
+    """
+    Write a compressed dump of an archive table to the archive directory
+    :param db_opts: dict of database connection options
+    :param table: archive table name
+    :param archive_dir: directory to write the dump to
+    :return: path of the dump file, or None on failure
+    """
+    dump_file = os.path.join(archive_dir, table + '.sql.gz')
+    dump_cmd = ['mysqldump', '-u' + db_opts['user'], '-p' + db_opts['password'], '-h' + db_opts['host'],
+                '--single-transaction', '--tz-utc', db_opts['database'], table]
+    with open(dump_file, 'wb') as out:
+        dump = Popen(dump_cmd, stdout=PIPE)
+        gzip = Popen(['gzip', '-c'], stdin=dump.stdout, stdout=out)
+        dump.stdout.close()
+        gzip.communicate()
+        dump.wait()
+    if dump.returncode != 0 or gzip.returncode != 0:
+        return None
+    return dump_file
+
+
+def archive_table_state(cur, table):
+    """
+    :param cur: database cursor
+    :param table: archive table name
+    :return: tuple of (exists, partitioned, compressed, has_rows) for the archive table
+    """
+    cur.execute('select row_format from information_schema.tables where table_schema = database() and table_name = %s',
+                (table,))
+    row = cur.fetchone()
+    if row is None:
+        return False, False, False, False
+    compressed = str(row[0]).lower() == 'compressed'
+    sql = '''
+        select count(*) from information_schema.partitions
+        where table_schema = database() and table_name = %s and partition_name is not null
+        '''
+    cur.execute(sql, (table,))
+    partitioned = cur.fetchone()[0] > 0
+    cur.execute('select id from {0} limit 1'.format(table))
+    has_rows = cur.fetchone() is not None
+    return True, partitioned, compressed, has_rows
+
+
+def archive_partition(db, partition, lower, upper, dry_run):
+    """
+    Move the rows of one closed partition into a compressed archive table and drop the partition. Every step checks
+    whether it is already done, so a run that was interrupted part way is finished by the next one.
+    :param db: database connection object
+    :param partition: partition name
+    :param lower: lower bound of the partition (date or None)
+    :param upper: upper bound of the partition (date)
+    :param dry_run: only print what would be done
+    :return: archive table name, or None if the partition was empty and simply dropped
+    """
+    if partition.startswith('p_'):
+        table = 'log_archive_' + partition[2:]
+    else:
+        table = 'log_archive_' + partition[1:]
+
+    cur = db.cursor()
+    cur.execute('select id from log partition ({0}) limit 1'.format(partition))
+    has_rows = cur.fetchone() is not None
+    (exists, partitioned, compressed, archived_rows) = archive_table_state(cur, table)
+
+    ts_now = datetime.utcnow().isoformat(' ')
+    if not has_rows and not archived_rows:
+        print(ts_now + ' : Dropping empty partition ' + partition)
+        if not dry_run:
+            cur.execute('ALTER TABLE log DROP PARTITION {0}'.format(partition))
+            if exists:
+                cur.execute('DROP TABLE {0}'.format(table))
+        cur.close()
+        return None
+
+    if has_rows and archived_rows:
+        # exchanging now would swap the archived rows back into the log table
+        print(ts_now + ' : Both partition ' + partition + ' and ' + table + ' hold rows. Skipping the partition.')
+        cur.close()
+        return None
+
+    print(ts_now + ' : Archiving partition ' + partition + ' to ' + table)
+    if dry_run:
+        cur.close()
+        return table
+
+    # EXCHANGE PARTITION swaps the partition's tablespace with an empty table of identical structure, so no rows
+    # are copied. Compression happens afterwards because the row formats must match during the exchange.
+    if not exists:
+        cur.execute('CREATE TABLE IF NOT EXISTS {0} LIKE log'.format(table))
+        partitioned = True
+    if partitioned:
+        cur.execute('ALTER TABLE {0} REMOVE PARTITIONING'.format(table))
+    if has_rows:
+        cur.execute('ALTER TABLE log EXCHANGE PARTITION {0} WITH TABLE {1}'.format(partition, table))
+
+    # record the archive table before the partition goes away, so the log APIs never miss the month
+    cur.execute('select table_name from log_archive where table_name = %s', (table,))
+    if cur.fetchone() is None:
+        sql = 'insert into log_archive (table_name, tstamp_start, tstamp_end, archived) values (%s, %s, %s, %s)'
+        cur.execute(sql, (table, lower, upper, datetime.utcnow()))
+        db.commit()
+
+    # unlike the exchange, this ALTER rebuilds the archive table and copies every row of the month
+    if not compressed:
+        cur.execute('ALTER TABLE {0} ROW_FORMAT=COMPRESSED KEY_BLOCK_SIZE=8'.format(table))
+    cur.execute('ALTER TABLE log DROP PARTITION {0}'.format(partition))
+    cur.close()
+    return table
+
+######
+# MAIN
+######
+if __name__ == '__main__':
+    hot_months = 3  # default
+    future_months = 2  # default
+    archive_dir = ''
+    cnx = False
+
+    parser = OptionParser()
+    parser.add_option('-n', '--dry-run', dest='dry_run', action='store_true', default=False,
+                      help='Print the partition changes without making them')
+    (args, unused) = parser.parse_args()
+
+    # Load settings
+    if os.path.exists('/etc/ganymede/ganymede.json'):
+        fp = open('/etc/ganymede/ganymede.json', 'r')
+        settings = json.load(fp)
+        fp.close()
+    else:
+        print('Cannot find database configuration settings.')
+        exit(1)
+
+    ganymede_db_opts = {
+        'user': settings['db_user'],
+        'password': settings['db_pass'],
+        'host': settings['db_host'],
+        'database': settings['db_schema'],
+        'raise_on_warnings': True,
+        'time_zone': settings['db_timezone'],
+    }
+
+    # override defaults, if necessary
+    if settings.get('log_hot_months'):
+        if int(settings['log_hot_months']) > 0:
+            hot_months = int(settings['log_hot_months'])
+        else:
+            print('Invalid "log_hot_months" setting. Using default value.')
+
+    if settings.get('log_future_months'):
+        if int(settings['log_future_months']) > 0:
+            future_months = int(settings['log_future_months'])
+        else:
+            print('Invalid "log_future_months" setting. Using default value.')
+
+    if settings.get('archive_dir'):
+        archive_dir = settings['archive_dir']
+
+    try:
+        cnx = mysql.connector.connect(**ganymede_db_opts)
+    except mysql.connector.Error as err:
+        if err.errno == errorcode.ER_ACCESS_DENIED_ERROR:
+            print('Incorrect Ganymede DB user name or password')
+            exit(1)
+        elif err.errno == errorcode.ER_BAD_DB_ERROR:
+            print('Ganymede Schema does not exist')
+            exit(1)
+        else:
+            print(err)
+            exit(1)
+
+    this_month = add_months(datetime.utcnow().date(), 0)
+    log_parts = log_partitions(cnx, settings['db_schema'])
+    if not log_parts:
+        print('The log table is not partitioned. Apply db/migrations/002_log_partitions.sql first.')
+        exit(1)
+
+    # make sure the months ahead have partitions before rows arrive for them
+    split_future_partition(cnx, log_parts, this_month, add_months(this_month, future_months), args.dry_run)
+
+    # everything that ended before the cutoff is closed and can be archived
+    cutoff = add_months(this_month, -hot_months)
+    for (part_name, part_lower, part_upper) in log_partitions(cnx, settings['db_schema']):
+        if part_upper is None or part_upper > cutoff:
+            continue
+        if not re.match(r'^p_?\w+$', part_name):
+            print('Skipping unexpected partition ' + part_name)
+            continue
+        archive_table = archive_partition(cnx, part_name, part_lower, part_upper, args.dry_run)
+        if archive_table is None or args.dry_run or not archive_dir:
+            continue
+        out_file = dump_archive(ganymede_db_opts, archive_table, archive_dir)
+        if out_file is None:
+            print(datetime.utcnow().isoformat(' ') + ' : Failed to dump ' + archive_table)
+        else:
+            print(datetime.utcnow().isoformat(' ') + ' : Dumped ' + archive_table + ' to ' + out_file)
+
+    cnx.close()
+    print(datetime.utcnow().isoformat(' ') + ' : Log archive maintenance complete.')
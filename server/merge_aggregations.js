@@ -0,0 +1,52 @@
+// Incremental counterpart of build_aggregations.js, used when the aggregation_mode setting is "incremental".
+// Instead of building a new set of collections for every extract, only the documents of the extracted hour are
+// unwound and merged into persistent <name>_rollup collections, which hold every hour within the retention period.
+// prune_aggregations.js removes the hours that fell out of it.
+//
+// Each unwound row is keyed by its source document and array position, so running the same hour twice replaces
+// its rows instead of duplicating them.
+
+function rollup(source, arrayField, fields, target) {
+    var project = {
+        _id: {doc: "$_id", i: "$idx"},
+        period_start: {$dateFromParts: {
+            year: "$report_period.year",
+            month: "$report_period.month",
+            day: "$report_period.day",
+            hour: "$report_period.hour"}
+        },
+        "report_period": 1,
+        "ganymede_doc_version": 1
+    };
+    fields.forEach(function (field) { project[field] = 1; });
+
+    db[target].createIndex({"report_period.year": 1, "report_period.month": 1, "report_period.day": 1,
+                            "report_period.hour": 1});
+    db[target].createIndex({period_start: 1});
+    // rows an earlier run left for this hour may come from array elements that are gone now
+    db[target].deleteMany(QUERY);
+    db[source].aggregate([
+        {$match : QUERY },
+        {$unwind: {path: "$" + arrayField, includeArrayIndex: "idx"}},
+        {$project: project},
+        {$merge: {into: target, on: "_id", whenMatched: "replace", whenNotMatched: "insert"}}
+    ]);
+}
+
+// Servers
+rollup("servers", "hardware.disk", ["general.server_id", "hardware.disk"], "serverdisks_rollup");
+rollup("servers", "hardware.nic", ["general.server_id", "hardware.nic.nic_id"], "servernics_rollup");
+rollup("servers", "hardware.software_label", ["general.server_id", "hardware.software_label.display_name"],
+       "serversoftwarelabels_rollup");
+
+// Images
+rollup("images", "hardware.disk", ["general.image_id", "hardware.disk"], "imagedisks_rollup");
+
+// MCPs
+rollup("mcps", "sites", ["geo", "sites.mcp_id", "sites.display_name", "sites.type", "sites.site_name"],
+       "geos_rollup");
+
+// Consistency Groups
+rollup("drs_cluster_pairs", "general.consistency_groups",
+       ["general.drs_pair_id", "general.consistency_groups.cg_id", "general.consistency_groups.state"],
+       "consistency_groups_rollup");
@@ -0,0 +1,9 @@
+// Retention-based cleanup for the collections merge_aggregations.js maintains, used in place of
+// clean_aggregations.js when the aggregation_mode setting is "incremental". Removes the hours that started more than
+// RETENTION hours ago.
+var cutoff = new Date(Date.now() - RETENTION * 3600 * 1000);
+
+["serverdisks_rollup", "servernics_rollup", "serversoftwarelabels_rollup", "imagedisks_rollup", "geos_rollup",
+ "consistency_groups_rollup"].forEach(function (name) {
+    db[name].deleteMany({period_start: {$lt: cutoff}});
+});
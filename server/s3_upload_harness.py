@@ -0,0 +1,272 @@
+#!/usr/bin/env python -u
+
+from __future__ import print_function
+from optparse import OptionParser
+from subprocess import Popen
+from time import sleep, time
+import gzip
+import io
+import os
+import os.path
+import shutil
+import socket
+import sys
+import tempfile
+
+import boto3
+from botocore.awsrequest import AWSResponse
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError, ConnectionClosedError
+
+from ganymede_s3_upload import MB, MIN_PART_SIZE, upload_file
+
+__author__ = 'jstoner'
+
+'''
+Tries ganymede_s3_upload.py against a local moto_server, with faults injected into single parts.
+
+Needs boto3 and moto's server with its extras (pip install "moto[server]"; plain moto lacks the flask that
+moto_server runs on). Neither is needed in production. Run it by hand from the directory holding
+ganymede_s3_upload.py:
+
+    python s3_upload_harness.py [--moto-server /path/to/moto_server] [--size 24]
+
+It starts moto_server on a free port, writes a file of random data and checks that:
+
+1. a plain multipart upload arrives intact
+2. a part that S3 rejects (BadDigest) or whose connection drops is retried, and the object arrives intact
+3. the same with --compress: the object gunzips to the original file
+4. a part that fails on every attempt aborts the upload and leaves no incomplete upload behind
+5. a damaged part that the server stores anyway fails the upload on the ETag check, and the object is removed
+
+The client's own retries are turned off, so every retry is one made by ganymede_s3_upload.py. Each retry waits
+for its back-off, so the run takes about half a minute.
+
+Exits with status 0 when every check passed and 1 otherwise.
+'''
+
+BUCKET = 'ganymede-upload-test'
+
+
+class ErrorBody(object):
+    """
+    Raw body of an injected error response
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+    def stream(self, **kwargs):
+        yield self.data
+
+
+class PartFault(object):
+    """
+    Injects a fault into the first attempts of one part:
+
+    * 'error': S3 answers 400 BadDigest, as it does for a part damaged in transit
+    * 'drop': the connection drops before a response arrives
+    * 'damage': the body is changed on the way but keeps its Content-MD5, and the server stores it anyway.
+      moto_server does not check Content-MD5, so this is how a damaged part that got through looks.
+    """
+
+    def __init__(self, part, attempts, mode):
+        """
+        :param part: part number to inject the fault into
+        :param attempts: number of attempts that fail; the part is left alone after that
+        :param mode: 'error', 'drop' or 'damage'
+        """
+        self.part = part
+        self.attempts = attempts
+        self.mode = mode
+        self.injected = 0
+
+    def register(self, client):
+        """
+        :param client: boto3 S3 client to inject the fault into
+        """
+        if self.mode == 'damage':
+            client.meta.events.register('before-parameter-build.s3.UploadPart', self.damage)
+        else:
+            client.meta.events.register('before-send.s3.UploadPart', self.fail)
+
+    def unregister(self, client):
+        """
+        :param client: boto3 S3 client
+        """
+        client.meta.events.unregister('before-parameter-build.s3.UploadPart', self.damage)
+        client.meta.events.unregister('before-send.s3.UploadPart', self.fail)
+
+    def damage(self, params, **kwargs):
+        """
+        botocore before-parameter-build handler: flips one byte of the body, leaving ContentMD5 as it was
+        :param params: the parameters upload_part was called with
+        """
+        if params['PartNumber'] != self.part or self.injected >= self.attempts:
+            return
+        self.injected += 1
+        data = params['Body']
+        params['Body'] = data[:1] + bytes(bytearray([bytearray(data)[1] ^ 0xff])) + data[2:]
+
+    def fail(self, request, **kwargs):
+        """
+        botocore before-send handler: a response returned here is used instead of sending the request
+        :param request: the prepared request
+        :return: the injected response, or None to send the request
+        """
+        if 'partNumber=' + str(self.part) + '&' not in request.url + '&' or self.injected >= self.attempts:
+            return None
+        self.injected += 1
+        if self.mode == 'drop':
+            raise ConnectionClosedError(endpoint_url=request.url)
+        body = (b'<?xml version="1.0" encoding="UTF-8"?><Error><Code>BadDigest</Code>'
+                b'<Message>The Content-MD5 you specified did not match what we received.</Message></Error>')
+        return AWSResponse(request.url, 400, {'Content-Type': 'application/xml'}, ErrorBody(body))
+
+
+def free_port():
+    """
+    :return: a TCP port nothing listens on right now
+    """
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_moto(command, port):
+    """
+    :param command: moto_server program
+    :param port: port to listen on
+    :return: Popen object of the server, once it accepts connections
+    """
+    devnull = open(os.devnull, 'w')
+    proc = Popen([command, '-H', '127.0.0.1', '-p', str(port)], stdout=devnull, stderr=devnull)
+    deadline = time() + 30
+    while time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(command + ' exited with status ' + str(proc.returncode))
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return proc
+        except socket.error:
+            sleep(0.2)
+    proc.kill()
+    raise RuntimeError(command + ' did not start listening on port ' + str(port))
+
+
+def fetch(client, key):
+    """
+    :param client: boto3 S3 client
+    :param key: object key
+    :return: contents of the object
+    """
+    return client.get_object(Bucket=BUCKET, Key=key)['Body'].read()
+
+
+def check(name, passed, detail=''):
+    """
+    :param name: what was checked
+    :param passed: result of the check
+    :param detail: printed with a failed check
+    :return: passed
+    """
+    print(('OK   ' if passed else 'FAIL ') + name + ('' if passed or not detail else ': ' + detail))
+    return passed
+
+
+def faulty_upload(client, key, path, compress, fault, retries=3):
+    """
+    Upload a file with a fault injected
+    :param client: boto3 S3 client
+    :param key: object key
+    :param path: file to upload
+    :param compress: gzip the file on the way
+    :param fault: PartFault object
+    :param retries: attempts per part
+    :return: ETag of the object
+    """
+    fault.register(client)
+    try:
+        return upload_file(client, BUCKET, key, path, compress, None, 4, MB, MIN_PART_SIZE, retries)
+    finally:
+        fault.unregister(client)
+
+
+def run_checks(client, path, original):
+    """
+    :param client: boto3 S3 client
+    :param path: file to upload
+    :param original: contents of the file
+    :return: number of failed checks
+    """
+    failures = 0
+
+    etag = upload_file(client, BUCKET, 'plain', path, False, None, 4, MB, MIN_PART_SIZE, 3)
+    failures += not check('plain upload (' + etag + ')', fetch(client, 'plain') == original)
+
+    for mode in ('error', 'drop'):
+        fault = PartFault(2, 1, mode)
+        etag = faulty_upload(client, mode, path, False, fault)
+        failures += not check('part retried after ' + mode + ' (' + etag + ')',
+                              fault.injected == 1 and fetch(client, mode) == original)
+
+    fault = PartFault(3, 2, 'error')
+    etag = faulty_upload(client, 'compressed.gz', path, True, fault)
+    unpacked = gzip.GzipFile(fileobj=io.BytesIO(fetch(client, 'compressed.gz'))).read()
+    failures += not check('compressed upload with a part retried twice (' + etag + ')',
+                          fault.injected == 2 and unpacked == original)
+
+    for (mode, attempts, reason) in (('error', 100, 'a part that keeps failing'),
+                                     ('damage', 1, 'a damaged part the server accepted')):
+        key = 'aborted-' + mode
+        try:
+            faulty_upload(client, key, path, False, PartFault(2, attempts, mode), retries=2)
+            failures += not check(reason + ' fails the upload', False, 'the upload succeeded')
+        except (BotoCoreError, ClientError, ValueError) as err:
+            pending = [u for u in client.list_multipart_uploads(Bucket=BUCKET).get('Uploads', []) if u['Key'] == key]
+            stored = client.list_objects(Bucket=BUCKET, Prefix=key).get('Contents', [])
+            failures += not check(reason + ' fails the upload (' + err.__class__.__name__ + ')',
+                                  not pending and not stored,
+                                  str(len(pending)) + ' incomplete uploads and ' + str(len(stored)) + ' objects left')
+    return failures
+
+######
+# MAIN
+######
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('-m', '--moto-server', dest='moto_server', default='moto_server',
+                      help='moto_server program (default: moto_server from the PATH)')
+    parser.add_option('-s', '--size', dest='size', type='int', default=24,
+                      help='MB of random data to upload; at least 11 for three parts (default: 24)')
+    (args, unused) = parser.parse_args()
+
+    moto_port = free_port()
+    try:
+        server = start_moto(args.moto_server, moto_port)
+    except (OSError, RuntimeError) as err:
+        print('Cannot start moto_server: ' + str(err))
+        exit(1)
+
+    work_dir = tempfile.mkdtemp(prefix='ganymede_s3_test_')
+    try:
+        file_path = os.path.join(work_dir, 'backup.sql')
+        original_data = os.urandom(args.size * MB)
+        with open(file_path, 'wb') as fp:
+            fp.write(original_data)
+        s3 = boto3.client('s3', endpoint_url='http://127.0.0.1:' + str(moto_port), region_name='us-east-1',
+                          aws_access_key_id='testing', aws_secret_access_key='testing',
+                          config=Config(retries={'total_max_attempts': 1}))
+        s3.create_bucket(Bucket=BUCKET)
+        failed = run_checks(s3, file_path, original_data)
+    finally:
+        shutil.rmtree(work_dir)
+        server.terminate()
+        server.wait()
+
+    if failed:
+        print(str(failed) + ' checks failed')
+        sys.exit(1)
+    print('All checks passed')
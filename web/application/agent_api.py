@@ -1,27 +1,58 @@
 from __future__ import print_function
 from uuid import uuid4
 from datetime import datetime
+from collections import OrderedDict
+from threading import Lock
+from time import time
+from types import GeneratorType
 import re
 import os
 import os.path
+import socket
+import fcntl
 
-from base64 import b64encode
+from base64 import b64encode, b64decode
+from hashlib import md5
 from optparse import OptionParser
 
 import bottle
-from bottle import route, request, response
-import bottle_mysql
+from bottle import route, request, response, HTTPError, HTTPResponse
+import MySQLdb
+import MySQLdb.cursors
 import json
 
+from ganymede_pool import ConnectionPool, PoolExhausted
+import ganymede_sql
+
+try:
+    string_types = basestring
+    from urllib import urlencode
+except NameError:
+    # Python 3
+    string_types = str
+    from urllib.parse import urlencode
+
 api_base = '/api/v1'
 data_dir = '/var/lib/ganymede/uploads'
+notify_socket = ''
+db_pool = None
+agent_cache = None
+response_cache = None
+version_file = ''
+max_batch_events = 1000
+max_page_size = 1000
+
+agent_stages = ['AGENT_INIT', 'AGENT_DUMP', 'AGENT_COMPRESS', 'AGENT_ENCRYPT', 'AGENT_TRANSFER', 'AGENT_END']
+worker_stages = ['WORKER_INIT', 'WORKER_DECRYPT', 'WORKER_DECOMPRESS', 'WORKER_SCHEMA', 'WORKER_LOAD', 'WORKER_ETL',
+                 'WORKER_END']
+log_statuses = ['SUCCESS', 'WARNING', 'FAIL', 'FATAL']
 
 '''Utility APIs
     Right now, it's just a "heartbeat" for monitoring purposes
 '''
 
 
-@route(api_base + '/heartbeat', method='GET')
+@route(api_base + '/heartbeat', method='GET', conditional=True)
 def heartbeat(db):
 
     sql = 'select count(*) as num from agent'
@@ -36,33 +67,88 @@ def heartbeat(db):
     return agent_count
 
 
+@route(api_base + '/heartbeat/pool', method='GET')
+def pool_status():
+    """
+        GETs the database connection pool metrics for this API process
+    """
+    if db_pool is None:
+        response.status = 503
+        return
+
+    response.status = 200
+    return db_pool.stats()
+
+
+@route(api_base + '/heartbeat/cache', method='GET')
+def cache_status():
+    """
+        GETs the agent lookup cache metrics for this API process
+    """
+    if agent_cache is None:
+        response.status = 503
+        return
+
+    response.status = 200
+    return agent_cache.stats()
+
+
 '''
 Start of AGENT APIs
 '''
 
 
-@route(api_base + '/agent', method='GET')
+@route(api_base + '/agent', method='GET', conditional=True)
 def list_agents(db):
     """
         GETs a list of all agents
+      Query Params:
+        after: <active>,<enabled>,<agent_id> of the last agent on the previous page
+        limit: page size
+        format: ndjson to stream one agent per line
     """
 
+    (after, limit, error) = page_request(3)
+    if error is None and after is not None and not (after[0].isdigit() and after[1].isdigit()):
+        error = 'Invalid "after" parameter'
+    if error is not None:
+        msg = {'status_message': error}
+        response.status = '400 Invalid parameters'
+        response.content_type = 'application/json'
+        return msg
+
     sql = '''
         select a.uid, a.name, a.enabled, a.active, g.short_name from agent a, geo_config g, assignment x
-        where x.agent_id = a.id and x.geo_config_id = g.id order by active, enabled
+        where x.agent_id = a.id and x.geo_config_id = g.id
         '''
+    params = ()
+    if after is not None:
+        sql += ' and (a.active, a.enabled, a.uid) > (%s, %s, %s)'
+        params = (int(after[0]), int(after[1]), after[2])
+    sql += ' order by a.active, a.enabled, a.uid'
+    if limit is not None:
+        sql += ' limit ' + str(limit + 1)
+
+    def render(row):
+        agentapi = api_base + '/agent/' + row['uid']
+        translog = agentapi + '/log'
+        return {'agent_id': row['uid'],
+                'agent_name': row['name'], 'geo_id': row['short_name'],
+                'enabled': row['enabled'], 'active': row['active'],
+                'transaction_log_url': translog, 'agent_url': agentapi}
 
-    db.execute(sql)
+    if request.query.format == 'ndjson':
+        return stream_rows(db, sql, params, render, limit)
+
+    db.execute(sql, params)
     agents = {'agents': []}
 
     for row in db:
-        agentapi = api_base + '/agent/' + row['uid']
-        translog = agentapi + '/log'
-        agent = {'agent_id': row['uid'],
-                 'agent_name': row['name'], 'geo_id': row['short_name'],
-                 'enabled': row['enabled'], 'active': row['active'],
-                 'transaction_log_url': translog, 'agent_url': agentapi}
-        agents['agents'].append(agent)
+        if limit is not None and len(agents['agents']) == limit:
+            last = agents['agents'][-1]
+            agents['next_url'] = next_page_url([last['active'], last['enabled'], last['agent_id']])
+            break
+        agents['agents'].append(render(row))
 
     return agents
 
@@ -92,6 +178,7 @@ def create_agent(db):
     db.execute(sql, (uid, name, enabled, active))
     if db.lastrowid:
         # db.commit()
+        invalidate_agent(uid)
         agenturl = api_base + '/agent/' + uid
         response.set_header('Location', agenturl)
         response.status = 201
@@ -104,7 +191,7 @@ def create_agent(db):
     return
 
 
-@route(api_base + '/agent/<agent_id:re:[a-zA-Z0-9-]+>', method='GET')
+@route(api_base + '/agent/<agent_id:re:[a-zA-Z0-9-]+>', method='GET', conditional=True)
 def list_agent(agent_id, db):
     """
       GETs the details of the given agent_id
@@ -184,6 +271,8 @@ def update_agent(agent_id, db):
         sql = 'update agent set enabled = %s where uid = %s'
         db.execute(sql, (enabled, agent_id))
 
+    invalidate_agent(agent_id)
+
     agenturl = api_base + '/agent/' + agent_id
     response.set_header('Location', agenturl)
     response.status = 204
@@ -252,6 +341,7 @@ def assign_agent(agent_id, db):
 
     if rows > 0:
         # db.commit()
+        invalidate_agent(agent_id)
         response.status = 204
         return
     else:
@@ -288,6 +378,7 @@ def delete_agent(agent_id, db):
     sql = 'delete from agent where id = %s'
     db.execute(sql, (agent['id'],))
     # db.commit()
+    invalidate_agent(agent_id)
     response.status = 204
     return
 
@@ -300,6 +391,9 @@ def get_agent_logs(agent_id, db):
         year:
         month:
         day:
+        after: <timestamp>,<transaction id> of the last transaction on the previous page
+        limit: page size
+        format: ndjson to stream one transaction per line
     """
 
     # these variables are used to build a timestamp to restrict the log query
@@ -311,9 +405,7 @@ def get_agent_logs(agent_id, db):
     tstamp_start = ''
     tstamp_end = ''
 
-    sql = 'select a.id, x.geo_config_id from agent a, assignment x where x.agent_id = a.id and a.uid = %s'
-    db.execute(sql, (agent_id,))
-    agent = db.fetchone()
+    agent = agent_assignment(db, agent_id)
     if agent is None:
         msg = {'status_message': 'Agent not found'}
         response.status = '404 Agent Not Found'
@@ -323,6 +415,17 @@ def get_agent_logs(agent_id, db):
     parent = api_base + '/agent/' + agent_id
     log = {'transactions': [], 'parent_url': parent}
 
+    (after, limit, error) = page_request(2)
+    if error is None and after is not None:
+        after[0] = parse_timestamp(after[0])
+        if after[0] is None:
+            error = 'Invalid "after" parameter'
+    if error is not None:
+        msg = {'status_message': error}
+        response.status = '400 Invalid parameters'
+        response.content_type = 'application/json'
+        return msg
+
     # Check the query params, if any
     if request.query.year and int(request.query.year) >= 2015:
         timestamp_year = request.query.year
@@ -350,32 +453,35 @@ def get_agent_logs(agent_id, db):
         else:
             timestamp = timestamp + '-' + str(right_now.day)
 
+    day = None
     if timestamp:
         # restrict the query
         tstamp_start = timestamp + ' 00:00:00'
         tstamp_end = timestamp + ' 23:59:59'
-        sql = '''
-            select transid, tstamp
-            from log
-            where
-                geo = %s and
-                stage = 'AGENT_INIT' and
-                tstamp >= %s and
-                tstamp <= %s
-            order by tstamp
-        '''
-        db.execute(sql, (agent['geo_config_id'], tstamp_start, tstamp_end))
+        day = (tstamp_start, tstamp_end)
+        tables = log_tables(db, tstamp_start, tstamp_end)
     else:
-        sql = '''
-            select transid, tstamp from log where geo = %s and stage = 'AGENT_INIT' order by tstamp
-            '''
-        db.execute(sql, (agent['geo_config_id'],))
+        tables = log_tables(db, after[0] if after else None)
 
-    for row in db:
+    (sql, params) = ganymede_sql.agent_logs_query(tables, agent['geo_config_id'], day, after,
+                                                  None if limit is None else limit + 1)
+
+    def render(row):
         transurl = parent + '/log/' + row['transid']
         stamp = row['tstamp']
-        trans = {'transaction_id': row['transid'], 'timestamp': stamp.isoformat(), 'transaction_url': transurl}
-        log['transactions'].append(trans)
+        return {'transaction_id': row['transid'], 'timestamp': stamp.isoformat(), 'transaction_url': transurl}
+
+    if request.query.format == 'ndjson':
+        return stream_rows(db, sql, params, render, limit)
+
+    db.execute(sql, params)
+
+    for row in db:
+        if limit is not None and len(log['transactions']) == limit:
+            last = log['transactions'][-1]
+            log['next_url'] = next_page_url([last['timestamp'], last['transaction_id']])
+            break
+        log['transactions'].append(render(row))
 
     return log
 
@@ -393,13 +499,7 @@ def create_transaction_log(agent_id, db):
         return msg
 
     timestamp = datetime.utcnow()
-    sql = '''
-        select x.geo_config_id, gc.short_name, gc.db_schema, gc.db_user, gc.db_pass, gc.db_host, gr.db_tables
-        from assignment x, agent a, geo_release gr, geo_config gc
-        where x.agent_id = a.id and x.geo_release_id = gr.id and x.geo_config_id = gc.id and a.uid = %s
-        '''
-    db.execute(sql, (agent_id,))
-    agent = db.fetchone()
+    agent = agent_release(db, agent_id)
     if agent is None:
         msg = {'status_message': 'Agent not found'}
         response.status = '404 Agent Not Found'
@@ -417,6 +517,7 @@ def create_transaction_log(agent_id, db):
     rowid = db.lastrowid
     if rowid:
         # db.commit()
+        record_state(db, [(transid, agent['geo_config_id'], 'AGENT_INIT', 'SUCCESS', timestamp)])
         # Return the transaction ID, db schema & credentials and list of tables to dump
         transurl = api_base + '/agent/' + agent_id + '/log/' + transid
         msg = {
@@ -444,11 +545,13 @@ def create_transaction_log(agent_id, db):
 def get_transaction_log(agent_id, logid, db):
     """
       GET a complete transaction log
+      Query Params:
+        after: <timestamp>,<entry id> of the last entry on the previous page
+        limit: page size
+        format: ndjson to stream one entry per line
     """
 
-    sql = 'select x.geo_config_id from assignment x, agent a where x.agent_id = a.id and a.uid = %s'
-    db.execute(sql, (agent_id,))
-    agent = db.fetchone()
+    agent = agent_assignment(db, agent_id)
     if agent is None:
         msg = {'status_message': 'Agent not found'}
         response.status = '404 Agent Not Found'
@@ -458,20 +561,117 @@ def get_transaction_log(agent_id, logid, db):
     parent = api_base + '/agent/' + agent_id + '/log'
     log = {'transactions': [], 'parent': parent}
 
-    sql = 'select id, tstamp, status, stage, message from log where transid = %s order by tstamp'
-    db.execute(sql, (logid,))
+    (after, limit, error) = page_request(2)
+    if error is None and after is not None:
+        after[0] = parse_timestamp(after[0])
+        if after[0] is None or not after[1].isdigit():
+            error = 'Invalid "after" parameter'
+    if error is not None:
+        msg = {'status_message': error}
+        response.status = '400 Invalid parameters'
+        response.content_type = 'application/json'
+        return msg
+
+    (sql, params) = ganymede_sql.transaction_log_query(log_tables(db), logid, after,
+                                                       None if limit is None else limit + 1)
+
+    def render(row):
+        stamp = row['tstamp']
+        return {'id': row['id'],
+                'stage': row['stage'],
+                'timestamp': stamp.isoformat(),
+                'status': row['status'],
+                'message': row['message']}
+
+    if request.query.format == 'ndjson':
+        return stream_rows(db, sql, params, render, limit)
+
+    db.execute(sql, params)
     # noinspection PyShadowingBuiltins
     for row in db:
-        stamp = row['tstamp']
-        trans = {'stage': row['stage'],
-                 'timestamp': stamp.isoformat(),
-                 'status': row['status'],
-                 'message': row['message']}
-        log['transactions'].append(trans)
+        if limit is not None and len(log['transactions']) == limit:
+            last = log['transactions'][-1]
+            log['next_url'] = next_page_url([last['timestamp'], str(last['id'])])
+            break
+        log['transactions'].append(render(row))
 
     return log
 
 
+# Defined before update_transaction_log: its <logid> pattern would also match "batch", and Bottle tries routes in
+# the order they were added.
+@route(api_base + '/agent/<agent_id:re:[a-zA-Z0-9-]+>/log/batch', method='POST')
+def create_log_batch(agent_id, db):
+    """
+      Add a batch of an agent's transaction log entries, for any number of its transactions, with a single insert.
+      The body is a JSON array (or {"events": [...]}) of objects with transid, stage, status, timestamp and
+      message, validated the same way as update_transaction_log: only AGENT_* stages, and only for transactions of
+      the GEO the agent is assigned to. Entries that fail validation are returned with their position in the
+      batch; the rest are written. Entries already in the log, as when a batch is sent again because its response
+      was lost, are counted as duplicates and not written again.
+    """
+    try:
+        events = request.json
+    except ValueError:
+        events = None
+    if isinstance(events, dict):
+        events = events.get('events')
+
+    if not isinstance(events, list) or len(events) == 0 or len(events) > max_batch_events:
+        msg = {'status_message': 'Expected a JSON array of 1 to ' + str(max_batch_events) + ' log entries'}
+        response.status = '403 Invalid Parameters'
+        response.content_type = 'application/json'
+        return msg
+
+    # validate the agent
+    agent = agent_assignment(db, agent_id)
+    if agent is None:
+        msg = {'status_message': 'Agent not found'}
+        response.status = '404 Agent Not Found'
+        response.content_type = 'application/json'
+        return msg
+
+    if not agent['enabled']:
+        msg = {'status_message': 'Agent disabled'}
+        response.status = '403 Agent Disabled'
+        response.content_type = 'application/json'
+        return msg
+
+    rejected = []
+    checked = []
+    for (index, event) in enumerate(events):
+        (timestamp, error) = check_log_event(event, agent_stages)
+        if error is None:
+            checked.append((index, event, timestamp))
+        else:
+            rejected.append({'index': index, 'status_message': error})
+
+    geos = transaction_geos(db, [event['transid'] for (index, event, timestamp) in checked])
+    entries = []
+    for (index, event, timestamp) in checked:
+        if event['transid'] not in geos:
+            rejected.append({'index': index, 'status_message': 'Transaction log not found'})
+            continue
+        if geos[event['transid']] != agent['geo_config_id']:
+            # another GEO's transaction: the agent may only log its own
+            rejected.append({'index': index, 'status_message': 'Transaction not assigned to this agent'})
+            continue
+        entries.append((event, timestamp, geos[event['transid']], None, None))
+
+    (accepted, duplicates) = write_log_batch(db, entries)
+
+    msg = {'accepted': accepted, 'duplicates': duplicates,
+           'rejected': sorted(rejected, key=lambda r: r['index'])}
+    if not accepted and not duplicates:
+        response.status = '403 Invalid Parameters'
+    elif rejected:
+        response.status = '207 Multi-Status'
+    else:
+        response.status = 201
+    response.content_type = 'application/json'
+    return msg
+
+
 @route(api_base + '/agent/<agent_id:re:[a-zA-Z0-9-]+>/log/<logid:re:[a-zA-Z0-9-]+>', method='POST')
 def update_transaction_log(agent_id, logid, db):
     """
@@ -490,16 +690,13 @@ def update_transaction_log(agent_id, logid, db):
         response.content_type = 'application/json'
         return msg
 
-    valid_stage = ['AGENT_INIT', 'AGENT_DUMP', 'AGENT_COMPRESS', 'AGENT_ENCRYPT', 'AGENT_TRANSFER', 'AGENT_END']
-    valid_status = ['SUCCESS', 'WARNING', 'FAIL', 'FATAL']
-
-    if stage.upper() not in valid_stage:
+    if stage.upper() not in agent_stages:
         msg = {'status_message': 'Invalid stage'}
         response.status = '403 Invalid Parameters'
         response.content_type = 'application/json'
         return msg
 
-    if status.upper() not in valid_status:
+    if status.upper() not in log_statuses:
         msg = {'status_message': 'Invalid status'}
         response.status = '403 Invalid Parameters'
         response.content_type = 'application/json'
@@ -523,32 +720,33 @@ def update_transaction_log(agent_id, logid, db):
         return msg
 
     # validate the agent
-    sql = 'select x.geo_config_id from assignment x, agent a where x.agent_id = a.id and a.uid = %s'
-    db.execute(sql, (agent_id,))
-    agent = db.fetchone()
+    agent = agent_assignment(db, agent_id)
     if agent is None:
         msg = {'status_message': 'Agent not found'}
         response.status = '404 Agent Not Found'
         response.content_type = 'application/json'
         return msg
 
-    # make sure the transaction exists by checking for the INIT entry
-    sql = '''
-        select id from log where transid = %s and stage = "AGENT_INIT"
-        '''
-    db.execute(sql, (logid,))
-    junk = db.fetchone()
-    if junk is None:
+    # make sure the transaction exists
+    if transaction_state(db, logid) is None:
         msg = {'status_message': 'Transaction log not found'}
         response.status = '404 Transaction Log Not Found'
         response.content_type = 'application/json'
         return msg
 
+    if (logid, stage.upper(), status.upper(), timestamp, message) in logged_events(db, [logid]):
+        # a retry of an entry that was written, but whose response never reached the agent
+        response.status = 201
+        return
+
     sql = 'insert into log (transid, geo, stage, status, tstamp, message) values (%s, %s, %s, %s, %s, %s)'
     db.execute(sql, (logid, agent['geo_config_id'], stage, status, timestamp.isoformat(), message))
     rowid = db.lastrowid
     if rowid:
         # db.commit()
+        record_state(db, [(logid, agent['geo_config_id'], stage.upper(), status.upper(), timestamp)])
+        # only once committed, or Jupiter may scan before the entry is visible and sleep through it
+        after_commit(lambda: notify_jupiter(logid, stage, status))
         response.status = 201
     else:
         msg = {'status_message': 'Failed to update transaction log'}
@@ -565,38 +763,8 @@ def upload_dump(agent_id, logid, db):
         POST an encrypted+compressed MySQL dump
     """
 
-    # validate the agent
-    sql = 'select x.geo_config_id from assignment x, agent a where x.agent_id = a.id and a.uid = %s'
-    db.execute(sql, (agent_id,))
-    agent = db.fetchone()
-    if agent is None:
-        msg = {'status_message': 'Agent not found'}
-        response.status = '404 Agent Not Found'
-        response.content_type = 'application/json'
-        return msg
-
-    # make sure the transaction exists by checking for the INIT entry
-    sql = '''
-        select id from log where transid = %s and stage = "AGENT_INIT"
-        '''
-    db.execute(sql, (logid,))
-    junk = db.fetchone()
-    if junk is None:
-        msg = {'status_message': 'Transaction log not found'}
-        response.status = '404 Transaction Log Not Found'
-        response.content_type = 'application/json'
-        return msg
-
-    # make sure the transaction has not already been completed
-    sql = '''
-        select id from log where transid = %s and stage = "AGENT_END" and status = "SUCCESS"
-        '''
-    db.execute(sql, (logid,))
-    junk = db.fetchone()
-    if junk is not None:
-        msg = {'status_message': 'Transaction closed'}
-        response.status = '404 Transaction Closed'
-        response.content_type = 'application/json'
+    msg = check_transfer(agent_id, logid, db)
+    if msg is not None:
         return msg
 
     # process the upload
@@ -627,6 +795,175 @@ def upload_dump(agent_id, logid, db):
 
     return
 
+
+@route(api_base + '/agent/<agent_id:re:[a-zA-Z0-9-]+>/transfer/<logid:re:[a-zA-Z0-9-]+>', method='GET')
+def get_transfer_status(agent_id, logid, db):
+    """
+        GET the number of bytes received so far for a chunked dump upload
+        Query Params:
+          filename: the name of the encrypted dump file
+    """
+
+    filename = request.query.filename
+    if not valid_dump_name(filename):
+        msg = {'status_message': 'Invalid dump format'}
+        response.status = '400 Invalid Dump'
+        response.content_type = 'application/json'
+        return msg
+
+    # validate the agent
+    agent = agent_assignment(db, agent_id)
+    if agent is None:
+        msg = {'status_message': 'Agent not found'}
+        response.status = '404 Agent Not Found'
+        response.content_type = 'application/json'
+        return msg
+
+    part_file = os.path.join(data_dir, filename + '.part')
+    dump_file = os.path.join(data_dir, filename)
+    msg = {'filename': filename, 'bytes_received': 0, 'complete': False}
+
+    sql = 'select filename from upload where transid = %s'
+    db.execute(sql, (logid,))
+    upload = db.fetchone()
+    if upload is not None and upload['filename'] == filename and os.path.exists(dump_file):
+        msg['bytes_received'] = os.path.getsize(dump_file)
+        msg['complete'] = True
+    elif os.path.exists(part_file):
+        msg['bytes_received'] = os.path.getsize(part_file)
+
+    return msg
+
+
+@route(api_base + '/agent/<agent_id:re:[a-zA-Z0-9-]+>/transfer/<logid:re:[a-zA-Z0-9-]+>', method='PUT')
+def upload_dump_chunk(agent_id, logid, db):
+    """
+        PUT one chunk of an encrypted+compressed MySQL dump
+        Query Params:
+          filename: the name of the encrypted dump file
+        Headers:
+          Content-Range: "bytes <first>-<last>/<total>" for a chunk. <total> may be "*" while the size is unknown.
+                         "bytes */<total>" with an empty body completes an upload of <total> bytes.
+          Content-MD5: base64-encoded MD5 digest of the chunk
+
+        Chunks are written straight into the upload directory at their offset. A chunk may start anywhere up to the
+        number of bytes already received, so a failed chunk can simply be sent again. The upload is complete once
+        a chunk (or an empty completion request) reaches <total> bytes.
+    """
+
+    filename = request.query.filename
+    if not valid_dump_name(filename):
+        msg = {'status_message': 'Invalid dump format'}
+        response.status = '400 Invalid Dump'
+        response.content_type = 'application/json'
+        return msg
+
+    content_range = request.get_header('Content-Range', '')
+    chunk_range = re.match(r'^bytes (\d+)-(\d+)/(\d+|\*)$', content_range)
+    final_range = re.match(r'^bytes \*/(\d+)$', content_range)
+    if chunk_range:
+        offset = int(chunk_range.group(1))
+        length = int(chunk_range.group(2)) - offset + 1
+        total = chunk_range.group(3)
+        checksum = request.get_header('Content-MD5', '')
+        if length <= 0 or request.content_length != length or not checksum:
+            msg = {'status_message': 'Invalid chunk'}
+            response.status = '400 Invalid Chunk'
+            response.content_type = 'application/json'
+            return msg
+    elif final_range:
+        offset = int(final_range.group(1))
+        length = 0
+        total = final_range.group(1)
+        checksum = ''
+    else:
+        msg = {'status_message': 'Invalid Content-Range'}
+        response.status = '400 Invalid Chunk'
+        response.content_type = 'application/json'
+        return msg
+
+    msg = check_transfer(agent_id, logid, db)
+    if msg is not None:
+        return msg
+
+    dump_file = os.path.join(data_dir, filename)
+    if total != '*' and offset + length <= int(total) and os.path.isfile(dump_file) \
+            and os.path.getsize(dump_file) == int(total):
+        # a retry of the chunk that completed the upload: the .part file is already gone, so do not start a new one
+        response.set_header('X-Ganymede-Bytes-Received', total)
+        return complete_upload(db, logid, filename, int(total))
+
+    part_file = dump_file + '.part'
+    try:
+        fd = os.open(part_file, os.O_RDWR | os.O_CREAT, 0o640)
+    except OSError:
+        msg = {'status_message': 'Error writing dump file to storage'}
+        response.status = '400 Write Error'
+        response.content_type = 'application/json'
+        return msg
+
+    with os.fdopen(fd, 'r+b') as part:
+        try:
+            # one writer per upload
+            fcntl.flock(part.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            msg = {'status_message': 'Upload already in progress'}
+            response.status = '409 Upload In Progress'
+            response.content_type = 'application/json'
+            return msg
+
+        received = os.fstat(part.fileno()).st_size
+        response.set_header('X-Ganymede-Bytes-Received', str(received))
+        if offset > received:
+            msg = {'status_message': 'Chunk does not start within the data received', 'bytes_received': received}
+            response.status = '416 Range Not Satisfiable'
+            response.content_type = 'application/json'
+            return msg
+
+        if length > 0:
+            # read the body directly from the client and write it in place, checking the digest as we go
+            part.seek(offset)
+            part.truncate()
+            digest = md5()
+            body = request.environ['wsgi.input']
+            remaining = length
+            while remaining > 0:
+                block = body.read(min(remaining, 65536))
+                if not block:
+                    break
+                digest.update(block)
+                part.write(block)
+                remaining -= len(block)
+
+            if remaining > 0 or b64encode(digest.digest()) != checksum.encode('ascii'):
+                # throw away the partial or corrupt chunk so the agent can resend it
+                part.seek(offset)
+                part.truncate()
+                response.set_header('X-Ganymede-Bytes-Received', str(offset))
+                msg = {'status_message': 'Chunk incomplete or checksum mismatch', 'bytes_received': offset}
+                response.status = '400 Invalid Chunk'
+                response.content_type = 'application/json'
+                return msg
+
+            part.flush()
+            received = offset + length
+            response.set_header('X-Ganymede-Bytes-Received', str(received))
+
+        if total == '*' or received < int(total):
+            response.status = 202
+            return {'filename': filename, 'bytes_received': received, 'complete': False}
+
+        if received != int(total):
+            msg = {'status_message': 'Upload size mismatch', 'bytes_received': received}
+            response.status = '400 Invalid Chunk'
+            response.content_type = 'application/json'
+            return msg
+
+        # Upload complete. Renaming does not copy the data, and workers only ever see the complete file.
+        os.rename(part_file, dump_file)
+
+    return complete_upload(db, logid, filename, received)
+
 '''
 Start of WORKER APIs
 '''
@@ -639,30 +976,21 @@ def get_worker_details(logid, db):
     """
 
     # start by verifying that the transaction contains an AGENT_END event and is SUCCESS
-    sql = '''
-        select status from log where transid = %s and stage = 'AGENT_END'
-        '''
-    db.execute(sql, (logid,))
-    log = db.fetchone()
-    if log is None:
+    state = transaction_state(db, logid)
+    if state is None or state['agent_status'] is None:
         msg = {'status_message': 'Invalid Transaction'}
         response.status = '404 Transaction Not Found'
         response.content_type = 'application/json'
         return msg
 
-    if log['status'] != 'SUCCESS':
+    if state['agent_status'] != 'SUCCESS':
         msg = {'status_message': 'Transaction was not successful'}
         response.status = '404 Transaction Not Successful'
         response.content_type = 'application/json'
         return msg
 
     # now, pull out the data the worker requires
-    sql = '''
-        select u.filename, l.nonce
-        from upload u, log l
-        where l.transid = %s and l.stage = 'AGENT_INIT' and u.transid = l.transid
-        '''
-    db.execute(sql, (logid,))
+    db.execute(ganymede_sql.WORKER_DETAILS, (logid,))
     worker = db.fetchone()
     if worker is None:
         msg = {'status_message': 'Transaction not found'}
@@ -696,19 +1024,15 @@ def manage_worker_schema(logid, db):
         response.content_type = 'application/json'
         return msg
 
-    # start by verifying that the most recent transaction contains an WORKER_INIT event and is SUCCESS
-    sql = '''
-        select status, tstamp from log where transid = %s and stage = 'WORKER_INIT' order by tstamp desc limit 1
-        '''
-    db.execute(sql, (logid,))
-    log = db.fetchone()
-    if log is None:
+    # start by verifying that the most recent WORKER_INIT event of the transaction is SUCCESS
+    state = transaction_state(db, logid)
+    if state is None or state['worker_status'] is None:
         msg = {'status_message': 'Invalid Transaction'}
         response.status = '404 Transaction Not Found'
         response.content_type = 'application/json'
         return msg
 
-    if log['status'] != 'SUCCESS':
+    if state['worker_status'] != 'SUCCESS':
         msg = {'status_message': 'Invalid Transaction'}
         response.status = '404 Transaction Not Found'
         response.content_type = 'application/json'
@@ -721,6 +1045,63 @@ def manage_worker_schema(logid, db):
     return msg
 
 
+# Defined before update_worker_transaction_log, whose <logid> pattern would also match "batch"
+@route(api_base + '/worker/log/batch', method='POST')
+def create_worker_log_batch(db):
+    """
+      Add a batch of worker transaction log entries with a single insert. The body is a JSON array (or
+      {"events": [...]}) of objects with transid, stage, status, timestamp and message, plus host and pid on a
+      WORKER_INIT entry, validated the same way as update_worker_transaction_log. Entries that fail validation are
+      returned with their position in the batch; the rest are written, except for entries already in the log.
+    """
+    try:
+        events = request.json
+    except ValueError:
+        events = None
+    if isinstance(events, dict):
+        events = events.get('events')
+
+    if not isinstance(events, list) or len(events) == 0 or len(events) > max_batch_events:
+        msg = {'status_message': 'Expected a JSON array of 1 to ' + str(max_batch_events) + ' log entries'}
+        response.status = '403 Invalid Parameters'
+        response.content_type = 'application/json'
+        return msg
+
+    rejected = []
+    checked = []
+    for (index, event) in enumerate(events):
+        (timestamp, error) = check_log_event(event, worker_stages)
+        if error is None:
+            checked.append((index, event, timestamp))
+        else:
+            rejected.append({'index': index, 'status_message': error})
+
+    geos = transaction_geos(db, [event['transid'] for (index, event, timestamp) in checked])
+    entries = []
+    for (index, event, timestamp) in checked:
+        if event['transid'] not in geos:
+            rejected.append({'index': index, 'status_message': 'Transaction log not found'})
+            continue
+        worker_pid = event.get('pid')
+        if not isinstance(worker_pid, string_types) or not worker_pid.isdigit():
+            worker_pid = None
+        worker_host = event.get('host') if isinstance(event.get('host'), string_types) else None
+        entries.append((event, timestamp, geos[event['transid']], worker_host, worker_pid))
+
+    (accepted, duplicates) = write_log_batch(db, entries)
+
+    msg = {'accepted': accepted, 'duplicates': duplicates,
+           'rejected': sorted(rejected, key=lambda r: r['index'])}
+    if not accepted and not duplicates:
+        response.status = '403 Invalid Parameters'
+    elif rejected:
+        response.status = '207 Multi-Status'
+    else:
+        response.status = 201
+    response.content_type = 'application/json'
+    return msg
+
+
 @route(api_base + '/worker/log/<logid:re:[a-zA-Z0-9-]+>', method='POST')
 def update_worker_transaction_log(logid, db):
     """
@@ -739,25 +1120,13 @@ def update_worker_transaction_log(logid, db):
         response.content_type = 'application/json'
         return msg
 
-    valid_stage = ['WORKER_INIT',
-                   'WORKER_DECRYPT',
-                   'WORKER_DECOMPRESS',
-                   'WORKER_SCHEMA',
-                   'WORKER_LOAD',
-                   'WORKER_ETL',
-                   'WORKER_END']
-    valid_status = ['SUCCESS',
-                    'WARNING',
-                    'FAIL',
-                    'FATAL']
-
-    if stage.upper() not in valid_stage:
+    if stage.upper() not in worker_stages:
         msg = {'status_message': 'Invalid stage'}
         response.status = '403 Invalid Parameters'
         response.content_type = 'application/json'
         return msg
 
-    if status.upper() not in valid_status:
+    if status.upper() not in log_statuses:
         msg = {'status_message': 'Invalid status'}
         response.status = '403 Invalid Parameters'
         response.content_type = 'application/json'
@@ -780,23 +1149,32 @@ def update_worker_transaction_log(logid, db):
         response.content_type = 'application/json'
         return msg
 
-    # make sure the transaction exists by checking for the INIT entry
-    sql = '''
-        select geo from log where transid = %s and stage = "AGENT_INIT"
-        '''
-    db.execute(sql, (logid,))
-    geo = db.fetchone()
+    # make sure the transaction exists
+    geo = transaction_state(db, logid)
     if geo is None:
         msg = {'status_message': 'Transaction log not found'}
         response.status = '404 Transaction Log Not Found'
         response.content_type = 'application/json'
         return msg
 
+    if (logid, stage.upper(), status.upper(), timestamp, message) in logged_events(db, [logid]):
+        # a retry of an entry that was written, but whose response never reached the worker
+        response.status = 201
+        return
+
+    # workers identify themselves when they start, so a stalled worker can be found
+    worker_host = request.forms.get('host')
+    worker_pid = request.forms.get('pid')
+    if worker_pid is not None and not worker_pid.isdigit():
+        worker_pid = None
+
     sql = 'insert into log (transid, geo, stage, status, tstamp, message) values (%s, %s, %s, %s, %s, %s)'
     db.execute(sql, (logid, geo['geo'], stage, status, timestamp.isoformat(), message))
     rowid = db.lastrowid
     if rowid:
         # db.commit()
+        record_state(db, [(logid, geo['geo'], stage.upper(), status.upper(), timestamp)], worker_host, worker_pid)
+        after_commit(lambda: notify_jupiter(logid, stage, status))
         response.status = 201
     else:
         msg = {'status_message': 'Failed to update transaction log'}
@@ -807,10 +1185,685 @@ def update_worker_transaction_log(logid, db):
     return
 
 
+@route(api_base + '/worker/heartbeat/<logid:re:[a-zA-Z0-9-]+>', method='POST')
+def update_worker_progress(logid, db):
+    """
+      Record that a worker is still making progress on a long stage. Workers only log when a stage completes, and
+      Jupiter takes a worker that has neither logged nor made progress for a while to be stalled. The time goes
+      into its own column: moving "updated" would make record_state treat the next log entry as out of order.
+    """
+    if transaction_state(db, logid) is None:
+        msg = {'status_message': 'Transaction log not found'}
+        response.status = '404 Transaction Log Not Found'
+        response.content_type = 'application/json'
+        return msg
+
+    db.execute('update transaction_state set progress = utc_timestamp() where transid = %s', (logid,))
+    msg = {'status_message': 'Progress recorded'}
+    return msg
+
+
 ''' Utility functions
     Internal functions, not APIs
 '''
 
+
+def page_request(fields):
+    """
+    Read the keyset pagination query parameters
+    :param fields: number of comma-separated values expected in "after"
+    :return: tuple of (list of "after" values or None, page size or None, error message or None)
+    """
+    after = None
+    limit = None
+    if request.query.after:
+        after = request.query.after.split(',', fields - 1)
+        if len(after) != fields or '' in after:
+            return None, None, 'Invalid "after" parameter'
+    if request.query.limit:
+        if not request.query.limit.isdigit() or not 1 <= int(request.query.limit) <= max_page_size:
+            return None, None, '"limit" must be between 1 and ' + str(max_page_size)
+        limit = int(request.query.limit)
+    return after, limit, None
+
+
+def next_page_url(after):
+    """
+    :param after: list of the key values of the last row on this page
+    :return: URL of the next page: this request with "after" moved on
+    """
+    query = dict(request.query.items())
+    query['after'] = ','.join([str(v) for v in after])
+    return request.path + '?' + urlencode(sorted(query.items()))
+
+
+def parse_timestamp(value):
+    """
+    :param value: timestamp in the format the APIs return (YYYY-MM-DDTHH:MM:SS)
+    :return: datetime object, or None if the value is not a valid timestamp
+    """
+    if not re.match(r'^\d\d\d\d-\d\d-\d\dT\d\d:\d\d:\d\d$', value):
+        return None
+    try:
+        return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S")
+    except ValueError:
+        return None
+
+
+def stream_rows(db, sql, params, render, limit=None):
+    """
+    Stream query results as newline-delimited JSON. The rows are read with an unbuffered cursor, so memory use does
+    not grow with the size of the result.
+    :param db: database cursor (its connection is used for the unbuffered cursor)
+    :param sql: query to run
+    :param params: query parameters
+    :param render: function turning a row into the dict to send
+    :param limit: maximum number of rows to send, or None for all of them
+    :return: generator of response lines
+    """
+    def lines():
+        cur = db.connection.cursor(MySQLdb.cursors.SSDictCursor)
+        try:
+            cur.execute(sql, params)
+            sent = 0
+            for row in cur:
+                if limit is not None and sent == limit:
+                    break
+                yield json.dumps(render(row)) + '\n'
+                sent += 1
+        finally:
+            cur.close()
+
+    response.content_type = 'application/x-ndjson'
+    return lines()
+
+
+def check_log_event(event, stages):
+    """
+    Validate one entry of a log batch the way update_transaction_log validates its form parameters
+    :param event: dict from the request body
+    :param stages: list of the stages that may be logged
+    :return: tuple of (timestamp as a datetime, None) or (None, error message)
+    """
+    if not isinstance(event, dict):
+        return None, 'Invalid parameters'
+    for key in ('transid', 'stage', 'status', 'timestamp', 'message'):
+        if not isinstance(event.get(key), string_types):
+            return None, 'Invalid parameters'
+
+    if not re.match(r'^[a-zA-Z0-9-]+$', event['transid']):
+        return None, 'Invalid transaction ID'
+
+    if event['stage'].upper() not in stages:
+        return None, 'Invalid stage'
+
+    if event['status'].upper() not in log_statuses:
+        return None, 'Invalid status'
+
+    if not re.match(r'\d\d\d\d-\d\d-\d\dT\d\d:\d\d:\d\d', event['timestamp']):
+        return None, 'Invalid timestamp'
+    try:
+        timestamp = datetime.strptime(event['timestamp'][:19], "%Y-%m-%dT%H:%M:%S")
+    except ValueError:
+        return None, 'Invalid timestamp'
+
+    if len(event['message']) == 0:
+        return None, 'Invalid message'
+
+    return timestamp, None
+
+
+def logged_events(db, transids):
+    """
+    The entries already in the log for some transactions. A client that lost the response to a post it made sends
+    the same entries again, and they must not be written (or counted in transaction_state) twice. An entry is
+    identified by its transaction, stage, status, timestamp and message.
+    :param db: database cursor
+    :param transids: list of transaction IDs
+    :return: set of (transid, STAGE, STATUS, tstamp, message) tuples, tstamp as a datetime
+    """
+    transids = list(set(transids))
+    if not transids:
+        return set()
+    db.execute(*ganymede_sql.logged_events_query(transids))
+    return set([(row['transid'], row['stage'].upper(), row['status'].upper(), row['tstamp'], row['message'])
+                for row in db.fetchall()])
+
+
+def transaction_geos(db, transids):
+    """
+    One lookup for the GEO of every transaction in a log batch
+    :param db: database cursor
+    :param transids: list of transaction IDs
+    :return: dict of transaction ID to GEO, for the transactions that exist
+    """
+    geos = {}
+    transids = list(set(transids))
+    if transids:
+        sql = 'select transid, geo from transaction_state where transid in ({0})'.format(
+            ', '.join(['%s'] * len(transids)))
+        db.execute(sql, tuple(transids))
+        for row in db.fetchall():
+            geos[row['transid']] = row['geo']
+    return geos
+
+
+def write_log_batch(db, entries):
+    """
+    Write validated log entries with a single insert and fold them into transaction_state, leaving out those
+    already in the log
+    :param db: database cursor
+    :param entries: list of (event, timestamp, geo, worker host, worker pid) tuples, in the order they were posted
+    :return: tuple of (number of entries written, number of entries already logged)
+    """
+    logged = logged_events(db, [event['transid'] for (event, timestamp, geo, host, pid) in entries])
+    params = []
+    written = []
+    states = []
+    for (event, timestamp, geo, host, pid) in entries:
+        key = (event['transid'], event['stage'].upper(), event['status'].upper(), timestamp, event['message'])
+        if key in logged:
+            continue
+        # the same entry twice in one batch is written once
+        logged.add(key)
+        params.extend([event['transid'], geo, event['stage'], event['status'], timestamp.isoformat(),
+                       event['message']])
+        states.append(((event['transid'], geo, key[1], key[2], timestamp), (host, pid)))
+        written.append(event)
+
+    if not written:
+        return 0, len(entries)
+
+    sql = 'insert into log (transid, geo, stage, status, tstamp, message) values ' + \
+          ', '.join(['(%s, %s, %s, %s, %s, %s)'] * len(written))
+    db.execute(sql, tuple(params))
+
+    # record_state takes one worker host and pid for all its entries, so start a new call when a WORKER_INIT
+    # entry names another worker
+    run = []
+    worker = (None, None)
+    for (state, owner) in states:
+        if state[2] == 'WORKER_INIT' and owner != worker:
+            if run:
+                record_state(db, run, *worker)
+            run = []
+            worker = owner
+        run.append(state)
+    record_state(db, run, *worker)
+
+    def notify():
+        for entry in written:
+            notify_jupiter(entry['transid'], entry['stage'], entry['status'])
+    after_commit(notify)
+    return len(written), len(entries) - len(written)
+
+
+class PoolPlugin(object):
+    """
+    Bottle plugin that hands each request a dict cursor on a pooled connection, in place of bottle_mysql (which
+    opens a new connection for every request). Like bottle_mysql, it commits when the handler returns, turns
+    integrity errors into a 409 and only applies to handlers that take the "db" keyword.
+    """
+    name = 'mysql'
+    api = 2
+
+    def __init__(self, pool, keyword='db', autocommit=True):
+        self.pool = pool
+        self.keyword = keyword
+        self.autocommit = autocommit
+
+    def setup(self, app):
+        for other in app.plugins:
+            if getattr(other, 'keyword', None) == self.keyword and other is not self:
+                raise bottle.PluginError('Found another plugin with conflicting settings (non-unique keyword).')
+
+    def apply(self, callback, route):
+        if self.keyword not in route.get_callback_args():
+            return callback
+
+        def wrapper(*args, **kwargs):
+            try:
+                conn = self.pool.acquire()
+            except PoolExhausted as err:
+                raise HTTPError(503, 'Database unavailable', err)
+            except MySQLdb.Error as err:
+                raise HTTPError(503, 'Database unavailable', err)
+
+            discard = False
+            cur = conn.cursor(MySQLdb.cursors.DictCursor)
+            kwargs[self.keyword] = cur
+            try:
+                rv = callback(*args, **kwargs)
+                if self.autocommit:
+                    conn.commit()
+                    for hook in request.environ.pop('ganymede.after_commit', []):
+                        hook()
+                if isinstance(rv, GeneratorType):
+                    # a streamed response reads from the connection while it is written out, so the connection
+                    # goes back to the pool when the stream ends rather than now
+                    rv = self.stream(rv, conn, cur)
+                    conn = None
+            except MySQLdb.IntegrityError as err:
+                conn.rollback()
+                raise HTTPError(409, 'Database Error', err)
+            except HTTPResponse:
+                if self.autocommit:
+                    conn.commit()
+                    for hook in request.environ.pop('ganymede.after_commit', []):
+                        hook()
+                raise
+            except (MySQLdb.OperationalError, MySQLdb.InterfaceError):
+                # the connection itself is suspect, so do not hand it to another request
+                discard = True
+                raise
+            finally:
+                if conn is not None:
+                    cur.close()
+                    self.pool.release(conn, discard)
+            return rv
+
+        return wrapper
+
+    def stream(self, chunks, conn, cur):
+        """
+        Pass a streamed response through, returning its connection to the pool once it is finished (or the
+        client goes away)
+        """
+        discard = False
+        try:
+            for chunk in chunks:
+                yield chunk
+        except (MySQLdb.OperationalError, MySQLdb.InterfaceError):
+            discard = True
+            raise
+        finally:
+            cur.close()
+            self.pool.release(conn, discard)
+
+
+class TTLCache(object):
+    """
+    Thread-safe dict with a time-to-live on every entry and least-recently-used eviction once it holds max_size
+    entries. Counts hits, misses, evictions and invalidations.
+    """
+
+    def __init__(self, max_size=1000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expiry time, value), least recently used first
+        self.lock = Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'expired': 0, 'evicted': 0, 'invalidated': 0}
+
+    def get(self, key):
+        """
+        :param key: cache key
+        :return: the cached value, or None if it is missing or expired
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.counters['misses'] += 1
+                return None
+            if entry[0] < time():
+                self.counters['expired'] += 1
+                self.counters['misses'] += 1
+                return None
+            # re-inserting moves the key to the most recently used end
+            self.entries[key] = entry
+            self.counters['hits'] += 1
+            return entry[1]
+
+    def put(self, key, value):
+        """
+        :param key: cache key
+        :param value: value to cache (None is not cached)
+        """
+        if value is None:
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time() + self.ttl, value)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.counters['evicted'] += 1
+
+    def invalidate(self, key):
+        """
+        :param key: cache key to drop
+        """
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self.counters['invalidated'] += 1
+
+    def stats(self):
+        """
+        :return: dict of cache metrics
+        """
+        with self.lock:
+            stats = dict(self.counters)
+            stats['size'] = len(self.entries)
+            stats['max_size'] = self.max_size
+            stats['ttl'] = self.ttl
+        return stats
+
+
+class ConditionalPlugin(object):
+    """
+    Bottle plugin for read-only resources polled by dashboards and monitoring. Routes opt in with
+    conditional=True. Responses carry an ETag made from the API version (see api_version); a request whose
+    If-None-Match matches gets a 304 before a database connection is taken. With a response cache configured,
+    successful responses are kept for the current version and served without running the handler.
+    Install it before PoolPlugin so it wraps the database plugin.
+    """
+    name = 'conditional'
+    api = 2
+
+    def apply(self, callback, route):
+        if not route.config.get('conditional'):
+            return callback
+
+        def wrapper(*args, **kwargs):
+            version = api_version()
+            if not version:
+                return callback(*args, **kwargs)
+
+            etag = '"' + version + '"'
+            tags = [t.strip() for t in request.headers.get('If-None-Match', '').split(',')]
+            if etag in tags or 'W/' + etag in tags or '*' in tags:
+                raise HTTPResponse(status=304, headers={'ETag': etag})
+
+            key = (request.path, request.query_string, version)
+            cached = response_cache.get(key) if response_cache is not None else None
+            if cached is not None:
+                (body, headers) = cached
+                for (name, value) in headers:
+                    response.set_header(name, value)
+                response.set_header('ETag', etag)
+                return body
+
+            rv = callback(*args, **kwargs)
+            if response.status_code == 200 and isinstance(rv, dict):
+                response.set_header('ETag', etag)
+                if response_cache is not None:
+                    headers = [(n, v) for (n, v) in response.headerlist if n.startswith('X-Ganymede')]
+                    response_cache.put(key, (rv, headers))
+            return rv
+
+        return wrapper
+
+
+def api_version():
+    """
+    The API version changes whenever an agent or an assignment is changed through the API. It lives in a small
+    file so every API process (and every gunicorn worker) sees the same value without querying MySQL.
+    :return: the current version string, or '' if versioning is not configured
+    """
+    if not version_file:
+        return ''
+    try:
+        with open(version_file, 'r') as fp:
+            return fp.read().strip()
+    except (IOError, OSError):
+        return ''
+
+
+def bump_api_version():
+    """
+    Write a new API version, replacing the file atomically so readers never see a partial value
+    """
+    if not version_file:
+        return
+    tmp_file = version_file + '.' + str(os.getpid())
+    try:
+        with open(tmp_file, 'w') as fp:
+            fp.write('{0:x}-{1:x}'.format(int(time() * 1000000), os.getpid()))
+        os.rename(tmp_file, version_file)
+    except (IOError, OSError) as err:
+        print(datetime.utcnow().isoformat(' ') + ' : Unable to update the API version: ' + str(err))
+
+
+def after_commit(hook):
+    """
+    Run a function once the current request's transaction has been committed, so nothing that runs it can read
+    the data as it was before the change
+    :param hook: function taking no arguments
+    """
+    request.environ.setdefault('ganymede.after_commit', []).append(hook)
+
+
+def agent_assignment(db, agent_id):
+    """
+    Look up an agent and its GEO assignment, from the cache when possible
+    :param db: database cursor
+    :param agent_id: the agent's uid
+    :return: dict with the agent id, enabled flag and geo_config_id, or None if the agent does not exist or is not
+        assigned
+    """
+    key = ('assignment', agent_id, api_version())
+    agent = agent_cache.get(key) if agent_cache is not None else None
+    if agent is None:
+        sql = '''
+            select a.id, a.enabled, x.geo_config_id from agent a, assignment x where x.agent_id = a.id and a.uid = %s
+            '''
+        db.execute(sql, (agent_id,))
+        agent = db.fetchone()
+        if agent_cache is not None:
+            agent_cache.put(key, agent)
+    return agent
+
+
+def agent_release(db, agent_id):
+    """
+    Look up an agent's GEO, its database settings and the tables to dump for its release, from the cache when
+    possible
+    :param db: database cursor
+    :param agent_id: the agent's uid
+    :return: dict of GEO and release details, or None if the agent does not exist or is not assigned
+    """
+    key = ('release', agent_id, api_version())
+    agent = agent_cache.get(key) if agent_cache is not None else None
+    if agent is None:
+        sql = '''
+            select x.geo_config_id, gc.short_name, gc.db_schema, gc.db_user, gc.db_pass, gc.db_host, gr.db_tables
+            from assignment x, agent a, geo_release gr, geo_config gc
+            where x.agent_id = a.id and x.geo_release_id = gr.id and x.geo_config_id = gc.id and a.uid = %s
+            '''
+        db.execute(sql, (agent_id,))
+        agent = db.fetchone()
+        if agent_cache is not None:
+            agent_cache.put(key, agent)
+    return agent
+
+
+def invalidate_agent(agent_id):
+    """
+    Move the API version on, and drop what this process cached for the agent. Called by the APIs that change agents
+    or their assignments. Cached lookups are keyed by the API version, so the new version is a miss in every API
+    process, not just this one. Changes made to geo_config or geo_release outside the API are picked up when the
+    entries expire.
+    :param agent_id: the agent's uid
+    """
+    def invalidate():
+        if agent_cache is not None:
+            version = api_version()
+            agent_cache.invalidate(('assignment', agent_id, version))
+            agent_cache.invalidate(('release', agent_id, version))
+        bump_api_version()
+
+    invalidate()
+    # and again once the change is committed, in case another request cached the old rows in the meantime
+    after_commit(invalidate)
+
+
+def connect_ganymede(settings):
+    """
+    :param settings: the ganymede.json settings dict
+    :return: function that opens a new connection to the Ganymede schema, for ConnectionPool
+    """
+    def connect():
+        conn = MySQLdb.connect(host=settings['db_host'], user=settings['db_user'], passwd=settings['db_pass'],
+                               db=settings['db_schema'], charset=settings['db_charset'])
+        cur = conn.cursor()
+        cur.execute('set time_zone = %s', (settings['db_timezone'],))
+        cur.close()
+        return conn
+
+    return connect
+
+
+def check_transfer(agent_id, logid, db):
+    """
+    Make sure a dump may be uploaded for a transaction
+    :param agent_id: the agent uploading the dump
+    :param logid: the transaction ID
+    :param db: database cursor
+    :return: None if the upload may proceed, otherwise an error message (the response status is already set)
+    """
+
+    # validate the agent
+    agent = agent_assignment(db, agent_id)
+    if agent is None:
+        msg = {'status_message': 'Agent not found'}
+        response.status = '404 Agent Not Found'
+        response.content_type = 'application/json'
+        return msg
+
+    # make sure the transaction exists
+    state = transaction_state(db, logid)
+    if state is None:
+        msg = {'status_message': 'Transaction log not found'}
+        response.status = '404 Transaction Log Not Found'
+        response.content_type = 'application/json'
+        return msg
+
+    # make sure the transaction has not already been completed
+    if state['agent_status'] == 'SUCCESS':
+        msg = {'status_message': 'Transaction closed'}
+        response.status = '404 Transaction Closed'
+        response.content_type = 'application/json'
+        return msg
+
+    return None
+
+
+def complete_upload(db, logid, filename, received):
+    """
+    Record a completed dump upload
+    :param db: database cursor
+    :param logid: the transaction ID
+    :param filename: the name of the encrypted dump file
+    :param received: size of the dump
+    :return: response message
+    """
+    # write an entry to the database. Use REPLACE to support multiple upload attempts
+    sql = 'replace into upload (transid, filename) values (%s, %s)'
+    db.execute(sql, (logid, filename))
+    # db.commit()
+    response.status = 201
+    return {'filename': filename, 'bytes_received': received, 'complete': True}
+
+
+def transaction_state(db, transid):
+    """
+    :param db: database cursor
+    :param transid: the transaction ID
+    :return: the transaction's row from transaction_state, or None if the transaction does not exist
+    """
+    db.execute(ganymede_sql.TRANSACTION_STATE, (transid,))
+    return db.fetchone()
+
+
+def record_state(db, entries, worker_host=None, worker_pid=None):
+    """
+    Fold new log entries into transaction_state. Called right after the log insert, in the same database
+    transaction, so the state always matches the log.
+    :param db: database cursor
+    :param entries: list of (transid, geo, stage, status, tstamp) tuples, in the order they were logged
+    :param worker_host: host name the worker reported, if any
+    :param worker_pid: process ID the worker reported, if any
+    """
+    params = []
+    for (transid, geo, stage, status, tstamp) in entries:
+        worker_start = stage == 'WORKER_INIT'
+        params.extend([transid, geo, stage, status,
+                       status if stage == 'AGENT_END' else None,
+                       status if worker_start else None,
+                       worker_host if worker_start else None,
+                       worker_pid if worker_start else None,
+                       1 if worker_start else 0,
+                       tstamp, tstamp])
+
+    # Rows are applied in order, so several entries for one transaction in a batch accumulate correctly. An entry
+    # older than the current state (a late retry) only fills in what it adds.
+    sql = '''
+        insert into transaction_state
+            (transid, geo, stage, status, agent_status, worker_status, worker_host, worker_pid, attempts, started,
+            updated)
+        values {0}
+        on duplicate key update
+            stage = if(values(updated) >= updated, values(stage), stage),
+            status = if(values(updated) >= updated, values(status), status),
+            agent_status = coalesce(values(agent_status), agent_status),
+            worker_status = coalesce(values(worker_status), worker_status),
+            worker_host = coalesce(values(worker_host), worker_host),
+            worker_pid = coalesce(values(worker_pid), worker_pid),
+            attempts = attempts + values(attempts),
+            updated = greatest(updated, values(updated))
+        '''.format(', '.join(['(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)'] * len(entries)))
+    db.execute(sql, tuple(params))
+
+
+def valid_dump_name(filename):
+    """
+    Dump file names are used as paths in the upload directory, so only accept plain names of encrypted dumps
+    :param filename: the file name supplied by the agent
+    :return: True if the name is acceptable
+    """
+    return bool(filename) and re.match(r'^[a-zA-Z0-9_.-]+\.encrypted$', filename) is not None and \
+        not filename.startswith('.')
+
+
+def log_tables(db, tstamp_start=None, tstamp_end=None):
+    """
+    Find the tables holding transaction log entries. Closed months are moved out of the log table into archive
+    tables by log_archiver.py and recorded in log_archive.
+    :param db: database cursor
+    :param tstamp_start: optional start of the period of interest (inclusive)
+    :param tstamp_end: optional end of the period of interest (inclusive)
+    :return: list of table names, starting with the live log table
+    """
+    tables = ['log']
+    db.execute(*ganymede_sql.log_tables_query(tstamp_start, tstamp_end))
+    for row in db.fetchall():
+        if ganymede_sql.ARCHIVE_TABLE.match(row['table_name']):
+            tables.append(row['table_name'])
+    return tables
+
+
+def notify_jupiter(logid, stage, status):
+    """
+    Publish a transaction event to Jupiter so it can launch (or retire) workers without waiting for its next poll.
+    Handlers register it with after_commit() so Jupiter never wakes up before the entry it is told about is visible.
+    :param logid: the transaction ID
+    :param stage: the stage just logged
+    :param status: the status just logged
+    :return: True if the event was handed to Jupiter
+    """
+    if not notify_socket or stage.upper() not in ('AGENT_END', 'WORKER_END'):
+        return False
+
+    event = '{0} {1} {2}'.format(logid, stage.upper(), status.upper())
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.setblocking(False)
+        sock.sendto(event.encode('utf-8'), notify_socket)
+    except socket.error:
+        # Jupiter is not running or is not keeping up. It still polls the log, so the event is not lost.
+        return False
+    finally:
+        sock.close()
+    return True
+
 '''
    MAIN
 '''
@@ -830,25 +1883,127 @@ if __name__ == '__main__':
 
     parser = OptionParser()
     parser.add_option('-t', '--port', dest='port', help='The port to listen on')
+    parser.add_option('-w', '--workers', dest='workers', type='int',
+                      help='Number of pre-forked worker processes (requires gunicorn). Overrides "api_workers"')
+    parser.add_option('--threads', dest='threads', type='int',
+                      help='Number of request threads per worker process. Overrides "api_threads"')
     (args, unused) = parser.parse_args()
 
     if args.port is None:
         print('Please specify a port number')
         exit()
 
+    # optional: the socket Jupiter listens on for transaction events
+    notify_socket = db_opts.get('jupiter_socket', '')
+
     pid_file = '/var/run/ganymede/agent_' + args.port + '.pid'
 
     with open(pid_file, 'w') as p:
         print(str(os.getpid()), file=p)
 
-    plugin = bottle_mysql.Plugin(
-        dbuser=db_opts['db_user'],
-        dbpass=db_opts['db_pass'],
-        dbhost=db_opts['db_host'],
-        dbname=db_opts['db_schema'],
-        charset=db_opts['db_charset'],
-        timezone=db_opts['db_timezone'])
+    # With no workers configured we run Bottle's single-threaded server, one request at a time. With workers,
+    # gunicorn pre-forks that many processes, each serving "threads" requests at once, so a long upload only
+    # holds one thread while heartbeats and log updates carry on. "kill -HUP" on the pid in the pid file reloads
+    # the workers gracefully: running requests get up to "api_graceful_timeout" seconds to finish.
+    workers = 0  # default
+    threads = 8  # default
+    graceful_timeout = 600  # default
+    if args.workers is not None:
+        workers = args.workers
+    elif db_opts.get('api_workers'):
+        workers = int(db_opts['api_workers'])
+    if workers < 0:
+        print('Invalid "api_workers" setting. Using default value.')
+        workers = 0
+
+    if args.threads is not None:
+        threads = args.threads
+    elif db_opts.get('api_threads'):
+        threads = int(db_opts['api_threads'])
+    if threads < 1:
+        print('Invalid "api_threads" setting. Using default value.')
+        threads = 8
+
+    if db_opts.get('api_graceful_timeout'):
+        if int(db_opts['api_graceful_timeout']) > 0:
+            graceful_timeout = int(db_opts['api_graceful_timeout'])
+        else:
+            print('Invalid "api_graceful_timeout" setting. Using default value.')
+
+    if workers:
+        try:
+            import gunicorn
+        except ImportError:
+            print('gunicorn is required to run with workers. Install it or set "api_workers" to 0.')
+            exit()
+
+    pool_size = 10  # default
+    pool_max_idle = 300  # default
+    if workers:
+        # each request thread may hold a connection, so the pool is at least as large as the thread count
+        pool_size = max(pool_size, threads)
+    if db_opts.get('db_pool_size'):
+        if int(db_opts['db_pool_size']) > 0:
+            pool_size = int(db_opts['db_pool_size'])
+        else:
+            print('Invalid "db_pool_size" setting. Using default value.')
+
+    if db_opts.get('db_pool_max_idle'):
+        if int(db_opts['db_pool_max_idle']) > 0:
+            pool_max_idle = int(db_opts['db_pool_max_idle'])
+        else:
+            print('Invalid "db_pool_max_idle" setting. Using default value.')
+
+    # Agent lookups are cached per process, keyed by the shared API version (see api_version_file below), so a change
+    # made through any worker or API process is seen by all of them at once. Without a version file, a change only
+    # reaches the other processes when their entries expire, so keep the TTL short.
+    cache_size = 1000  # default
+    cache_ttl = 60  # default
+    if db_opts.get('agent_cache_size'):
+        if int(db_opts['agent_cache_size']) > 0:
+            cache_size = int(db_opts['agent_cache_size'])
+        else:
+            print('Invalid "agent_cache_size" setting. Using default value.')
+
+    if 'agent_cache_ttl' in db_opts:
+        # 0 disables the cache
+        if int(db_opts['agent_cache_ttl']) >= 0:
+            cache_ttl = int(db_opts['agent_cache_ttl'])
+        else:
+            print('Invalid "agent_cache_ttl" setting. Using default value.')
+
+    if cache_ttl > 0:
+        agent_cache = TTLCache(cache_size, cache_ttl)
+
+    # ETags come from a version file shared by every API process. Each start moves the version on, which covers
+    # changes made while the API was down. Cached responses are dropped whenever the version changes.
+    version_file = '/var/run/ganymede/api_version'  # default
+    response_ttl = 0  # default
+    if 'api_version_file' in db_opts:
+        # '' disables ETags
+        version_file = db_opts['api_version_file']
+
+    if db_opts.get('response_cache_ttl'):
+        if int(db_opts['response_cache_ttl']) >= 0:
+            response_ttl = int(db_opts['response_cache_ttl'])
+        else:
+            print('Invalid "response_cache_ttl" setting. Using default value.')
+
+    bump_api_version()
+    if response_ttl > 0 and version_file:
+        response_cache = TTLCache(cache_size, response_ttl)
 
+    # one pool per API process; connections are opened on demand and shared across requests
+    db_pool = ConnectionPool(connect_ganymede(db_opts), max_size=pool_size, max_idle=pool_max_idle)
+    plugin = PoolPlugin(db_pool)
+
+    # the conditional plugin goes first so it wraps the database plugin and a 304 never takes a connection
+    bottle.install(ConditionalPlugin())
     bottle.install(plugin)
 
-    bottle.run(host='127.0.0.1', port=args.port)
+    if workers:
+        # The pool opens connections on first use, so every forked worker builds its own set of connections
+        bottle.run(host='127.0.0.1', port=args.port, server='gunicorn', workers=workers, threads=threads,
+                   worker_class='gthread', graceful_timeout=graceful_timeout, proc_name='agent_' + args.port)
+    else:
+        bottle.run(host='127.0.0.1', port=args.port)
@@ -0,0 +1 @@
+../../server/ganymede_pool.py
\ No newline at end of file
@@ -0,0 +1,116 @@
+from __future__ import print_function
+import re
+
+__author__ = 'jstoner'
+
+'''
+The SQL of the API's hot queries. agent_api.py runs these, and db/check_indexes.py explains the very same queries
+to make sure they are answered from an index, so change them here and nowhere else. Deploy it next to
+agent_api.py.
+
+Queries that read the transaction log are built for a list of log tables: closed months are moved out of the log
+table into archive tables by log_archiver.py, and are read alongside it with UNION ALL.
+'''
+
+# transaction_state(): every log post, upload_dump, get_worker_details, manage_worker_schema
+TRANSACTION_STATE = '''
+    select transid, geo, stage, status, agent_status, worker_status, worker_host, worker_pid, attempts, started,
+        updated
+    from transaction_state where transid = %s
+    '''
+
+# get_worker_details
+WORKER_DETAILS = '''
+    select u.filename, l.nonce
+    from upload u, log l
+    where l.transid = %s and l.stage = 'AGENT_INIT' and u.transid = l.transid
+    '''
+
+# archive table names are interpolated into queries, so only the names log_archiver.py creates are accepted
+ARCHIVE_TABLE = re.compile(r'^log_archive_\w+$')
+
+
+def log_tables_query(tstamp_start=None, tstamp_end=None):
+    """
+    The archive tables holding log entries of a period, from log_archive
+    :param tstamp_start: optional start of the period of interest (inclusive)
+    :param tstamp_end: optional end of the period of interest (inclusive)
+    :return: (sql, params); the query returns table_name, oldest month first
+    """
+    sql = 'select table_name from log_archive where 1 = 1'
+    params = ()
+    if tstamp_start:
+        sql += ' and tstamp_end > %s'
+        params += (tstamp_start,)
+    if tstamp_end:
+        sql += ' and (tstamp_start is null or tstamp_start <= %s)'
+        params += (tstamp_end,)
+    return sql + ' order by tstamp_end', params
+
+
+def union_query(sql, params, tables, order, limit):
+    """
+    :param sql: query of one log table, with {0} in place of the table name
+    :param params: parameters of the query of one table
+    :param tables: log tables to read
+    :param order: order by clause of the combined result
+    :param limit: optional number of rows to return
+    :return: (sql, params) reading every table with UNION ALL
+    """
+    params = params * len(tables)
+    if limit is None:
+        return ' union all '.join([sql.format(table) for table in tables]) + ' order by ' + order, params
+    # each table stops after "limit" rows read in index order, so a page never sorts the whole history
+    page = ' order by ' + order + ' limit ' + str(int(limit))
+    sql = ' union all '.join(['(' + sql.format(table) + page + ')' for table in tables]) + page
+    return sql, params
+
+
+def agent_logs_query(tables, geo, day=None, after=None, limit=None):
+    """
+    get_agent_logs: the transactions of a GEO, from their AGENT_INIT entries
+    :param tables: log tables to read
+    :param geo: GEO ID
+    :param day: optional (start, end) timestamps of the day to list
+    :param after: optional (tstamp, transid) of the last transaction on the previous page
+    :param limit: optional number of rows to return
+    :return: (sql, params)
+    """
+    sql = "select transid, tstamp from {0} where geo = %s and stage = 'AGENT_INIT'"
+    params = (geo,)
+    if day is not None:
+        sql += ' and tstamp >= %s and tstamp <= %s'
+        params += (day[0], day[1])
+    if after is not None:
+        # keyset pagination: start right after the last transaction the client has seen
+        sql += ' and (tstamp > %s or (tstamp = %s and transid > %s))'
+        params += (after[0], after[0], after[1])
+    return union_query(sql, params, tables, 'tstamp, transid', limit)
+
+
+def transaction_log_query(tables, transid, after=None, limit=None):
+    """
+    get_transaction_log: the log entries of one transaction
+    :param tables: log tables to read
+    :param transid: transaction ID
+    :param after: optional (tstamp, id) of the last entry on the previous page
+    :param limit: optional number of rows to return
+    :return: (sql, params)
+    """
+    sql = 'select id, tstamp, status, stage, message from {0} where transid = %s'
+    params = (transid,)
+    if after is not None:
+        sql += ' and (tstamp > %s or (tstamp = %s and id > %s))'
+        params += (after[0], after[0], int(after[1]))
+    return union_query(sql, params, tables, 'tstamp, id', limit)
+
+
+def logged_events_query(transids):
+    """
+    logged_events: the entries already in the log for a log post or batch
+    :param transids: list of transaction IDs
+    :return: (sql, params)
+    """
+    sql = 'select transid, stage, status, tstamp, message from log where transid in ({0})'.format(
+        ', '.join(['%s'] * len(transids)))
+    return sql, tuple(transids)
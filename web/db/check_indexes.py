@@ -0,0 +1,211 @@
+#!/usr/bin/env python -u
+
+from __future__ import print_function
+from datetime import timedelta
+from optparse import OptionParser
+import os.path
+import json
+import sys
+
+import mysql.connector
+from mysql.connector import errorcode
+
+# the queries come from the code that runs them, in the same checkout
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'application'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'server'))
+import ganymede_sql
+import jupiter
+
+__author__ = 'jstoner'
+
+'''
+Checks that the hot queries of the API and Jupiter are answered from an index (see migrations/001_log_indexes.sql
+and migrations/003_transaction_state.sql).
+
+The queries are the ones the API and Jupiter run, imported from application/ganymede_sql.py and server/jupiter.py,
+so run this from a checkout of the same version. Their parameters are taken from the most recent transaction in
+the schema, and queries of the transaction log read the live log and the archive tables listed in log_archive, as
+the API does. The check runs EXPLAIN on each query and fails if MySQL would read log (or an archive of it), upload or
+transaction_state with a full table scan (type ALL); those tables grow without bound.
+
+Run it against the production schema (or a copy with production-like data) after applying a migration or changing
+a query. On a nearly empty schema the optimizer may choose a scan because it is cheaper for a handful of rows.
+
+Exits with status 0 when no full table scans are found and 1 otherwise.
+'''
+
+# tables that must never be read with a full table scan
+GROWING_TABLES = ('log', 'upload', 'transaction_state')
+
+# the API reads one row more than its largest page (max_page_size) to tell whether there is a next page
+PAGE_LIMIT = 1001
+
+
+def log_tables(db, tstamp_start=None, tstamp_end=None):
+    """
+    :param db: database connection object
+    :param tstamp_start: optional start of the period of interest (inclusive)
+    :param tstamp_end: optional end of the period of interest (inclusive)
+    :return: the log tables the API reads for the period, starting with the live log table
+    """
+    cur = db.cursor()
+    cur.execute(*ganymede_sql.log_tables_query(tstamp_start, tstamp_end))
+    tables = ['log'] + [row[0] for row in cur.fetchall() if ganymede_sql.ARCHIVE_TABLE.match(row[0])]
+    cur.close()
+    return tables
+
+
+def sample_params(db):
+    """
+    :param db: database connection object
+    :return: dict of query parameters taken from the most recent transaction, or placeholders in an empty schema
+    """
+    params = {'transid': '00000000-0000-0000-0000-000000000000', 'geo': 0, 'started': None, 'entry_id': 0}
+    cur = db.cursor()
+    cur.execute('select transid, geo, started from transaction_state order by started desc limit 1')
+    row = cur.fetchone()
+    if row is not None:
+        (params['transid'], params['geo'], params['started']) = row
+        cur.execute('select max(id) from log where transid = %s', (params['transid'],))
+        params['entry_id'] = cur.fetchone()[0] or 0
+    if params['started'] is None:
+        cur.execute('select utc_timestamp()')
+        params['started'] = cur.fetchone()[0]
+    cur.close()
+
+    started = params['started']
+    params['hour_start'] = started.strftime('%Y-%m-%d %H:00:00')
+    params['hour_end'] = started.strftime('%Y-%m-%d %H:59:59')
+    params['day_start'] = started.strftime('%Y-%m-%d 00:00:00')
+    params['day_end'] = started.strftime('%Y-%m-%d 23:59:59')
+    # Jupiter's default jupiter_lookback_hours
+    params['backlog_start'] = (started - timedelta(hours=6)).strftime('%Y-%m-%d %H:00:00')
+    return params
+
+
+def checks(db, params):
+    """
+    :param db: database connection object
+    :param params: dict from sample_params
+    :return: list of (name, query, query parameters, {table or alias in the query: table it reads})
+    """
+    transid = params['transid']
+    state = {'transaction_state': 'transaction_state'}
+    tables = log_tables(db)
+    day_tables = log_tables(db, params['day_start'], params['day_end'])
+    # archive tables are read like the log itself
+    logs = dict([(table, 'log') for table in tables])
+
+    return [
+        ('transaction_state: every log post, upload_dump, get_worker_details, manage_worker_schema',
+         ganymede_sql.TRANSACTION_STATE, (transid,), state),
+        # stands in for "replace into upload", which finds the row to replace through the same unique key
+        ('upload_dump: replace into upload (unique key lookup)',
+         'select id from upload where transid = %s', (transid,), {'upload': 'upload'}),
+        ('get_worker_details', ganymede_sql.WORKER_DETAILS, (transid,), {'u': 'upload', 'l': 'log'}),
+        ('logged_events: every log post',) + ganymede_sql.logged_events_query([transid]) + ({'log': 'log'},),
+        ('get_transaction_log',) + ganymede_sql.transaction_log_query(tables, transid, None, PAGE_LIMIT) +
+        (logs,),
+        ('get_transaction_log: next page',) +
+        ganymede_sql.transaction_log_query(tables, transid, (params['started'], params['entry_id']), PAGE_LIMIT) +
+        (logs,),
+        ('get_agent_logs',) + ganymede_sql.agent_logs_query(tables, params['geo'], None, None, PAGE_LIMIT) +
+        (logs,),
+        ('get_agent_logs: next page',) +
+        ganymede_sql.agent_logs_query(log_tables(db, params['started']), params['geo'], None,
+                                      (params['started'], transid), PAGE_LIMIT) + (logs,),
+        ('get_agent_logs: one day',) +
+        ganymede_sql.agent_logs_query(day_tables, params['geo'], (params['day_start'], params['day_end']), None,
+                                      PAGE_LIMIT) + (logs,),
+        ('jupiter: scan_transaction_state', jupiter.SCAN_TRANSACTION_STATE, (params['hour_start'], params['hour_end']),
+         state),
+        ('jupiter: scan_backlog', jupiter.SCAN_BACKLOG, (params['backlog_start'], params['hour_start']), state),
+        # a copy: the query lives in a shell script. Keep it in step with hourly_backup.sh.
+        ('hourly_backup.sh: uploads of the hour', '''
+            select u.filename
+            from upload u, log l
+            where u.transid = l.transid and l.tstamp >= %s and tstamp <= %s and stage = 'AGENT_END'
+                and status = 'SUCCESS'
+            ''', (params['hour_start'], params['hour_end']), {'u': 'upload', 'l': 'log'}),
+    ]
+
+
+def full_scans(db, sql, params, watched):
+    """
+    :param db: database connection object
+    :param sql: query to explain
+    :param params: query parameters
+    :param watched: dict mapping the table names or aliases in the query to the tables they read
+    :return: list of (table, EXPLAIN row as a dict) for every full scan of a table in GROWING_TABLES, and the
+        complete EXPLAIN output
+    """
+    cur = db.cursor(dictionary=True)
+    cur.execute('explain ' + sql, params)
+    plan = cur.fetchall()
+    cur.close()
+    scans = []
+    for row in plan:
+        table = watched.get(row['table'])
+        if table in GROWING_TABLES and row['type'] == 'ALL':
+            scans.append((table, row))
+    return scans, plan
+
+######
+# MAIN
+######
+if __name__ == '__main__':
+
+    parser = OptionParser()
+    parser.add_option('-v', '--verbose', dest='verbose', action='store_true', default=False,
+                      help='Print the query plan of every check')
+    (args, unused) = parser.parse_args()
+
+    # Load settings
+    if os.path.exists('/etc/ganymede/ganymede.json'):
+        fp = open('/etc/ganymede/ganymede.json', 'r')
+        settings = json.load(fp)
+        fp.close()
+    else:
+        print('Cannot find database configuration settings.')
+        exit(1)
+
+    ganymede_db_opts = {
+        'user': settings['db_user'],
+        'password': settings['db_pass'],
+        'host': settings['db_host'],
+        'database': settings['db_schema'],
+        'time_zone': settings['db_timezone'],
+    }
+
+    try:
+        cnx = mysql.connector.connect(**ganymede_db_opts)
+    except mysql.connector.Error as err:
+        if err.errno == errorcode.ER_ACCESS_DENIED_ERROR:
+            print('Incorrect Ganymede DB user name or password')
+            exit(1)
+        elif err.errno == errorcode.ER_BAD_DB_ERROR:
+            print('Ganymede Schema does not exist')
+            exit(1)
+        else:
+            print(err)
+            exit(1)
+
+    all_checks = checks(cnx, sample_params(cnx))
+    failures = 0
+    for (check_name, check_sql, check_params, tables) in all_checks:
+        (table_scans, query_plan) = full_scans(cnx, check_sql, check_params, tables)
+        print(('FAIL ' if table_scans else 'OK   ') + check_name)
+        for (scanned, plan_row) in table_scans:
+            print('     full table scan of ' + scanned + ' (about ' + str(plan_row['rows']) + ' rows)')
+        if args.verbose:
+            for plan_row in query_plan:
+                print('     ' + str(plan_row['table']) + ': type=' + str(plan_row['type']) + ' key=' +
+                      str(plan_row['key']) + ' rows=' + str(plan_row['rows']))
+        if table_scans:
+            failures += 1
+    cnx.close()
+
+    if failures:
+        print(str(failures) + ' of ' + str(len(all_checks)) + ' queries use a full table scan')
+        exit(1)
+    print('No full table scans')
@@ -27,19 +27,75 @@ CREATE TABLE IF NOT EXISTS `ganymede`.`agent` (
   uid varchar(255) not null, -- UUID
   name varchar(255) not null, -- display-friendly name
   enabled tinyint not null default 1, -- 0 = disabled, 1 = enabled
-  active tinyint not null default 1 -- 0 = inactive, 1 = active
+  active tinyint not null default 1, -- 0 = inactive, 1 = active
+  unique index uidx_agent_uid (uid)
 ) Engine=InnoDB DEFAULT CHARSET=utf8;
 
 DROP TABLE IF EXISTS `ganymede`.`log`;
 CREATE TABLE IF NOT EXISTS `ganymede`.`log` (
-  id int unsigned auto_increment primary key,
+  id int unsigned auto_increment,
   transid varchar(255) not null, -- UUID
   geo int unsigned not null,
   tstamp datetime not null,
   status varchar(255) not null, -- SUCCESS, ERROR
   stage varchar(255) not null, -- DUMP, TRANSFER, LOAD, TRANSFORM, etc.
   message text not null,
-  nonce text -- one-time passphrase for encryption/decryption
+  nonce text, -- one-time passphrase for encryption/decryption
+  index idx_log_transid_stage (transid, stage, status, tstamp), -- per-transaction stage lookups
+  index idx_log_stage_status_tstamp (stage, status, tstamp), -- Jupiter and backup scans
+  index idx_log_geo_stage_tstamp (geo, stage, tstamp, transid), -- agent transaction history
+  primary key (id, tstamp) -- the partitioning column must be part of the primary key
+) Engine=InnoDB DEFAULT CHARSET=utf8
+-- monthly partitions are added (and closed months archived) by log_archiver.py
+PARTITION BY RANGE (TO_DAYS(tstamp)) (
+  PARTITION p_history VALUES LESS THAN (TO_DAYS('2016-01-01')),
+  PARTITION p_future VALUES LESS THAN MAXVALUE
+);
+
+DROP TABLE IF EXISTS `ganymede`.`log_archive`;
+CREATE TABLE IF NOT EXISTS `ganymede`.`log_archive` (
+  id int unsigned auto_increment primary key,
+  table_name varchar(64) not null, -- archive table holding the rows of one closed partition
+  tstamp_start datetime, -- first tstamp covered (inclusive); NULL if the partition had no lower bound
+  tstamp_end datetime not null, -- last tstamp covered (exclusive)
+  archived datetime not null,
+  unique index uidx_log_archive_table (table_name)
+) Engine=InnoDB DEFAULT CHARSET=utf8;
+
+DROP TABLE IF EXISTS `ganymede`.`transaction_state`;
+CREATE TABLE IF NOT EXISTS `ganymede`.`transaction_state` (
+  transid varchar(255) not null primary key, -- UUID
+  geo int unsigned not null,
+  stage varchar(255) not null, -- stage of the most recent log entry
+  status varchar(255) not null, -- status of the most recent log entry
+  agent_status varchar(255), -- status of AGENT_END; NULL until the agent finishes
+  worker_status varchar(255), -- status of the most recent WORKER_INIT; NULL until a worker starts
+  worker_host varchar(255), -- host and PID of the most recent worker
+  worker_pid int unsigned,
+  attempts int unsigned not null default 0, -- number of workers started (WORKER_INIT entries)
+  started datetime not null, -- tstamp of AGENT_INIT
+  updated datetime not null, -- tstamp of the most recent log entry
+  progress datetime, -- most recent worker heartbeat (UTC); NULL until a worker posts one
+  index idx_transaction_state_started (started, agent_status) -- Jupiter
+) Engine=InnoDB DEFAULT CHARSET=utf8;
+
+DROP TABLE IF EXISTS `ganymede`.`work_queue`;
+CREATE TABLE IF NOT EXISTS `ganymede`.`work_queue` (
+  transid varchar(255) not null primary key, -- UUID
+  state varchar(16) not null, -- QUEUED, LEASED, DONE or FAILED
+  attempts int unsigned not null default 0, -- number of times the transaction has been leased
+  not_before datetime not null, -- earliest time the transaction may be leased (retry back-off)
+  lease_owner varchar(255), -- host:pid of the worker daemon holding the lease
+  lease_token char(32), -- identifies one lease; heartbeats and completion must present it
+  lease_expires datetime, -- the lease is reclaimed if no heartbeat extends it past this time
+  heartbeats int unsigned not null default 0,
+  cancel_requested tinyint(1) not null default 0, -- set by Jupiter to have the daemon stop the worker
+  enqueued datetime not null,
+  updated datetime not null,
+  index idx_work_queue_ready (state, not_before, enqueued), -- worker daemons
+  index idx_work_queue_expires (state, lease_expires), -- reclaiming expired leases
+  index idx_work_queue_lease (lease_token), -- claims without SKIP LOCKED
+  index idx_work_queue_finished (state, updated) -- purging finished transactions
 ) Engine=InnoDB DEFAULT CHARSET=utf8;
 
 DROP TABLE IF EXISTS `ganymede`.`assignment`;
@@ -47,15 +103,32 @@ CREATE TABLE IF NOT EXISTS `ganymede`.`assignment` (
   id int unsigned auto_increment primary key,
   agent_id int unsigned not null,
   geo_config_id int unsigned not null,
-  geo_release_id int unsigned not null
+  geo_release_id int unsigned not null,
+  index idx_assignment_agent_id (agent_id)
 ) Engine=InnoDB DEFAULT CHARSET=utf8;
 
 DROP TABLE IF EXISTS `ganymede`.`upload`;
 CREATE TABLE IF NOT EXISTS `ganymede`.`upload` (
   id int unsigned auto_increment primary key,
   transid varchar(255) not null,
-  filename text not null -- we use text in case of large path+file names
+  filename text not null, -- we use text in case of large path+file names
+  unique index uidx_upload_transid (transid) -- required by "replace into upload"
+) Engine=InnoDB DEFAULT CHARSET=utf8;
+
+-- Migrations (see migrations/) already reflected in this file
+DROP TABLE IF EXISTS `ganymede`.`schema_version`;
+CREATE TABLE IF NOT EXISTS `ganymede`.`schema_version` (
+  version int unsigned not null primary key,
+  description varchar(255) not null,
+  applied datetime not null
 ) Engine=InnoDB DEFAULT CHARSET=utf8;
+INSERT INTO `ganymede`.`schema_version` (version, description, applied) VALUES (1, 'log table indexes', UTC_TIMESTAMP());
+INSERT INTO `ganymede`.`schema_version` (version, description, applied) VALUES (2, 'log table partitions', UTC_TIMESTAMP());
+INSERT INTO `ganymede`.`schema_version` (version, description, applied) VALUES (3, 'transaction state', UTC_TIMESTAMP());
+INSERT INTO `ganymede`.`schema_version` (version, description, applied) VALUES (4, 'work queue', UTC_TIMESTAMP());
+INSERT INTO `ganymede`.`schema_version` (version, description, applied) VALUES (5, 'work queue cancel', UTC_TIMESTAMP());
+INSERT INTO `ganymede`.`schema_version` (version, description, applied) VALUES (6, 'transaction progress', UTC_TIMESTAMP());
+INSERT INTO `ganymede`.`schema_version` (version, description, applied) VALUES (7, 'work queue retention', UTC_TIMESTAMP());
 
 -- Test data
 -- Create GEOs
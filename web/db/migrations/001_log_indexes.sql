@@ -0,0 +1,33 @@
+-- Migration 001: indexes for the transaction log hot paths
+--
+-- Apply to an existing Ganymede schema with:
+--   mysql -u<user> -p -h<host> ganymede < 001_log_indexes.sql
+-- New installs get these from ganymede_schema.sql and do not need this migration.
+use `ganymede`;
+
+CREATE TABLE IF NOT EXISTS `ganymede`.`schema_version` (
+  version int unsigned not null primary key,
+  description varchar(255) not null,
+  applied datetime not null
+) Engine=InnoDB DEFAULT CHARSET=utf8;
+
+-- Transaction lookups by stage: update_transaction_log, update_worker_transaction_log, upload_dump,
+-- get_worker_details, manage_worker_schema (latest WORKER_INIT) and get_transaction_log (ordered by tstamp)
+ALTER TABLE `ganymede`.`log` ADD INDEX idx_log_transid_stage (transid, stage, status, tstamp);
+
+-- Stage/status scans over a time window: Jupiter and hourly_backup.sh
+ALTER TABLE `ganymede`.`log` ADD INDEX idx_log_stage_status_tstamp (stage, status, tstamp);
+
+-- Transaction history for a GEO: get_agent_logs. Includes transid so the query is answered from the index.
+ALTER TABLE `ganymede`.`log` ADD INDEX idx_log_geo_stage_tstamp (geo, stage, tstamp, transid);
+
+-- "replace into upload" relies on transid being unique. Keep the most recent row for any transaction that was
+-- uploaded more than once before the index existed.
+DELETE u1 FROM `ganymede`.`upload` u1 JOIN `ganymede`.`upload` u2 ON u1.transid = u2.transid AND u1.id < u2.id;
+ALTER TABLE `ganymede`.`upload` ADD UNIQUE INDEX uidx_upload_transid (transid);
+
+-- Agent lookups by uid and the assignment join that starts nearly every agent API call
+ALTER TABLE `ganymede`.`agent` ADD UNIQUE INDEX uidx_agent_uid (uid);
+ALTER TABLE `ganymede`.`assignment` ADD INDEX idx_assignment_agent_id (agent_id);
+
+INSERT INTO `ganymede`.`schema_version` (version, description, applied) VALUES (1, 'log table indexes', UTC_TIMESTAMP());
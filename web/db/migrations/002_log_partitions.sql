@@ -0,0 +1,32 @@
+-- Migration 002: monthly range partitions for the transaction log
+--
+-- Apply to an existing Ganymede schema with:
+--   mysql -u<user> -p -h<host> ganymede < 002_log_partitions.sql
+-- New installs get this from ganymede_schema.sql and do not need this migration.
+--
+-- Everything logged before the current month lands in p_history; rows from the current month onward land in
+-- p_future. server/log_archiver.py splits p_future into monthly partitions and moves closed months out to
+-- compressed archive tables listed in log_archive.
+use `ganymede`;
+
+-- MySQL requires the partitioning column in every unique key, including the primary key
+ALTER TABLE `ganymede`.`log` DROP PRIMARY KEY, ADD PRIMARY KEY (id, tstamp);
+
+SET @partition_sql = CONCAT(
+  'ALTER TABLE `ganymede`.`log` PARTITION BY RANGE (TO_DAYS(tstamp)) (',
+  'PARTITION p_history VALUES LESS THAN (TO_DAYS(''', DATE_FORMAT(UTC_DATE(), '%Y-%m-01'), ''')), ',
+  'PARTITION p_future VALUES LESS THAN MAXVALUE)');
+PREPARE partition_stmt FROM @partition_sql;
+EXECUTE partition_stmt;
+DEALLOCATE PREPARE partition_stmt;
+
+CREATE TABLE IF NOT EXISTS `ganymede`.`log_archive` (
+  id int unsigned auto_increment primary key,
+  table_name varchar(64) not null, -- archive table holding the rows of one closed partition
+  tstamp_start datetime, -- first tstamp covered (inclusive); NULL if the partition had no lower bound
+  tstamp_end datetime not null, -- last tstamp covered (exclusive)
+  archived datetime not null,
+  unique index uidx_log_archive_table (table_name)
+) Engine=InnoDB DEFAULT CHARSET=utf8;
+
+INSERT INTO `ganymede`.`schema_version` (version, description, applied) VALUES (2, 'log table partitions', UTC_TIMESTAMP());
@@ -0,0 +1,43 @@
+-- Migration 003: current state of every transaction
+--
+-- Apply to an existing Ganymede schema with:
+--   mysql -u<user> -p -h<host> ganymede < 003_transaction_state.sql
+-- New installs get this from ganymede_schema.sql and do not need this migration.
+--
+-- The API updates transaction_state in the same transaction as every log insert, so the checks that used to
+-- search the log for a stage (upload_dump, get_worker_details, manage_worker_schema, Jupiter) become primary key
+-- or single index lookups. The log table remains the full history.
+use `ganymede`;
+
+CREATE TABLE IF NOT EXISTS `ganymede`.`transaction_state` (
+  transid varchar(255) not null primary key, -- UUID
+  geo int unsigned not null,
+  stage varchar(255) not null, -- stage of the most recent log entry
+  status varchar(255) not null, -- status of the most recent log entry
+  agent_status varchar(255), -- status of AGENT_END; NULL until the agent finishes
+  worker_status varchar(255), -- status of the most recent WORKER_INIT; NULL until a worker starts
+  worker_host varchar(255), -- host and PID of the most recent worker
+  worker_pid int unsigned,
+  attempts int unsigned not null default 0, -- number of workers started (WORKER_INIT entries)
+  started datetime not null, -- tstamp of AGENT_INIT
+  updated datetime not null, -- tstamp of the most recent log entry
+  index idx_transaction_state_started (started, agent_status) -- Jupiter
+) Engine=InnoDB DEFAULT CHARSET=utf8;
+
+-- Backfill from the live log. Transactions in archived months are finished and are not needed.
+INSERT IGNORE INTO `ganymede`.`transaction_state`
+  (transid, geo, stage, status, agent_status, worker_status, attempts, started, updated)
+SELECT
+  i.transid, i.geo, l.stage, l.status,
+  (SELECT e.status FROM `ganymede`.`log` e
+    WHERE e.transid = i.transid AND e.stage = 'AGENT_END' ORDER BY e.tstamp DESC, e.id DESC LIMIT 1),
+  (SELECT w.status FROM `ganymede`.`log` w
+    WHERE w.transid = i.transid AND w.stage = 'WORKER_INIT' ORDER BY w.tstamp DESC, w.id DESC LIMIT 1),
+  (SELECT count(*) FROM `ganymede`.`log` c WHERE c.transid = i.transid AND c.stage = 'WORKER_INIT'),
+  i.tstamp, l.tstamp
+FROM `ganymede`.`log` i
+JOIN `ganymede`.`log` l ON l.transid = i.transid AND l.id = (
+  SELECT x.id FROM `ganymede`.`log` x WHERE x.transid = i.transid ORDER BY x.tstamp DESC, x.id DESC LIMIT 1)
+WHERE i.stage = 'AGENT_INIT';
+
+INSERT INTO `ganymede`.`schema_version` (version, description, applied) VALUES (3, 'transaction state', UTC_TIMESTAMP());
@@ -0,0 +1,27 @@
+-- Migration 004: work queue for distributed workers
+--
+-- Apply to an existing Ganymede schema with:
+--   mysql -u<user> -p -h<host> ganymede < 004_work_queue.sql
+-- New installs get this from ganymede_schema.sql and do not need this migration.
+--
+-- With "jupiter_dispatch" set to "queue", Jupiter enqueues transactions here instead of running workers itself.
+-- server/ganymede_worker_daemon.py runs on any number of worker hosts and leases transactions from this table
+-- (see server/ganymede_queue.py). Leases are extended by heartbeats and reclaimed once they expire.
+use `ganymede`;
+
+CREATE TABLE IF NOT EXISTS `ganymede`.`work_queue` (
+  transid varchar(255) not null primary key, -- UUID
+  state varchar(16) not null, -- QUEUED, LEASED, DONE or FAILED
+  attempts int unsigned not null default 0, -- number of times the transaction has been leased
+  not_before datetime not null, -- earliest time the transaction may be leased (retry back-off)
+  lease_owner varchar(255), -- host:pid of the worker daemon holding the lease
+  lease_token char(32), -- identifies one lease; heartbeats and completion must present it
+  lease_expires datetime, -- the lease is reclaimed if no heartbeat extends it past this time
+  heartbeats int unsigned not null default 0,
+  enqueued datetime not null,
+  updated datetime not null,
+  index idx_work_queue_ready (state, not_before, enqueued), -- worker daemons
+  index idx_work_queue_expires (state, lease_expires) -- reclaiming expired leases
+) Engine=InnoDB DEFAULT CHARSET=utf8;
+
+INSERT INTO `ganymede`.`schema_version` (version, description, applied) VALUES (4, 'work queue', UTC_TIMESTAMP());
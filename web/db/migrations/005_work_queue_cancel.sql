@@ -0,0 +1,15 @@
+-- Migration 005: let Jupiter stop a queued worker
+--
+-- Apply to an existing Ganymede schema with:
+--   mysql -u<user> -p -h<host> ganymede < 005_work_queue_cancel.sql
+-- New installs get this from ganymede_schema.sql and do not need this migration.
+--
+-- Jupiter sets cancel_requested on the lease of a worker that stalled. The worker daemon holding the lease sees it
+-- on its next heartbeat, stops the worker with everything it started and finishes the lease as a failed attempt, so
+-- the queue retries the transaction (see server/ganymede_queue.py).
+use `ganymede`;
+
+ALTER TABLE `ganymede`.`work_queue`
+  ADD COLUMN cancel_requested tinyint(1) not null default 0 AFTER heartbeats;
+
+INSERT INTO `ganymede`.`schema_version` (version, description, applied) VALUES (5, 'work queue cancel', UTC_TIMESTAMP());
@@ -0,0 +1,15 @@
+-- Migration 006: worker progress heartbeats
+--
+-- Apply to an existing Ganymede schema with:
+--   mysql -u<user> -p -h<host> ganymede < 006_transaction_progress.sql
+-- New installs get this from ganymede_schema.sql and do not need this migration.
+--
+-- Workers only log when a stage completes, so a long load or ETL looked the same as a stalled worker. While a
+-- stage makes progress the worker now posts a heartbeat, which the API records in transaction_state.progress, and
+-- Jupiter takes a worker to be stalled only once neither updated nor progress has moved for jupiter_stall_minutes.
+use `ganymede`;
+
+ALTER TABLE `ganymede`.`transaction_state`
+  ADD COLUMN progress datetime AFTER updated;
+
+INSERT INTO `ganymede`.`schema_version` (version, description, applied) VALUES (6, 'transaction progress', UTC_TIMESTAMP());
@@ -0,0 +1,16 @@
+-- Migration 007: work queue lease lookups and retention
+--
+-- Apply to an existing Ganymede schema with:
+--   mysql -u<user> -p -h<host> ganymede < 007_work_queue_retention.sql
+-- New installs get this from ganymede_schema.sql and do not need this migration.
+--
+-- Without SKIP LOCKED, a worker daemon claims work with a single UPDATE and then finds the rows it leased by their
+-- lease token, which needs an index of its own. Jupiter now purges DONE and FAILED transactions once they are older
+-- than queue_retention_days, which reads idx_work_queue_finished (see server/ganymede_queue.py).
+use `ganymede`;
+
+ALTER TABLE `ganymede`.`work_queue`
+  ADD INDEX idx_work_queue_lease (lease_token),
+  ADD INDEX idx_work_queue_finished (state, updated);
+
+INSERT INTO `ganymede`.`schema_version` (version, description, applied) VALUES (7, 'work queue retention', UTC_TIMESTAMP());